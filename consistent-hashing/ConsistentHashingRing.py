@@ -4,7 +4,7 @@ Each cache node is represented by an instance of the CacheNode class.
 """
 
 from typing import List, Optional
-from cache.CacheNode import CacheNode
+from cache.CacheNode import CacheNode, ValueCompressor
 import hashlib
 import bisect
 import logging
@@ -15,7 +15,7 @@ logger = logging.getLogger(__name__)
 
 
 class ConsistentHashingRing:
-    def __init__(self, cache_size: int, servers: List[str], replication_factor: int) -> None:
+    def __init__(self, cache_size: int, servers: List[str], replication_factor: int, compression_threshold: int = 1024) -> None:
         self.replication_factor = replication_factor
         self.ring = {} # Create the Hash Ring
         self.sorted_keys = [] # Sorted list of hash keys
@@ -23,6 +23,8 @@ class ConsistentHashingRing:
         self.cache_size = cache_size # Cache size for each CacheNode
         self.virtual_node_map = {} # Map of virtual nodes to real servers
         self.server_virtual_node_map = defaultdict(list) # Map of real servers to their virtual nodes
+        self.compression_threshold = compression_threshold # Values larger than this (in bytes) are compressed
+        self.compressor = ValueCompressor(threshold=compression_threshold) # Client edge compression
        
         logger.debug("Initializing Consistent Hashing Ring. Adding Servers: %s", servers)
 
@@ -45,7 +47,7 @@ class ConsistentHashingRing:
         logger.debug("Adding Server: %s to the hash ring", server)
         parent_hash_val = self._get_hash_key(f"{server}-{0}") 
         logger.debug("Adding parent node with hash: %d for server: %s-0", parent_hash_val, server)
-        self.ring[parent_hash_val] = CacheNode(instance_no=parent_hash_val, cache_size=self.cache_size)
+        self.ring[parent_hash_val] = CacheNode(instance_no=parent_hash_val, cache_size=self.cache_size, compression_threshold=self.compression_threshold)
 
         self.virtual_node_map[parent_hash_val] = parent_hash_val
         self.server_virtual_node_map[parent_hash_val].append(parent_hash_val)
@@ -131,7 +133,7 @@ class ConsistentHashingRing:
         server = self.get_server(key)
         if server:
             logger.debug("Putting key: %s into server with instance_no: %d", key, server.instance_no)
-            server.put_entry(key, value)
+            server.put_entry(key, self.compressor.compress(value))
             return True
         else:
             logger.error("No servers available in the hash ring to put key: %s", key)
@@ -150,11 +152,17 @@ class ConsistentHashingRing:
             value =  server.get_entry(key)
             if value is None:
                 logger.warning("Key 'value' not found in response for key: %s from server with instance_no: %d", key, server.instance_no)
-            return value
+            # Values are stored compressed and only decompressed here
+            return self.compressor.decompress(value)
             
         else:
             raise Exception("No servers available in the hash ring")
 
+    def get_compression_stats(self) -> dict:
+        ''' Returns the compression metrics for the client edge and for each cache node '''
+        nodes = {str(node.instance_no): node.get_compression_stats() for node in self.ring.values()}
+        return {"client": self.compressor.get_stats(), "nodes": nodes}
+
 # ----- Testing -----
 
 if __name__ == "__main__":
@@ -170,6 +178,17 @@ if __name__ == "__main__":
     assert(ring.get_cache_entry("key31") == "value31")  # Should print value31
     assert(ring.get_cache_entry("key21") == "value21")  # Should print value21
     assert(ring.get_cache_entry("all") == "good")  # Should print sum
+    large_value = {"tickets": [{"seat": f"A{i}", "state": "available"} for i in range(100)]}
+    ring.put_cache_entry("large", large_value)
+    assert(ring.get_cache_entry("large") == large_value)
+    # Compressed once by the ring, held compressed by a single node
+    stats = ring.get_compression_stats()
+    assert(stats["client"]["compressed_entries"] == 1)
+    assert(sum(node["compressed_entries"] for node in stats["nodes"].values()) == 1)
+    lookalike = {"__compressed__": "zlib", "data": "user data"}
+    ring.put_cache_entry("lookalike", lookalike)
+    assert(ring.get_cache_entry("lookalike") == lookalike)
+    print(stats)
     
 
 
@@ -3,8 +3,7 @@ This class implements a consistent hashing ring to distribute keys across multip
 Each cache node is represented by an instance of the CacheNode class.
 """
 
-from DockerHelper import CacheDockerHelper
-from cache.CacheNode import CacheNode
+from cache.CacheNode import CacheNode, ValueCompressor
 from typing import List
 import hashlib
 import bisect
@@ -21,23 +20,31 @@ class NoServersAvailableException(Exception):
 
 
 class ConsistentHashingRingContainer:
-    def __init__(self, cache_size: int, servers: List[str], replication_factor: int) -> None:
+    def __init__(self, cache_size: int, servers: List[str], replication_factor: int, compression_threshold: int = 1024, pool_size: int = 2, port_base: int = 5000, node_helper=None) -> None:
         self.replication_factor = replication_factor
         self.ring = {} # Create the Hash Ring
         self.sorted_keys = [] # Sorted list of hash keys
         self.servers = set() # Set of servers in the ring
         self.virtual_node_map = {} # Map of virtual nodes to real servers
         self.server_virtual_node_map = defaultdict(list) # Map of real servers to their virtual nodes
+        self.version = 0 # Topology version, bumped on every membership change and announced to the cache nodes
        
         self.cache_size = cache_size # Cache size for each CacheNode
-        self.cur_port = 5000  # Starting port for CacheNode instances
-        self.docker_helper = CacheDockerHelper(port_base=self.cur_port)
         self.base_cache_url = "http://0.0.0.0"
+        self.compression_threshold = compression_threshold # Values larger than this (in bytes) are compressed
+        self.compressor = ValueCompressor(threshold=compression_threshold) # Client edge compression
+        # The node helper starts the cache nodes. By default these are docker containers: the docker helper hands out 
+        # ports starting after port_base and keeps pool_size idle containers pre-started. A CacheProcessHelper can be passed
+        # instead to run the cache nodes as local processes.
+        if node_helper is None:
+            # Imported here so that running the cache nodes as processes does not need the docker SDK
+            from DockerHelper import CacheDockerHelper
+            node_helper = CacheDockerHelper(port_base=port_base, pool_size=pool_size, cache_size=cache_size, compression_threshold=compression_threshold)
+        self.node_helper = node_helper
         
         logger.debug("Initializing Consistent Hashing Ring. Adding Servers: %s", servers)
 
-        for server in servers:
-            self.add_server(server)
+        self.add_servers(servers)
 
     def _get_hash_key(self, key: str) -> int:
         ''' Returns a hash value for the given key using MD5'''
@@ -51,17 +58,40 @@ class ConsistentHashingRingContainer:
 
     def add_server(self, server: str) -> None:
         ''' Adds a server to the hash ring with virtual nodes based on the replication factor '''
+        self.add_servers([server])
+
+    def add_servers(self, servers: List[str]) -> None:
+        ''' Adds servers to the hash ring. The cache containers for all servers are provisioned concurrently
+            and each server only receives traffic once its container is ready '''
+        if self._start_servers(servers):
+            self.set_version(self.version + 1)
+
+    def _start_servers(self, servers: List[str]) -> List[str]:
+        ''' Provisions containers for the servers not on the hash ring yet and places them on it, without
+            announcing a new version. Returns the servers added '''
+        servers = [server for server in dict.fromkeys(servers) if server not in self.servers]
+        if not servers:
+            return []
+        container_requests = [(f'lru-cache-{server}', self._get_hash_key(f"{server}-{0}")) for server in servers]
+        container_nodes = self.node_helper.acquire_containers(container_requests, cache_size=self.cache_size, compression_threshold=self.compression_threshold)
+        for server, container_node in zip(servers, container_nodes):
+            self._register_server(server, container_node)
+        return servers
+
+    def _register_server(self, server: str, container_node) -> None:
+        ''' Places a server with a ready container and its virtual nodes on the hash ring '''
         self.servers.add(server)
         logger.debug("Adding Server: %s to the hash ring", server)
         container_name = f"{server}-{0}"
         parent_hash_val = self._get_hash_key(container_name) 
         logger.debug("Adding parent node with hash: %d for server: %s-0", parent_hash_val, server)
 
-        self.cur_port += 1
-        self.ring[parent_hash_val] = self.docker_helper.create_container(name=f'lru-cache-{server}', instance_no=parent_hash_val, cache_size=self.cache_size, port=self.cur_port)
+        self.ring[parent_hash_val] = container_node
 
         self.virtual_node_map[parent_hash_val] = parent_hash_val
         self.server_virtual_node_map[parent_hash_val].append(parent_hash_val)
+
+        bisect.insort(self.sorted_keys, parent_hash_val)
         
         for i in range(1, self.replication_factor):
             # Add as many virtual nodes as the replication factor
@@ -72,40 +102,69 @@ class ConsistentHashingRingContainer:
             self.virtual_node_map[hash_val] = parent_hash_val
             self.server_virtual_node_map[parent_hash_val].append(hash_val)
 
-            # self.ring[hash_val] = CacheNode(instance_no=hash_val, cache_size=self.cache_size)
-            # self.ring[hash_val] = self.docker_helper.create_container(name=f'lru-cache-{container_name}', instance_no=hash_val, cache_size=self.cache_size, port=self.cur_port)
             # Keeping it sorted will help in efficient lookups
             bisect.insort(self.sorted_keys, hash_val)  
 
     def remove_server(self, server: str) -> None:
         ''' Removes a server and its virtual nodes from the hash ring '''
+        return self.remove_servers([server])
+
+    def remove_servers(self, servers: List[str]) -> bool:
+        ''' Removes servers from the hash ring. Their containers are recycled into the idle pool
+            or stopped and removed concurrently. Returns False if none of the servers were in the ring '''
+        container_nodes = []
+        for server in dict.fromkeys(servers):
+            container_node = self._unregister_server(server)
+            if container_node:
+                container_nodes.append(container_node)
+        if not container_nodes:
+            return False
+        # Let the removed cache nodes know too so they reject clients still routing to them
+        self.set_version(self.version + 1, container_nodes)
+        self.node_helper.release_containers(container_nodes)
+        return True
+
+    def _unregister_server(self, server: str):
+        ''' Takes a server and its virtual nodes off the hash ring and returns its container '''
         parent_hash_val = self._get_hash_key(f"{server}-0")
         logger.debug("Removing parent node with hash: %d for server: %s-0", parent_hash_val, server)
 
         if server in self.servers:
             logger.debug("Removing Server: %s from the hash ring", server)
-            for i in range(1, self.replication_factor):
-                container_name = f"{server}-{i}"
-                hash_val = self._get_hash_key(container_name)
-                logger.debug("Removing virtual node with hash: %d for server: %s-%d", hash_val, server, i)
-                # Remove from ring and sorted keys
-                self.docker_helper.stop_container(self.ring[hash_val])
-                self.docker_helper.remove_container(self.ring[hash_val])
-                del self.ring[hash_val]
+            for hash_val in self.server_virtual_node_map[parent_hash_val]:
+                logger.debug("Removing virtual node with hash: %d for server: %s", hash_val, server)
+                del self.virtual_node_map[hash_val]
                 # Find the index of hash_val in sorted_keys and remove it
                 index = bisect.bisect_left(self.sorted_keys, hash_val)
                 del self.sorted_keys[index]
 
             # Finally remove the parent node
-            del self.virtual_node_map[parent_hash_val]
             del self.server_virtual_node_map[parent_hash_val]
-            del self.ring[parent_hash_val]
+            container_node = self.ring.pop(parent_hash_val)
 
             self.servers.remove(server)
-            return True
+            return container_node
         else:
             logger.warning("Attempted to remove non-existent server: %s from the hash ring", server)
-            return False
+            return None
+
+    def set_version(self, version: int, removed_nodes: List = ()) -> None:
+        ''' Records the topology version and announces it to the cache nodes, so that they can reject
+            requests from smart clients that routed with an older topology '''
+        self.version = version
+        for node in list(self.ring.values()) + list(removed_nodes):
+            try:
+                requests.post(self.base_cache_url + f":{node.port}/ring_version", json={"version": version}, timeout=1)
+            except Exception as e:
+                logger.error("Error announcing ring version %d to server with instance_no: %d. Error: %s", version, node.instance_no, str(e))
+
+    def get_topology(self) -> dict:
+        ''' Returns the topology version and the cache node of every server, used by smart clients to route directly '''
+        servers = {}
+        for server in self.servers:
+            node = self.ring[self._get_hash_key(f"{server}-0")]
+            servers[server] = {"instance_no": node.instance_no, "port": node.port}
+        return {"version": self.version, "replication_factor": self.replication_factor, "servers": servers}
 
     def get_server(self, key: str) -> CacheNode:
         ''' Returns the CacheNode responsible for the given key
@@ -145,14 +204,18 @@ class ConsistentHashingRingContainer:
 
     def put_cache_entry(self, key: str, value: str) -> None:
         ''' Puts an entry into the appropriate cache node based on consistent hashing '''
-        server = self.get_server(key)
+        return self._put_entry_on(self.get_server(key), key, value)
+
+    def _put_entry_on(self, server, key: str, value: str) -> bool:
+        ''' Puts an entry into the given cache node '''
         if server:
             logger.debug("Putting key: %s into server with instance_no: %d", key, server.instance_no)
             
             # server.put_entry(key, value)
             try:
                 url = self.base_cache_url + f":{server.port}/put_entry"
-                json = {'key': key, 'value': value}
+                # Large values are compressed here and stay compressed on the wire and in the cache node
+                json = {'key': key, 'value': self.compressor.to_wire(self.compressor.compress(value))}
                 response = requests.post(url, json=json)
                 logger.debug("POST %s status_code: %d, response: %s", url, response.status_code, response.text)
                 return True
@@ -166,7 +229,10 @@ class ConsistentHashingRingContainer:
 
     def get_cache_entry(self, key: str) -> str:
         ''' Gets an entry from the appropriate cache node based on consistent hashing '''
-        server = self.get_server(key)
+        return self._get_entry_from(self.get_server(key), key)
+
+    def _get_entry_from(self, server, key: str) -> str:
+        ''' Gets an entry from the given cache node '''
         if server:
             url = self.base_cache_url + f":{server.port}/get_entry/{key}"
             logger.debug("Getting key: %s from server with instance_no: %d", key, server.instance_no)
@@ -175,12 +241,23 @@ class ConsistentHashingRingContainer:
                 value = response.json().get('value')
                 if value is None:
                     logger.warning("Key 'value' not found in response for key: %s from server with instance_no: %d", key, server.instance_no)
-                return value
+                return self.compressor.decompress(self.compressor.from_wire(value))
             except Exception as e:
                 logger.error("Error getting key: %s from server with instance_no: %d. Error: %s", key, server.instance_no, str(e))
                 return None
         else:
             raise NoServersAvailableException("No servers available in the hash ring")
+
+    def get_compression_stats(self) -> dict:
+        ''' Returns the compression metrics for the client edge and for each cache node '''
+        nodes = {}
+        for server in set(self.ring.values()):
+            try:
+                response = requests.get(self.base_cache_url + f":{server.port}/compression_stats")
+                nodes[str(server.instance_no)] = response.json()
+            except Exception as e:
+                logger.error("Error getting compression stats from server with instance_no: %d. Error: %s", server.instance_no, str(e))
+        return {"client": self.compressor.get_stats(), "nodes": nodes}
         
 
 # ----- Testing -----
@@ -1,10 +1,18 @@
 """
 This module provides helper functions for creating and managing docker containers for each CacheNode.
 It uses the Docker SDK for Python to interact with Docker.
+
+Containers are provisioned concurrently and a small pool of pre-started idle containers is kept
+around so that new cache nodes can be handed out instantly when the ring scales out.
 """
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import List, Optional, Tuple
 import docker
 import logging
 import os
+import threading
+import time
+import requests
 
 log_file = os.environ.get('CONSISTENT_HASHING_LOG', 'consistent_hashing.log')
 logging.basicConfig(filename=log_file, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -17,15 +25,34 @@ class ContainerNode:
         self.port = port
 
 class CacheDockerHelper:
-    def __init__(self, port_base: int = 5000):
+    def __init__(self, port_base: int = 5000, pool_size: int = 0, cache_size: int = 100, compression_threshold: int = 1024,
+                 max_workers: int = 8, ready_timeout: int = 30):
         self.client = docker.from_env()
         self.port_base = port_base
+        self.cur_port = port_base # Last port handed out to a container
+        self.pool_size = pool_size # Number of idle containers to keep pre-started
+        self.cache_size = cache_size # Default cache size for the idle containers
+        self.compression_threshold = compression_threshold # Default compression threshold for the idle containers
+        self.ready_timeout = ready_timeout # Seconds to wait for a container to start serving requests
+        self.base_url = "http://0.0.0.0"
+
+        self.idle_pool: List[ContainerNode] = [] # Pre-started containers not assigned to any server
+        self.pending = 0 # Idle containers being started
+        self.lock = threading.Lock() # Guards the port counter and the idle pool
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        self.fill_pool()
+
+    def _next_port(self) -> int:
+        with self.lock:
+            self.cur_port += 1
+            return self.cur_port
 
-    def create_container(self, name: str, instance_no : int, cache_size: int, port: int):
+    def create_container(self, name: str, instance_no : int, cache_size: int, port: int, compression_threshold: int = 1024):
         container = self.client.containers.run(
             image="lru_cache_node:latest",
             name=name,
-            command=f"{instance_no} {cache_size}",
+            command=f"{instance_no} {cache_size} {compression_threshold}",
             detach=True,
             ports={"5000/tcp": port}
         )
@@ -38,4 +65,130 @@ class CacheDockerHelper:
 
     def remove_container(self, container_node: ContainerNode):
         container_node.container.remove()
-        logger.info("Removed container for CacheNode %d", container_node.instance_no)
\ No newline at end of file
+        logger.info("Removed container for CacheNode %d", container_node.instance_no)
+
+    def wait_until_ready(self, container_node: ContainerNode) -> bool:
+        ''' Polls the container's health endpoint until it responds or the timeout is reached '''
+        url = self.base_url + f":{container_node.port}/health"
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline:
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    logger.debug("Container for CacheNode %d is ready on port %d", container_node.instance_no, container_node.port)
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.05)
+        logger.error("Container for CacheNode %d did not become ready on port %d", container_node.instance_no, container_node.port)
+        return False
+
+    # Methods to manage the pool of idle pre-started containers
+
+    def fill_pool(self) -> None:
+        ''' Starts idle containers in the background until the pool is full '''
+        with self.lock:
+            missing = self.pool_size - len(self.idle_pool) - self.pending
+            self.pending += max(missing, 0)
+        for _ in range(missing):
+            self.executor.submit(self._start_idle_container)
+
+    def _start_idle_container(self) -> None:
+        port = self._next_port()
+        try:
+            container_node = self.create_container(name=f"lru-cache-pool-{port}", instance_no=0, cache_size=self.cache_size,
+                                                   port=port, compression_threshold=self.compression_threshold)
+            if self.wait_until_ready(container_node):
+                with self.lock:
+                    self.idle_pool.append(container_node)
+                logger.info("Added idle container on port %d to the pool", port)
+            else:
+                self._destroy_container(container_node)
+        except Exception as e:
+            logger.error("Error starting idle container on port %d. Error: %s", port, str(e))
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _configure_container(self, container_node: ContainerNode, instance_no: int, cache_size: int, compression_threshold: int) -> bool:
+        ''' Assigns a new identity to a running container and clears its cache '''
+        url = self.base_url + f":{container_node.port}/reset_node"
+        json = {"instance_no": instance_no, "cache_size": cache_size, "compression_threshold": compression_threshold}
+        try:
+            response = requests.post(url, json=json, timeout=self.ready_timeout)
+            if response.status_code == 200:
+                container_node.instance_no = instance_no
+                return True
+            logger.error("Error configuring container on port %d. Status code: %d", container_node.port, response.status_code)
+        except requests.exceptions.RequestException as e:
+            logger.error("Error configuring container on port %d. Error: %s", container_node.port, str(e))
+        return False
+
+    def _destroy_container(self, container_node: ContainerNode) -> None:
+        try:
+            self.stop_container(container_node)
+            self.remove_container(container_node)
+        except Exception as e:
+            logger.error("Error destroying container for CacheNode %d. Error: %s", container_node.instance_no, str(e))
+
+    def acquire_container(self, name: str, instance_no: int, cache_size: int, compression_threshold: int = 1024) -> ContainerNode:
+        ''' Returns a ready container for a CacheNode. An idle container from the pool is used if one is available,
+            else a new container is created and we wait for it to be ready '''
+        container_node: Optional[ContainerNode] = None
+        with self.lock:
+            if self.idle_pool:
+                container_node = self.idle_pool.pop()
+        if container_node and self._configure_container(container_node, instance_no, cache_size, compression_threshold):
+            container_node.container.rename(name)
+            logger.info("Assigned idle container on port %d to CacheNode %d", container_node.port, instance_no)
+        else:
+            if container_node:
+                self.executor.submit(self._destroy_container, container_node)
+            container_node = self.create_container(name=name, instance_no=instance_no, cache_size=cache_size,
+                                                   port=self._next_port(), compression_threshold=compression_threshold)
+            if not self.wait_until_ready(container_node):
+                self._destroy_container(container_node)
+                raise Exception(f"Container for CacheNode {instance_no} did not become ready")
+        # Replace the container we just handed out
+        self.fill_pool()
+        return container_node
+
+    def acquire_containers(self, container_requests: List[Tuple[str, int]], cache_size: int, compression_threshold: int = 1024) -> List[ContainerNode]:
+        ''' Acquires containers for a list of (name, instance_no) requests concurrently '''
+        futures = [self.executor.submit(self.acquire_container, name, instance_no, cache_size, compression_threshold)
+                   for name, instance_no in container_requests]
+        # Wait for all of them before raising, so the ones that were acquired can be released
+        wait(futures)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            acquired = [future.result() for future in futures if future.exception() is None]
+            logger.error("Failed to acquire %d of %d containers, releasing the %d acquired - %s", len(errors), len(futures), len(acquired), str(errors[0]))
+            self.release_containers(acquired)
+            raise errors[0]
+        return [future.result() for future in futures]
+
+    def release_container(self, container_node: ContainerNode) -> None:
+        ''' Returns a container to the idle pool if there is room, else stops and removes it '''
+        with self.lock:
+            recycle = len(self.idle_pool) + self.pending < self.pool_size
+        if recycle and self._configure_container(container_node, 0, self.cache_size, self.compression_threshold):
+            container_node.container.rename(f"lru-cache-pool-{container_node.port}")
+            with self.lock:
+                self.idle_pool.append(container_node)
+            logger.info("Recycled container on port %d into the pool", container_node.port)
+        else:
+            self._destroy_container(container_node)
+
+    def release_containers(self, container_nodes: List[ContainerNode]) -> None:
+        ''' Releases a list of containers concurrently '''
+        futures = [self.executor.submit(self.release_container, container_node) for container_node in container_nodes]
+        for future in futures:
+            future.result()
+
+    def shutdown(self) -> None:
+        ''' Stops and removes all idle containers in the pool '''
+        with self.lock:
+            self.pool_size = 0
+            idle_pool, self.idle_pool = self.idle_pool, []
+        futures = [self.executor.submit(self._destroy_container, container_node) for container_node in idle_pool]
+        for future in futures:
+            future.result()
@@ -0,0 +1,191 @@
+"""
+This module provides helper functions for running each CacheNode as a local OS process.
+Each process runs the same CacheAPIInvocation Flask server as the docker containers, on its own port.
+It exposes the same methods as CacheDockerHelper so ConsistentHashingRingContainer can use either one,
+and supervises the processes so that a cache node that dies is restarted on the same port.
+"""
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, List, Tuple
+import atexit
+import logging
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import requests
+
+log_file = os.environ.get('CONSISTENT_HASHING_LOG', 'consistent_hashing.log')
+logging.basicConfig(filename=log_file, level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
+class ProcessNode:
+    def __init__(self, process: subprocess.Popen, instance_no: int, port: int, cache_size: int, compression_threshold: int):
+        self.process = process
+        self.instance_no = instance_no
+        self.port = port
+        self.cache_size = cache_size
+        self.compression_threshold = compression_threshold
+
+class CacheProcessHelper:
+    def __init__(self, port_base: int = 5000, max_workers: int = 8, ready_timeout: int = 10, supervise_interval: float = 1.0):
+        self.port_base = port_base
+        self.cur_port = port_base # Last port handed out to a process
+        self.ready_timeout = ready_timeout # Seconds to wait for a process to start serving requests
+        self.base_url = "http://127.0.0.1"
+        self.nodes: Dict[int, ProcessNode] = {} # Running processes keyed by port
+        self.lock = threading.Lock() # Guards the port counter and the running processes
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+        # The supervisor restarts cache node processes that exit unexpectedly
+        self.supervise_interval = supervise_interval
+        self.stop_event = threading.Event()
+        self.supervisor = threading.Thread(target=self._supervise, daemon=True)
+        self.supervisor.start()
+        atexit.register(self.shutdown)
+
+    def _port_in_use(self, port: int) -> bool:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            return sock.connect_ex(("127.0.0.1", port)) == 0
+
+    def _next_port(self) -> int:
+        ''' Returns the next free port, skipping ports used by other programs '''
+        with self.lock:
+            self.cur_port += 1
+            while self._port_in_use(self.cur_port):
+                self.cur_port += 1
+            return self.cur_port
+
+    def _spawn(self, instance_no: int, cache_size: int, port: int, compression_threshold: int) -> subprocess.Popen:
+        return subprocess.Popen(
+            [sys.executable, "CacheAPIInvocation.py", str(instance_no), str(cache_size), str(compression_threshold), str(port)],
+            cwd=CACHE_DIR,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    def create_process(self, instance_no: int, cache_size: int, port: int, compression_threshold: int = 1024) -> ProcessNode:
+        process = self._spawn(instance_no, cache_size, port, compression_threshold)
+        process_node = ProcessNode(process=process, instance_no=instance_no, port=port, cache_size=cache_size, compression_threshold=compression_threshold)
+        with self.lock:
+            self.nodes[port] = process_node
+        logger.info("Started process %d for CacheNode %d on port %d", process.pid, instance_no, port)
+        return process_node
+
+    def stop_process(self, process_node: ProcessNode) -> None:
+        with self.lock:
+            self.nodes.pop(process_node.port, None)
+        process_node.process.terminate()
+        try:
+            process_node.process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            process_node.process.kill()
+            process_node.process.wait()
+        logger.info("Stopped process for CacheNode %d on port %d", process_node.instance_no, process_node.port)
+
+    def wait_until_ready(self, process_node: ProcessNode) -> bool:
+        ''' Polls the process's health endpoint until it responds or the timeout is reached '''
+        url = self.base_url + f":{process_node.port}/health"
+        deadline = time.monotonic() + self.ready_timeout
+        while time.monotonic() < deadline:
+            if process_node.process.poll() is not None:
+                break
+            try:
+                if requests.get(url, timeout=1).status_code == 200:
+                    logger.debug("Process for CacheNode %d is ready on port %d", process_node.instance_no, process_node.port)
+                    return True
+            except requests.exceptions.RequestException:
+                pass
+            time.sleep(0.02)
+        logger.error("Process for CacheNode %d did not become ready on port %d", process_node.instance_no, process_node.port)
+        return False
+
+    def _supervise(self) -> None:
+        while not self.stop_event.wait(self.supervise_interval):
+            with self.lock:
+                dead_nodes = [node for node in self.nodes.values() if node.process.poll() is not None]
+            for node in dead_nodes:
+                with self.lock:
+                    # Skip nodes that were stopped on purpose since we took the snapshot
+                    if self.nodes.get(node.port) is not node:
+                        continue
+                    logger.warning("Process for CacheNode %d on port %d exited with code %s. Restarting it.",
+                                   node.instance_no, node.port, node.process.returncode)
+                    node.process = self._spawn(node.instance_no, node.cache_size, node.port, node.compression_threshold)
+
+    # Same interface as CacheDockerHelper
+
+    def acquire_container(self, name: str, instance_no: int, cache_size: int, compression_threshold: int = 1024) -> ProcessNode:
+        ''' Starts a cache node process and waits for it to be ready. The name is only used for logging '''
+        process_node = self.create_process(instance_no=instance_no, cache_size=cache_size, port=self._next_port(), compression_threshold=compression_threshold)
+        if not self.wait_until_ready(process_node):
+            self.stop_process(process_node)
+            raise Exception(f"Process {name} for CacheNode {instance_no} did not become ready")
+        return process_node
+
+    def acquire_containers(self, container_requests: List[Tuple[str, int]], cache_size: int, compression_threshold: int = 1024) -> List[ProcessNode]:
+        ''' Starts cache node processes for a list of (name, instance_no) requests concurrently '''
+        futures = [self.executor.submit(self.acquire_container, name, instance_no, cache_size, compression_threshold)
+                   for name, instance_no in container_requests]
+        # Wait for all of them before raising, so the ones that were acquired can be released
+        wait(futures)
+        errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            acquired = [future.result() for future in futures if future.exception() is None]
+            logger.error("Failed to acquire %d of %d cache node processes, releasing the %d acquired - %s", len(errors), len(futures), len(acquired), str(errors[0]))
+            self.release_containers(acquired)
+            raise errors[0]
+        return [future.result() for future in futures]
+
+    def release_container(self, process_node: ProcessNode) -> None:
+        self.stop_process(process_node)
+
+    def release_containers(self, process_nodes: List[ProcessNode]) -> None:
+        ''' Stops a list of cache node processes concurrently '''
+        futures = [self.executor.submit(self.stop_process, process_node) for process_node in process_nodes]
+        for future in futures:
+            future.result()
+
+    def shutdown(self) -> None:
+        ''' Stops the supervisor and all running cache node processes '''
+        # This also runs at interpreter exit, when the executor no longer accepts work
+        self.stop_event.set()
+        with self.lock:
+            process_nodes = list(self.nodes.values())
+            self.nodes.clear()
+        # Signal every process first so they all shut down in parallel
+        for process_node in process_nodes:
+            process_node.process.terminate()
+        for process_node in process_nodes:
+            try:
+                process_node.process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                process_node.process.kill()
+                process_node.process.wait()
+        if process_nodes:
+            logger.info("Stopped %d cache node processes", len(process_nodes))
+
+
+# ----- Testing -----
+
+if __name__ == "__main__":
+    from ConsistentHashingRingContainer import ConsistentHashingRingContainer
+
+    servers = [f"server{i}" for i in range(8)]
+    start = time.perf_counter()
+    ring = ConsistentHashingRingContainer(cache_size=1000, servers=servers, replication_factor=3, node_helper=CacheProcessHelper())
+    print(f"Started {len(servers)} cache node processes in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    for i in range(2000):
+        ring.put_cache_entry(f"key{i}", f"value{i}")
+    for i in range(2000):
+        assert(ring.get_cache_entry(f"key{i}") == f"value{i}")
+    print(f"4000 operations in {time.perf_counter() - start:.2f}s")
+
+    start = time.perf_counter()
+    ring.node_helper.shutdown()
+    print(f"Stopped cache node processes in {time.perf_counter() - start:.2f}s")
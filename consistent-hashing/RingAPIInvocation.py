@@ -5,8 +5,15 @@ from typing import List
 from flask import Flask, request
 from ConsistentHashingRing import ConsistentHashingRing
 from ConsistentHashingRingContainer import ConsistentHashingRingContainer
+from ProcessHelper import CacheProcessHelper
+from SharedRing import SharedConsistentHashingRing, SharedRingState
 from cache.CacheNode import CacheNode
 import logging
+import multiprocessing
+import signal
+import socket
+import sys
+from werkzeug.serving import make_server
 
 
 logging.basicConfig(filename='consistent_hashing.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -19,21 +26,45 @@ import os
 cache_size = int(os.getenv('CACHE_SIZE', 3))
 servers = os.getenv('SERVERS', 'server1,server2').split(',')
 replication_factor = int(os.getenv('REPLICATION_FACTOR', 2))
-### Set this variable to change how you want to run the Consistent Hashing Ring: Local or Dockerized Cache Nodes
-RUN_MODE_LOCAL = os.getenv('RUN_MODE_LOCAL', 'True') == 'True'  # Set to 'True' to use local CacheNode instances
+compression_threshold = int(os.getenv('COMPRESSION_THRESHOLD', 1024))  # Values larger than this (in bytes) are compressed
+container_pool_size = int(os.getenv('CONTAINER_POOL_SIZE', 2))  # Idle cache containers kept pre-started in Dockerized mode
+### Set this variable to change how you want to run the Consistent Hashing Ring: Local, Local Processes or Dockerized Cache Nodes
+RUN_MODE = os.getenv('RUN_MODE_LOCAL', 'True')
+RUN_MODE_LOCAL = RUN_MODE == 'True'  # Set to 'True' to use local CacheNode instances
+RUN_MODE_PROCESS = RUN_MODE == 'Process'  # Set to 'Process' to run each CacheNode as a local process
 
 
-print ('Initializing Consistent Hashing Ring in mode:', 'Local' if RUN_MODE_LOCAL else 'Dockerized Cache Nodes')
+### Set this variable to run the router with several worker processes. The workers share the ring topology
+### through shared memory, so this is only supported when the cache nodes are local processes or docker containers.
+WORKERS = int(os.getenv('WORKERS', 1))
+if WORKERS > 1 and RUN_MODE_LOCAL:
+    print ('WORKERS is ignored in Local mode as the cache nodes live inside the router process. Running a single worker.')
+    WORKERS = 1
 
-ring_controller = ConsistentHashingRingContainer(
-    cache_size=cache_size,
-    servers=servers,
-    replication_factor=replication_factor
-) if not RUN_MODE_LOCAL else ConsistentHashingRing(
-    cache_size=cache_size,
-    servers=servers,
-    replication_factor=replication_factor
-)
+
+print ('Initializing Consistent Hashing Ring in mode:', 'Local' if RUN_MODE_LOCAL else 'Local Processes' if RUN_MODE_PROCESS else 'Dockerized Cache Nodes')
+
+def create_ring_controller(servers: List[str], port_base: int = 5000):
+    ''' Builds the Consistent Hashing Ring for the configured run mode '''
+    if RUN_MODE_LOCAL:
+        return ConsistentHashingRing(
+            cache_size=cache_size,
+            servers=servers,
+            replication_factor=replication_factor,
+            compression_threshold=compression_threshold
+        )
+    return ConsistentHashingRingContainer(
+        cache_size=cache_size,
+        servers=servers,
+        replication_factor=replication_factor,
+        compression_threshold=compression_threshold,
+        pool_size=container_pool_size,
+        port_base=port_base,
+        node_helper=CacheProcessHelper(port_base=port_base) if RUN_MODE_PROCESS else None
+    )
+
+# In multi-worker mode each worker builds its own ring_controller after it is forked
+ring_controller = create_ring_controller(servers) if WORKERS == 1 else None
 
 # *** Note:  The Server related methods will be used specifically by monitoring programs 
 # to add/remove servers from the ring dynamically depending on load. These should not be
@@ -69,6 +100,14 @@ def get_servers() -> List[dict]:
     servers = ring_controller.get_servers()
     return {"servers": servers}, 200
 
+@app.route('/topology', methods=['GET'])
+def topology() -> tuple[dict, int]:
+    ''' API used by smart clients to fetch the ring topology and route directly to the cache nodes '''
+    logger.info("Received request to get the ring topology")
+    if RUN_MODE_LOCAL:
+        return {"error": "Topology is not available in Local mode as the cache nodes live inside the router."}, 400
+    return ring_controller.get_topology(), 200
+
 
 # *** Note: The following methods are the client-facing APIs 
 # to interact with the cache via the Consistent Hashing Ring ***
@@ -79,7 +118,7 @@ def put_cache_entry() -> tuple[str, int]:
     # Get Key/Value from the request body
     key = request.json.get('key')
     value = request.json.get('value')
-    logger.info("Received request to put cache entry: key=%s, value=%s", key, value)
+    logger.info("Received request to put cache entry: key=%s", key)
     if key is None or value is None:
         return "Key and Value must be provided.", 400
     if ring_controller.put_cache_entry(key, value):
@@ -96,7 +135,61 @@ def get_cache_entry(key: str) -> tuple[str, int]:
         return value, 200
     else:
         return f"Key {key} not found in cache.", 404
+
+@app.route('/compression_stats', methods=['GET'])
+def compression_stats() -> tuple[dict, int]:
+    ''' API to get the compression ratio and CPU cost for the ring and its cache nodes '''
+    logger.info("Received request to get compression stats")
+    return ring_controller.get_compression_stats(), 200
     
+def run_worker(worker_no: int, state: SharedRingState, listen_fd: int) -> None:
+    ''' Serves requests in a forked worker process. All workers accept connections on the same listening socket '''
+    global ring_controller
+    # Each worker hands out ports (and names its idle containers) for the cache nodes it starts from its own range
+    # so they never clash
+    ring = create_ring_controller([], port_base=5000 + worker_no * 1000)
+    ring_controller = SharedConsistentHashingRing(ring, state)
+    if worker_no == 0:
+        # The first worker starts the initial servers. The others pick them up from the shared topology.
+        ring_controller.initialize(servers)
+    else:
+        ring_controller.wait_until_initialized()
+    logger.info("Worker %d serving requests", worker_no)
+    # Forked workers do not run atexit handlers, so stop the cache nodes this worker started explicitly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        make_server('0.0.0.0', 6000, app, threaded=True, fd=listen_fd).serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ring_controller.stop()
+        ring.node_helper.shutdown()
+
+def run_workers(workers: int) -> None:
+    ''' Forks the worker processes and waits for them '''
+    state = SharedRingState()
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(('0.0.0.0', 6000))
+    listen_socket.listen(128)
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=run_worker, args=(worker_no, state, listen_socket.fileno())) for worker_no in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.terminate()
+            process.join()
+    finally:
+        listen_socket.close()
+        state.close(unlink=True)
+
 # ----- Testing -----
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=6000)
\ No newline at end of file
+    if WORKERS > 1:
+        run_workers(WORKERS)
+    else:
+        app.run(host='0.0.0.0', port=6000)
\ No newline at end of file
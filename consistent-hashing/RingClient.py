@@ -0,0 +1,111 @@
+"""
+Smart client for the Consistent Hashing Ring.
+The client fetches the ring topology from the router once, places keys on the ring locally using the same MD5 hashing
+and talks directly to the cache node that owns a key, removing the hop through RingAPIInvocation.
+The topology is refreshed when a cache node reports a newer ring version or rejects a request because it is not the owner.
+"""
+from cache.CacheNode import ValueCompressor
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlparse
+import bisect
+import hashlib
+import logging
+import requests
+
+logging.basicConfig(filename='consistent_hashing.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+
+class NotOwnerException(Exception):
+    """Raised when a cache node rejects a request because the client routed it with an outdated topology."""
+    pass
+
+
+class RingClient:
+    def __init__(self, router_url: str = "http://localhost:6000", node_host: Optional[str] = None,
+                 compression_threshold: int = 1024, max_retries: int = 2):
+        self.router_url = router_url
+        # Cache nodes are reached on the router's host unless told otherwise
+        self.node_host = node_host or urlparse(router_url).hostname
+        self.max_retries = max_retries # Times a request is retried after refreshing the topology
+        self.session = requests.Session() # Keeps connections to the cache nodes alive
+        self.compressor = ValueCompressor(threshold=compression_threshold) # This is the client edge
+
+        self.version = -1 # Version of the topology the local ring was built from
+        self.sorted_keys = [] # Sorted list of hash keys
+        self.virtual_node_map: Dict[int, Tuple[int, int]] = {} # Map of virtual nodes to (instance_no, port) of their cache node
+        self.refresh_topology()
+
+    def _get_hash_key(self, key: str) -> int:
+        ''' Returns a hash value for the given key using MD5, same as the ring '''
+        return int(hashlib.md5(key.encode()).hexdigest(), 16)
+
+    def refresh_topology(self) -> None:
+        ''' Fetches the topology from the router and rebuilds the local ring '''
+        response = self.session.get(f"{self.router_url}/topology")
+        response.raise_for_status()
+        topology = response.json()
+        virtual_node_map = {}
+        for server, node in topology["servers"].items():
+            for i in range(topology["replication_factor"]):
+                virtual_node_map[self._get_hash_key(f"{server}-{i}")] = (node["instance_no"], node["port"])
+        self.virtual_node_map = virtual_node_map
+        self.sorted_keys = sorted(virtual_node_map)
+        self.version = topology["version"]
+        logger.debug("Refreshed ring topology to version %d with servers: %s", self.version, list(topology["servers"]))
+
+    def _get_node(self, key: str) -> Tuple[int, int]:
+        ''' Returns the (instance_no, port) of the cache node that owns the key '''
+        if not self.sorted_keys:
+            raise Exception("No servers available in the hash ring")
+        index = bisect.bisect(self.sorted_keys, self._get_hash_key(key)) % len(self.sorted_keys)
+        return self.virtual_node_map[self.sorted_keys[index]]
+
+    def _request(self, method: str, key: str, path: str, json: Optional[dict] = None) -> requests.Response:
+        ''' Sends a request to the owner of the key, refreshing the topology and retrying if the owner has changed '''
+        for _ in range(self.max_retries + 1):
+            instance_no, port = self._get_node(key)
+            url = f"http://{self.node_host}:{port}"
+            headers = {"X-Ring-Version": str(self.version), "X-Instance-No": str(instance_no)}
+            try:
+                response = self.session.request(method, url + path, headers=headers, json=json)
+            except requests.exceptions.ConnectionError as e:
+                # The cache node was probably removed from the ring
+                logger.warning("Could not reach cache node with instance_no: %d for key: %s. Error: %s", instance_no, key, str(e))
+                self.refresh_topology()
+                continue
+            if response.status_code == 409:
+                logger.debug("Cache node with instance_no: %d rejected key: %s: %s", instance_no, key, response.text)
+                self.refresh_topology()
+                continue
+            # Pick up topology changes announced on any response
+            if int(response.headers.get("X-Ring-Version", self.version)) > self.version:
+                self.refresh_topology()
+            return response
+        raise NotOwnerException(f"Could not find the owner of key {key} after {self.max_retries} topology refreshes")
+
+    def put(self, key: str, value: Any) -> bool:
+        ''' Puts an entry directly into the cache node that owns the key '''
+        json = {"key": key, "value": self.compressor.to_wire(self.compressor.compress(value))}
+        response = self._request("POST", key, path="/put_entry", json=json)
+        return response.status_code == 200
+
+    def get(self, key: str) -> Optional[Any]:
+        ''' Gets an entry directly from the cache node that owns the key. Returns None if the key is not found '''
+        response = self._request("GET", key, path=f"/get_entry/{key}")
+        if response.status_code != 200:
+            return None
+        return self.compressor.decompress(self.compressor.from_wire(response.json().get("value")))
+
+
+# ----- Testing -----
+
+if __name__ == "__main__":
+    # Start the router first with RUN_MODE_LOCAL set to 'Process' or 'False'
+    client = RingClient()
+    client.put("key1", "value1")
+    client.put("key2", {"seat": "A1"})
+    assert(client.get("key1") == "value1")
+    assert(client.get("key2") == {"seat": "A1"})
+    # Entries written by the smart client can be read through the router and vice versa
+    assert(requests.get(f"{client.router_url}/get_cache_entry/key1").text == "value1")
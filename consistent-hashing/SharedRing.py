@@ -0,0 +1,264 @@
+"""
+This module lets several RingAPIInvocation worker processes route with the same Consistent Hashing Ring.
+The ring topology (servers and the port of their cache node) lives in shared memory together with a version counter.
+Every worker keeps its own ConsistentHashingRingContainer and re-syncs it from shared memory whenever the version changes,
+so membership changes made through any worker are seen by all of them.
+Requests route with a copy of the local ring's routing tables that is replaced whole after every change, so they never
+see the ring half updated and never wait for a sync.
+A cache node is only ever released by the worker that started it. A server removed through another worker cannot be
+added again until its owner has released the old cache node, so two cache nodes for one server never run at once.
+"""
+from ConsistentHashingRingContainer import ConsistentHashingRingContainer
+from multiprocessing import shared_memory
+from typing import Dict, List, Optional
+import bisect
+import json
+import logging
+import multiprocessing
+import struct
+import threading
+import time
+
+logging.basicConfig(filename='consistent_hashing.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# Header of the shared memory block: version counter followed by the length of the JSON encoded topology
+HEADER = struct.Struct("QI")
+# Header of the block of servers waiting to be released: length of the JSON encoded list
+RELEASING_HEADER = struct.Struct("I")
+
+
+class SharedRingState:
+    ''' Ring topology stored in shared memory with a version counter. Must be created before the workers are forked '''
+    def __init__(self, size: int = 1 << 20, releasing_size: int = 1 << 16):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.lock = multiprocessing.get_context("fork").RLock() # Serializes membership changes across workers
+        HEADER.pack_into(self.shm.buf, 0, 0, 0)
+        # Servers removed through a worker that did not start their cache node, until that worker has released it.
+        # Kept out of the versioned topology, so finishing a release does not make every worker sync again.
+        self.releasing_shm = shared_memory.SharedMemory(create=True, size=releasing_size)
+        RELEASING_HEADER.pack_into(self.releasing_shm.buf, 0, 0)
+
+    @property
+    def version(self) -> int:
+        ''' Current version of the topology. Cheap enough to check on every request.
+            The version is odd while a write is in progress '''
+        return HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def read(self) -> tuple:
+        ''' Returns the current (version, topology). Readers never take the lock, they retry if a write
+            was in progress or happened while they were reading '''
+        while True:
+            version, length = HEADER.unpack_from(self.shm.buf, 0)
+            if version % 2:
+                time.sleep(0) # Let the writer finish
+                continue
+            data = bytes(self.shm.buf[HEADER.size:HEADER.size + length])
+            if self.version == version:
+                return version, (json.loads(data) if length else {})
+            time.sleep(0)
+
+    def write(self, topology: Dict[str, dict]) -> int:
+        ''' Replaces the topology and bumps the version. Callers must hold the lock '''
+        data = json.dumps(topology).encode()
+        if HEADER.size + len(data) > self.shm.size:
+            raise ValueError(f"Ring topology of {len(data)} bytes does not fit in shared memory of {self.shm.size} bytes")
+        version, length = HEADER.unpack_from(self.shm.buf, 0)
+        HEADER.pack_into(self.shm.buf, 0, version + 1, length)
+        self.shm.buf[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.shm.buf, 0, version + 2, len(data))
+        return version + 2
+
+    def get_releasing(self) -> List[str]:
+        ''' Servers whose cache node has not been released by the worker that started it yet. Callers must hold the lock '''
+        length, = RELEASING_HEADER.unpack_from(self.releasing_shm.buf, 0)
+        return json.loads(bytes(self.releasing_shm.buf[RELEASING_HEADER.size:RELEASING_HEADER.size + length])) if length else []
+
+    def set_releasing(self, servers: List[str]) -> None:
+        ''' Replaces the servers waiting to be released. Callers must hold the lock '''
+        data = json.dumps(servers).encode()
+        if RELEASING_HEADER.size + len(data) > self.releasing_shm.size:
+            raise ValueError(f"Servers waiting to be released of {len(data)} bytes do not fit in shared memory of {self.releasing_shm.size} bytes")
+        self.releasing_shm.buf[RELEASING_HEADER.size:RELEASING_HEADER.size + len(data)] = data
+        RELEASING_HEADER.pack_into(self.releasing_shm.buf, 0, len(data))
+
+    def close(self, unlink: bool = False) -> None:
+        for shm in (self.shm, self.releasing_shm):
+            shm.close()
+            if unlink:
+                shm.unlink()
+
+
+class RemoteNode:
+    ''' Cache node started by another worker. Only what is needed to route requests to it is known '''
+    def __init__(self, instance_no: int, port: int):
+        self.instance_no = instance_no
+        self.port = port
+
+
+class SharedConsistentHashingRing:
+    ''' Wraps a worker's ConsistentHashingRingContainer and keeps it in sync with the shared ring topology '''
+    def __init__(self, ring: ConsistentHashingRingContainer, state: SharedRingState, sync_interval: float = 0.5):
+        self.ring = ring
+        self.state = state
+        self.version = 0 # Version of the topology the local ring was built from
+        self.owned_servers = set() # Servers whose cache node was started by this worker
+        # Flask serves requests on several threads within a worker. Every change to the local ring is made under
+        # this lock, requests only read the routing tables below
+        self.sync_lock = threading.RLock()
+        self.routes = self._copy_routes() # (sorted_keys, virtual_node_map, ring) of the local ring
+        # Cache nodes removed through another worker are only released by their owner, so sync in the background too
+        self.sync_interval = sync_interval
+        self.stop_event = threading.Event()
+        self.sync_thread = threading.Thread(target=self._run_sync, daemon=True)
+        self.sync_thread.start()
+
+    def _run_sync(self) -> None:
+        while not self.stop_event.wait(self.sync_interval):
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error("Error syncing ring topology. Error: %s", str(e))
+
+    def stop(self) -> None:
+        self.stop_event.set()
+        self.sync_thread.join()
+
+    def initialize(self, servers: List[str]) -> None:
+        ''' Starts the initial servers and publishes the first topology. Only called by the first worker '''
+        with self.state.lock:
+            self.add_servers(servers)
+            if self.version == 0:
+                self._publish() # Even an empty ring, so the other workers stop waiting
+
+    def wait_until_initialized(self, poll_interval: float = 0.05) -> None:
+        ''' Blocks until the first worker has published the initial topology and syncs the local ring to it '''
+        while self.state.version == 0:
+            time.sleep(poll_interval)
+        self.sync()
+
+    def sync(self) -> None:
+        ''' Rebuilds the local ring if the shared topology has changed '''
+        if self.state.version == self.version:
+            return
+        with self.sync_lock:
+            version, topology = self.state.read()
+            if version == self.version:
+                return
+            released = self._apply(topology)
+            self.routes = self._copy_routes()
+            self.version = version
+            self.ring.version = version
+            logger.debug("Synced ring topology to version %d with servers: %s", version, list(topology))
+        if released:
+            try:
+                self.ring.node_helper.release_containers([node for _, node in released])
+            finally:
+                # Let workers waiting to add these servers again go ahead
+                with self.state.lock:
+                    released_servers = {server for server, _ in released}
+                    self.state.set_releasing([server for server in self.state.get_releasing() if server not in released_servers])
+
+    def _copy_routes(self) -> tuple:
+        # Copied after every change and swapped in with a single assignment
+        return list(self.ring.sorted_keys), dict(self.ring.virtual_node_map), dict(self.ring.ring)
+
+    def _apply(self, topology: Dict[str, dict]) -> List[tuple]:
+        ''' Updates the local ring to the topology and returns the (server, cache node) pairs this worker should release '''
+        released = []
+        for server in list(self.ring.servers):
+            node = self.ring.ring[self.ring._get_hash_key(f"{server}-0")]
+            # Servers that were removed, or removed and added again with a new cache node
+            if server not in topology or topology[server]["port"] != node.port:
+                self.ring._unregister_server(server)
+                if server in self.owned_servers:
+                    self.owned_servers.discard(server)
+                    released.append((server, node))
+        for server, node_info in topology.items():
+            if server not in self.ring.servers:
+                self.ring._register_server(server, RemoteNode(node_info["instance_no"], node_info["port"]))
+        return released
+
+    def _publish(self, removed_nodes: List = ()) -> None:
+        with self.sync_lock:
+            self.routes = self._copy_routes()
+            self.version = self.state.write(self.ring.get_topology()["servers"])
+        # Only the worker that made the change announces the new version to the cache nodes
+        self.ring.set_version(self.version, removed_nodes)
+
+    # Server related methods. Membership changes are serialized across workers with the shared lock
+    # and with the background sync within the worker with the sync lock
+
+    def add_servers(self, servers: List[str], release_timeout: float = 30) -> None:
+        deadline = time.monotonic() + release_timeout
+        while True:
+            with self.state.lock, self.sync_lock:
+                self.sync()
+                new_servers = [server for server in servers if server not in self.ring.servers]
+                releasing = [server for server in new_servers if server in self.state.get_releasing()]
+                if not releasing:
+                    # The new version is announced once, by _publish
+                    added = self.ring._start_servers(new_servers)
+                    if added:
+                        self.owned_servers.update(added)
+                        self._publish()
+                    return
+            # Starting a second cache node for a server before the old one is released would clash with it.
+            # Wait outside the locks, which the owner needs to release it.
+            if time.monotonic() > deadline:
+                raise Exception(f"Cache nodes of removed servers {releasing} were not released by the worker that started them")
+            time.sleep(0.05)
+
+    def add_server(self, server: str) -> None:
+        self.add_servers([server])
+
+    def remove_server(self, server: str) -> bool:
+        with self.state.lock, self.sync_lock:
+            self.sync()
+            if server not in self.ring.servers:
+                logger.warning("Attempted to remove non-existent server: %s from the hash ring", server)
+                return False
+            removed_node = self.ring._unregister_server(server)
+            if server in self.owned_servers:
+                self.owned_servers.discard(server)
+                self._publish([removed_node])
+                # Released with the shared lock held, so no worker can add the server again before it is gone
+                self.ring.node_helper.release_containers([removed_node])
+            else:
+                # The owning worker releases the cache node once it syncs
+                self.state.set_releasing(self.state.get_releasing() + [server])
+                self._publish([removed_node])
+            return True
+
+    def get_servers(self) -> List[dict]:
+        self.sync()
+        with self.sync_lock:
+            return self.ring.get_servers()
+
+    def get_topology(self) -> dict:
+        self.sync()
+        with self.sync_lock:
+            return self.ring.get_topology()
+
+    # Methods to interact with the cache nodes via consistent hashing
+
+    def get_server(self, key: str):
+        ''' Returns the cache node for the key, found the same way as ConsistentHashingRingContainer.get_server
+            but on the current copy of the routing tables '''
+        self.sync()
+        sorted_keys, virtual_node_map, ring = self.routes
+        if not sorted_keys:
+            return None
+        index = bisect.bisect(sorted_keys, self.ring._get_hash_key(key)) % len(sorted_keys)
+        return ring[virtual_node_map[sorted_keys[index]]]
+
+    def put_cache_entry(self, key: str, value: str) -> bool:
+        return self.ring._put_entry_on(self.get_server(key), key, value)
+
+    def get_cache_entry(self, key: str) -> Optional[str]:
+        return self.ring._get_entry_from(self.get_server(key), key)
+
+    def get_compression_stats(self) -> dict:
+        self.sync()
+        with self.sync_lock:
+            return self.ring.get_compression_stats()
@@ -12,6 +12,60 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 
 cache_node = None  # Initialized in the 'if __name__ == "__main__":' block
+ring_version = 0  # Latest ring topology version announced by the router
+
+def _check_owner():
+    ''' Smart clients send the ring version and instance number they routed with.
+        Returns an error response if this node is no longer the owner as far as the client knows '''
+    client_version = request.headers.get('X-Ring-Version')
+    instance_no = request.headers.get('X-Instance-No')
+    try:
+        client_version = int(client_version) if client_version is not None else None
+        instance_no = int(instance_no) if instance_no is not None else None
+    except ValueError:
+        return {"error": "X-Ring-Version and X-Instance-No must be integers", "ring_version": ring_version}, 400
+    if instance_no is not None and instance_no != cache_node.instance_no:
+        return {"error": "Not owner", "ring_version": ring_version}, 409
+    if client_version is not None and client_version < ring_version:
+        return {"error": "Stale ring version", "ring_version": ring_version}, 409
+    return None
+
+@app.after_request
+def add_ring_version(response):
+    # Lets smart clients notice a topology change on any response
+    response.headers['X-Ring-Version'] = str(ring_version)
+    return response
+
+@app.route('/health', methods=['GET'])
+def health():
+    ''' API used to check if the node is ready to serve requests '''
+    if cache_node is None:
+        return "CacheNode not initialized.", 503
+    return {"status": "ok", "instance_no": cache_node.instance_no}, 200
+
+@app.route('/reset_node', methods=['POST'])
+def reset_node():
+    ''' API to clear the cache and assign a new identity to the node. Used to recycle pre-started containers '''
+    global cache_node, ring_version
+    instance_no = request.json.get('instance_no')
+    cache_size = request.json.get('cache_size')
+    if instance_no is None or cache_size is None:
+        return "Instance number and Cache size must be provided.", 400
+    compression_threshold = request.json.get('compression_threshold', 1024)
+    logger.info("Resetting CacheNode to instance %d with cache size %d", int(instance_no), int(cache_size))
+    cache_node = CacheNode(instance_no=int(instance_no), cache_size=int(cache_size), compression_threshold=int(compression_threshold))
+    ring_version = 0
+    return f"CacheNode reset to instance {instance_no}.", 200
+
+@app.route('/ring_version', methods=['POST'])
+def set_ring_version():
+    ''' API used by the router to announce a new ring topology version '''
+    global ring_version
+    version = request.json.get('version')
+    if version is None:
+        return "Version must be provided.", 400
+    ring_version = max(ring_version, int(version))
+    return {"ring_version": ring_version}, 200
 
 @app.route('/get_cache_size', methods=['GET'])
 def get_cache_size():
@@ -31,7 +85,15 @@ def put_entry():
     value = request.json.get('value')
     if key is None or value is None:
         return "Key and Value must be provided.", 400
-    logger.info("CacheNode %d: Putting entry key=%s, value=%s", cache_node.instance_no, key, value)
+    not_owner = _check_owner()
+    if not_owner:
+        return not_owner
+    try:
+        # Values compressed by the client are kept compressed
+        value = cache_node.compressor.from_wire(value, verify=True)
+    except ValueError as e:
+        return {"error": str(e)}, 400
+    logger.info("CacheNode %d: Putting entry key=%s", cache_node.instance_no, key)
     cache_node.put_entry(key, value)
     return f"Entry for key {key} added/updated.", 200
    
@@ -41,21 +103,34 @@ def get_entry(key: str):
     ''' API to get an entry from the cache '''
     if cache_node is None:
         return "CacheNode not initialized.", 500
+    not_owner = _check_owner()
+    if not_owner:
+        return not_owner
     logger.info("CacheNode %d: Getting entry for key=%s", cache_node.instance_no, key)
     value = cache_node.get_entry(key)
     if value is not None:
-        return {"key": key, "value": value}, 200
+        # Compressed values are sent as is and decompressed by the client
+        return {"key": key, "value": cache_node.compressor.to_wire(value)}, 200
     else:
         return {"error": f"Key {key} not found in cache"}, 404
 
+@app.route('/compression_stats', methods=['GET'])
+def compression_stats():
+    ''' API to get the compression ratio and CPU cost for this cache node '''
+    if cache_node is None:
+        return "CacheNode not initialized.", 500
+    return cache_node.get_compression_stats(), 200
+
 
 if __name__ == '__main__':
     if len(sys.argv) >= 3:
         instance_no = int(sys.argv[1])
         cache_size = int(sys.argv[2])
-        logger.info("Starting CacheNode instance %d with cache size %d", instance_no, cache_size)
-        cache_node = CacheNode(instance_no=instance_no, cache_size=cache_size)
-        app.run(host='0.0.0.0', port=5000)
+        compression_threshold = int(sys.argv[3]) if len(sys.argv) >= 4 else 1024
+        port = int(sys.argv[4]) if len(sys.argv) >= 5 else 5000 # Local processes each need their own port
+        logger.info("Starting CacheNode instance %d with cache size %d and compression threshold %d", instance_no, cache_size, compression_threshold)
+        cache_node = CacheNode(instance_no=instance_no, cache_size=cache_size, compression_threshold=compression_threshold)
+        app.run(host='0.0.0.0', port=port)
     else:
-        logger.error("Insufficient arguments provided. Usage: python CacheAPIInvocation.py <instance_no> <cache_size>")
-        print("Usage: python CacheAPIInvocation.py <instance_no> <cache_size>")
+        logger.error("Insufficient arguments provided. Usage: python CacheAPIInvocation.py <instance_no> <cache_size> [compression_threshold] [port]")
+        print("Usage: python CacheAPIInvocation.py <instance_no> <cache_size> [compression_threshold] [port]")
@@ -3,13 +3,152 @@ This is an implementation of the LRU cache. This cache represents one node in th
 where data to be cached is stored
 """
 
-from typing import Optional
+from typing import Any, Optional
+import base64
+import binascii
+import json
 import logging
+import threading
+import time
+import zlib
 
 logging.basicConfig(filename='lru_cache.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
+# Compressed value held in memory. Only the zlib bytes are kept around,
+# the original value is rebuilt at the client edge.
+class CompressedValue:
+    __slots__ = ("data", "raw_size", "is_json")
+
+    def __init__(self, data: bytes, raw_size: int, is_json: bool = False):
+        self.data = data # zlib compressed bytes
+        self.raw_size = raw_size # Size of the uncompressed value in bytes
+        self.is_json = is_json # True if the original value was not a string and was serialized as JSON
+
+
+class ValueCompressor:
+    ''' Compresses values above a size threshold using zlib and keeps track of
+        the compression ratio and the CPU time spent compressing/decompressing '''
+    CODEC = "zlib"
+    ENVELOPE_KEY = "__compressed__" # Marks a compressed value when sent as JSON over the wire
+    ESCAPED = "escaped" # Envelope tag for a user dict that happens to contain ENVELOPE_KEY, sent as is in "value"
+
+    def __init__(self, threshold: int = 1024, level: int = 1):
+        self.threshold = threshold # Values smaller than this (in bytes) are stored as is
+        self.level = level # zlib level 1 favours speed over ratio
+        self._stats_lock = threading.Lock()
+        self.compressed_entries = 0
+        self.uncompressed_entries = 0
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+        self.compress_cpu_time = 0.0 # in seconds
+        self.decompress_cpu_time = 0.0 # in seconds
+
+    def compress(self, value: Any) -> Any:
+        ''' Returns a CompressedValue if the value is above the threshold and compresses well,
+            else returns the value unchanged '''
+        if isinstance(value, CompressedValue):
+            return value # Already compressed
+        is_json = not isinstance(value, str)
+        raw = (json.dumps(value) if is_json else value).encode()
+        if len(raw) < self.threshold:
+            self._record_uncompressed()
+            return value
+        start = time.thread_time()
+        data = zlib.compress(raw, self.level)
+        cpu_time = time.thread_time() - start
+        if len(data) >= len(raw):
+            # Not worth keeping a compressed copy that is larger than the original
+            self._record_uncompressed(cpu_time)
+            return value
+        self._record(len(raw), len(data), cpu_time)
+        return CompressedValue(data, len(raw), is_json)
+
+    def decompress(self, value: Any) -> Any:
+        ''' Returns the original value for a CompressedValue, else the value unchanged '''
+        if not isinstance(value, CompressedValue):
+            return value
+        start = time.thread_time()
+        raw = zlib.decompress(value.data).decode()
+        cpu_time = time.thread_time() - start
+        with self._stats_lock:
+            self.decompress_cpu_time += cpu_time
+        return json.loads(raw) if value.is_json else raw
+
+    def to_wire(self, value: Any) -> Any:
+        ''' Converts a stored value into something that can be sent as JSON '''
+        if not isinstance(value, CompressedValue):
+            if isinstance(value, dict) and self.ENVELOPE_KEY in value:
+                # Wrapped so the receiver does not mistake the user's dict for an envelope
+                return {self.ENVELOPE_KEY: self.ESCAPED, "value": value}
+            return value
+        return {
+            self.ENVELOPE_KEY: self.CODEC,
+            "data": base64.b64encode(value.data).decode("ascii"),
+            "raw_size": value.raw_size,
+            "json": value.is_json,
+        }
+
+    def from_wire(self, value: Any, verify: bool = False) -> Any:
+        ''' Converts a value received as JSON back into a CompressedValue if it was compressed.
+            Raises a ValueError for a malformed envelope. With verify the compressed data is also checked to
+            decompress to raw_size bytes, for values from clients that are stored without being decompressed '''
+        if isinstance(value, dict) and self.ENVELOPE_KEY in value:
+            if value[self.ENVELOPE_KEY] == self.CODEC:
+                raw_size = value.get("raw_size")
+                if not isinstance(raw_size, int) or isinstance(raw_size, bool) or raw_size < 0:
+                    raise ValueError(f"Invalid raw_size {raw_size!r} of compressed value")
+                try:
+                    data = base64.b64decode(value.get("data"), validate=True)
+                except (TypeError, binascii.Error) as e:
+                    raise ValueError(f"Invalid base64 data of compressed value - {e}")
+                if verify:
+                    self._verify(data, raw_size)
+                return CompressedValue(data, raw_size, bool(value.get("json")))
+            if value[self.ENVELOPE_KEY] == self.ESCAPED and "value" in value:
+                return value["value"]
+            raise ValueError(f"Invalid {self.ENVELOPE_KEY} envelope {value[self.ENVELOPE_KEY]!r}")
+        return value
+
+    def _verify(self, data: bytes, raw_size: int) -> None:
+        # Decompresses at most one byte more than raw_size, so a value claiming to be small cannot make us inflate a lot
+        decompressor = zlib.decompressobj()
+        try:
+            raw = decompressor.decompress(data, raw_size + 1)
+        except zlib.error as e:
+            raise ValueError(f"Invalid zlib data of compressed value - {e}")
+        if len(raw) != raw_size or not decompressor.eof:
+            raise ValueError(f"Compressed value does not decompress to its raw_size of {raw_size} bytes")
+
+    def get_stats(self) -> dict:
+        ''' Returns the compression metrics '''
+        with self._stats_lock:
+            return {
+                "codec": self.CODEC,
+                "threshold": self.threshold,
+                "compressed_entries": self.compressed_entries,
+                "uncompressed_entries": self.uncompressed_entries,
+                "raw_bytes": self.raw_bytes,
+                "compressed_bytes": self.compressed_bytes,
+                "compression_ratio": round(self.raw_bytes / self.compressed_bytes, 3) if self.compressed_bytes else None,
+                "compress_cpu_ms": round(self.compress_cpu_time * 1000, 3),
+                "decompress_cpu_ms": round(self.decompress_cpu_time * 1000, 3),
+            }
+
+    def _record(self, raw_size: int, compressed_size: int, cpu_time: float):
+        with self._stats_lock:
+            self.compressed_entries += 1
+            self.raw_bytes += raw_size
+            self.compressed_bytes += compressed_size
+            self.compress_cpu_time += cpu_time
+
+    def _record_uncompressed(self, cpu_time: float = 0.0):
+        with self._stats_lock:
+            self.uncompressed_entries += 1
+            self.compress_cpu_time += cpu_time
+
+
 # Doubly Linked List Node
 class DLL_Node:
     def __init__(self, key: str, value: str):
@@ -19,9 +158,16 @@ class DLL_Node:
     
 
 class CacheNode:
-    def __init__(self, instance_no: int, cache_size: int):
+    def __init__(self, instance_no: int, cache_size: int, compression_threshold: int = 1024):
         self.instance_no = instance_no # ID for the node
         self.cache_size = cache_size  # in bytes
+        # Values are compressed only at the client edge. The node keeps them compressed in memory and only
+        # converts them to and from the wire format, so its compressor does no compression work.
+        self.compressor = ValueCompressor(threshold=compression_threshold)
+        # Compressed values currently held, and their raw and compressed sizes in bytes
+        self.stored_compressed_entries = 0
+        self.stored_raw_bytes = 0
+        self.stored_compressed_bytes = 0
 
         # We maintain two data structures to implement LRU Cache
         # The hash map stores the key to node mapping and allows for key searches in O(1) time
@@ -46,7 +192,9 @@ class CacheNode:
         if key in self.hash_map:
             node = self.hash_map[key]
             self._remove_node(node) # Remove the node from its current position
+            self._account(node.value, -1)
         self._add_node(key, value) # Add the node to the tail
+        self._account(value, 1)
         # If addition of the new node exceeded cache size, 
         # remove the least recently used node from the head
         if len(self.hash_map) > self.cache_size:
@@ -54,9 +202,10 @@ class CacheNode:
             # Remove the least recently used node
             node = self.head.next
             self._remove_node(node)
+            self._account(node.value, -1)
             del self.hash_map[node.key]
     
-    # Get entry from the cache
+    # Get entry from the cache. Large values are returned as a CompressedValue
     def get_entry(self, key: str):
         logger.debug("CacheNode %d: Getting key: %s", self.instance_no, key)
         if not key in self.hash_map:
@@ -89,6 +238,24 @@ class CacheNode:
         ''' Returns all key-value pairs in the cache node for testing purposes '''
         ''' This method is not to be used in production as it exposes internal state '''
         return {key: node.value for key, node in self.hash_map.items()}
+
+    def _account(self, value, sign: int):
+        # Track the compressed values held by the node as they are added and removed
+        if isinstance(value, CompressedValue):
+            self.stored_compressed_entries += sign
+            self.stored_raw_bytes += sign * value.raw_size
+            self.stored_compressed_bytes += sign * len(value.data)
+
+    def get_compression_stats(self) -> dict:
+        ''' Returns how many of the values held by this node are compressed and the memory they save.
+            Compression work is only counted at the client edge. '''
+        return {
+            "entries": len(self.hash_map),
+            "compressed_entries": self.stored_compressed_entries,
+            "raw_bytes": self.stored_raw_bytes,
+            "compressed_bytes": self.stored_compressed_bytes,
+            "compression_ratio": round(self.stored_raw_bytes / self.stored_compressed_bytes, 3) if self.stored_compressed_bytes else None,
+        }
         
 
 # ----- Testing ----- 
@@ -105,4 +272,16 @@ if __name__ == "__main__":
     assert(cache_node.get_entry("key4") == "value4")  # Should print value4
     print(cache_node._get_all_kv_pairs())  # Should print all key-value pairs in the cache node
 
-
+    # Large repetitive values are compressed by the client, stored compressed and restored by the client
+    client_compressor = ValueCompressor()
+    large_value = '{"seat": "A1", "state": "available"}' * 100
+    cache_node.put_entry("large_key", client_compressor.compress(large_value))
+    stored_value = cache_node.get_entry("large_key")
+    assert(isinstance(stored_value, CompressedValue))
+    assert(client_compressor.decompress(stored_value) == large_value)
+    wire_value = cache_node.compressor.to_wire(stored_value)
+    assert(client_compressor.decompress(cache_node.compressor.from_wire(wire_value)) == large_value)
+    # A user dict that looks like an envelope round trips unchanged
+    lookalike = {ValueCompressor.ENVELOPE_KEY: ValueCompressor.CODEC, "data": "not base64"}
+    assert(cache_node.compressor.from_wire(cache_node.compressor.to_wire(lookalike)) == lookalike)
+    print(cache_node.get_compression_stats())
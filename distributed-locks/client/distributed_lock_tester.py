@@ -62,6 +62,74 @@ def test_distributed_locks():
     print("Client 1 Acquire Lock After Expiry Response:", response.json())
 
 
+def test_batch_locks():
+    # Client 1 acquires the locks for all seats in one order in a single call
+    seats = ["seat_lock_A1", "seat_lock_A2", "seat_lock_A3"]
+    response = requests.post(f"{base_lock_url}/acquire_locks", json={"keys": seats, "client_id": "client_1", "expiry": 10})
+    print("Client 1 Acquire Locks Response:", response.json())
+
+    # Client 2 wants an overlapping set of seats. None of them are acquired.
+    response = requests.post(f"{base_lock_url}/acquire_locks", json={"keys": ["seat_lock_A3", "seat_lock_A4"], "client_id": "client_2", "expiry": 10})
+    print("Client 2 Acquire Overlapping Locks Response:", response.json())
+    response = requests.get(f"{base_lock_url}/lock_status/seat_lock_A4")
+    print("Lock Status for seat_lock_A4 (should not be found):", response.json())
+
+    # Client 1 renews and then releases all its locks in one call each
+    response = requests.post(f"{base_lock_url}/renew_locks", json={"keys": seats, "client_id": "client_1"})
+    print("Client 1 Renew Locks Response:", response.json())
+    response = requests.post(f"{base_lock_url}/release_locks", json={"keys": seats, "client_id": "client_1"})
+    print("Client 1 Release Locks Response:", response.json())
+
+    # Now Client 2 gets all its seats
+    response = requests.post(f"{base_lock_url}/acquire_locks", json={"keys": ["seat_lock_A3", "seat_lock_A4"], "client_id": "client_2", "expiry": 10})
+    print("Client 2 Acquire Locks After Release Response:", response.json())
+
+
+def test_blocking_locks():
+    # Client 1 acquires a lock and Client 2 waits up to 15 seconds for it instead of polling
+    client_1_data = {"key": "resource_lock", "client_id": "client_1", "expiry": 5}
+    response = requests.post(f"{base_lock_url}/acquire_lock", json=client_1_data)
+    print("Client 1 Acquire Lock Response:", response.json())
+
+    # The request returns as soon as the lock expires and is handed to Client 2, after about 5 seconds
+    start = time.time()
+    client_2_data = {"key": "resource_lock", "client_id": "client_2", "expiry": 10, "wait_timeout": 15}
+    response = requests.post(f"{base_lock_url}/acquire_lock", json=client_2_data)
+    print(f"Client 2 Blocking Acquire Lock Response after {time.time() - start:.2f}s:", response.json())
+
+    # Client 1 gives up after waiting 1 second since Client 2 now holds the lock
+    client_1_data["wait_timeout"] = 1
+    response = requests.post(f"{base_lock_url}/acquire_lock", json=client_1_data)
+    print("Client 1 Blocking Acquire Lock Timeout Response:", response.json())
+
+    response = requests.get(f"{base_lock_url}/wait_stats/resource_lock")
+    print("Wait Stats for resource_lock:", response.json())
+    requests.post(f"{base_lock_url}/release_lock", json={"key": "resource_lock", "client_id": "client_2"})
+
+
+def test_session_locks():
+    # Client 1 holds several locks under one session and keeps them all alive with a single heartbeat
+    response = requests.post(f"{base_lock_url}/create_session", json={"client_id": "client_1", "ttl": 5})
+    print("Client 1 Create Session Response:", response.json())
+    session_id = response.json()["session_id"]
+    for seat in ["seat_lock_B1", "seat_lock_B2", "seat_lock_B3"]:
+        response = requests.post(f"{base_lock_url}/acquire_lock", json={"key": seat, "client_id": "client_1", "session_id": session_id})
+        print(f"Client 1 Acquire {seat} Response:", response.json())
+
+    for _ in range(3):
+        time.sleep(3)
+        response = requests.post(f"{base_lock_url}/heartbeat", json={"session_id": session_id, "client_id": "client_1"})
+        print("Client 1 Heartbeat Response:", response.json())
+    response = requests.get(f"{base_lock_url}/lock_status/seat_lock_B1")
+    print("Lock Status for seat_lock_B1 after 9 seconds (should be locked):", response.json())
+
+    # Client 1 stops sending heartbeats. Once the session expires all its locks are released together.
+    print("Sleeping for 6 seconds to let the session expire...")
+    time.sleep(6)
+    response = requests.post(f"{base_lock_url}/acquire_lock", json={"key": "seat_lock_B2", "client_id": "client_2", "expiry": 10})
+    print("Client 2 Acquire Lock After Session Expiry Response:", response.json())
+
+
 def test_ephemeral_nodes():
     # Test ephemeral node behavior
     response = requests.post(f"{base_ephemeral_url}/create_node", json={
@@ -81,18 +149,71 @@ def test_ephemeral_nodes():
         "expiry": 5
     })
     print("Ephemeral Node 2 Acquire Lock Response:", response.json())
+    node_path = response.json()["node_path"]
     response = requests.get(f"{base_ephemeral_url}/current_lock_owner", params={"path": "/locks/ticket1"})
     print("Current Lock Owner Response:", response.json())
 
+    # Client 2 waits for client 1's node to expire. The service answers as soon as client 2's node owns the lock.
+    start = time.time()
+    response = requests.post(f"{base_ephemeral_url}/wait_for_lock", json={"path": node_path, "timeout": 30})
+    print(f"Client 2 Wait For Lock Response after {time.time() - start:.1f}s:", response.json())
 
-    # Wait for lock to expire
-    time.sleep(15)
+    # Watch client 2's node until it expires too
+    response = requests.post(f"{base_ephemeral_url}/watch_node", json={"path": node_path, "timeout": 30})
+    print("Watch Response for Client 2's Node:", response.json())
     response = requests.get(f"{base_ephemeral_url}/current_lock_owner", params={"path": "/locks/ticket1"})
     print("Current Lock Owner After Expiry:", response.json())
 
-    time.sleep(15)
-    response = requests.get(f"{base_ephemeral_url}/current_lock_owner", params={"path": "/locks/ticket1"})
-    print("Current Lock Owner After Further Expiry:", response.json())
+def test_ephemeral_sessions():
+    # Client 1 holds locks on several tickets with nodes owned by one session, kept alive by a single heartbeat
+    response = requests.post(f"{base_ephemeral_url}/create_session", json={"client_id": "client1", "ttl": 5})
+    print("Ephemeral Create Session Response:", response.json())
+    session_id = response.json()["session_id"]
+    for ticket in ("ticket2", "ticket3"):
+        response = requests.post(f"{base_ephemeral_url}/create_node", json={"path": f"/locks/{ticket}", "client_id": "client1", "session_id": session_id})
+        print(f"Client 1 Create Node for {ticket} Response:", response.json())
+    response = requests.post(f"{base_ephemeral_url}/create_node", json={"path": "/locks/ticket2", "client_id": "client2", "expiry": 5})
+    print("Client 2 Create Node for ticket2 Response:", response.json())
+    node_path = response.json()["node_path"]
+    for i in range(2):
+        time.sleep(3)
+        response = requests.post(f"{base_ephemeral_url}/heartbeat", json={"session_id": session_id, "client_id": "client1"})
+        print("Client 1 Heartbeat Response:", response.json())
+
+    # Client 1 stops sending heartbeats, as if it crashed. Once the session expires all its nodes are deleted
+    # together and Client 2 is handed the lock on ticket2.
+    start = time.time()
+    response = requests.post(f"{base_ephemeral_url}/wait_for_lock", json={"path": node_path, "timeout": 30})
+    print(f"Client 2 Wait For Lock Response after {time.time() - start:.1f}s:", response.json())
+    response = requests.get(f"{base_ephemeral_url}/current_lock_owner", params={"path": "/locks/ticket3"})
+    print("Current Lock Owner for ticket3 After Session Expiry:", response.json())
+
+def test_ephemeral_multi():
+    # Creating a node returns whether it owns the lock and the node before it, so one call is enough to try for a lock
+    response = requests.post(f"{base_ephemeral_url}/create_node", json={"path": "/locks/ticket4", "client_id": "client1", "expiry": 30})
+    print("Client 1 Create Node Response (owner):", response.json())
+    client_1_node = response.json()["node_path"]
+    response = requests.post(f"{base_ephemeral_url}/create_node", json={"path": "/locks/ticket4", "client_id": "client2", "expiry": 30})
+    print("Client 2 Create Node Response (queued behind client 1):", response.json())
+    client_2_node = response.json()["node_path"]
+
+    # Client 1 hands ticket4 over and takes ticket5 in one transaction, as long as nobody queued on ticket5 meanwhile
+    response = requests.post(f"{base_ephemeral_url}/multi", json={"ops": [{"op": "get_children", "path": "/locks/ticket5"}]})
+    print("Get Children of ticket5 Response:", response.json())
+    ops = [
+        {"op": "delete", "path": client_1_node},
+        {"op": "create", "path": "/locks/ticket5", "client_id": "client1", "expiry": 30},
+        {"op": "get_children", "path": "/locks/ticket4"},
+    ]
+    response = requests.post(f"{base_ephemeral_url}/multi", json={"ops": ops})
+    print("Client 1 Multi Response:", response.json())
+
+    # A transaction with a failed check changes nothing
+    ops = [{"op": "delete", "path": client_2_node}, {"op": "check", "path": "/locks/ticket5", "version": 99}]
+    response = requests.post(f"{base_ephemeral_url}/multi", json={"ops": ops})
+    print("Multi Response with Failed Check (HTTP 409):", response.json())
+    response = requests.get(f"{base_ephemeral_url}/current_lock_owner", params={"path": "/locks/ticket4"})
+    print("Current Lock Owner for ticket4 (still client2):", response.json())
 
 def test_ticket_reservation():
     try:
@@ -143,8 +264,23 @@ if __name__ == "__main__":
     # Tests for Ephemeral Nodes Service
     #test_ephemeral_nodes()
 
+    # Tests for ephemeral nodes owned by a session kept alive by heartbeats
+    # test_ephemeral_sessions()
+
+    # Tests for lock status on node creation and atomic multi-op transactions on the Ephemeral Nodes Service
+    # test_ephemeral_multi()
+
     # Tests for Distributed Lock Service: Mutually exclusive with Ephemeral Nodes
     # test_distributed_locks()
 
+    # Tests for multi-key acquire, renew and release on the Distributed Lock Service
+    # test_batch_locks()
+
+    # Tests for blocking acquire with a wait timeout on the Distributed Lock Service
+    # test_blocking_locks()
+
+    # Tests for locks held under a session kept alive by heartbeats
+    # test_session_locks()
+
     # Tests for Ticket Reservation and Booking Service
     test_ticket_reservation()
@@ -0,0 +1,279 @@
+"""
+Benchmarks for the ephemeral node service internals.
+These run against the ephemeral node classes directly (no Flask server needed).
+"""
+import gc, logging, os, shutil, sys, tempfile, threading, time, tracemalloc
+
+# The ephemeral node service modules live in the ephemeral_nodes directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "ephemeral_nodes"))
+
+from ephemeral_node_manager import EphemeralNodeManager
+from node_wal import TransactionLog
+
+# The ephemeral node service logs every operation at DEBUG level. Silence it so we measure the data structures.
+logging.disable(logging.CRITICAL)
+
+
+def per_op(func, count):
+    # Average microseconds per call
+    start = time.perf_counter()
+    for i in range(count):
+        func(i)
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def benchmark_children_index(total_nodes=100_000, nodes_per_lock=10, ops=10_000):
+    # Per-operation latency of the lock operations with a large tree: nodes_per_lock clients queued on each lock.
+    node_manager = EphemeralNodeManager()
+    num_locks = total_nodes // nodes_per_lock
+    start = time.perf_counter()
+    for i in range(total_nodes):
+        node_manager.create_node(f"/locks/ticket_lock_{i % num_locks}", f"client_{i}", 3600)
+    print(f"Created {total_nodes} nodes under {num_locks} locks in {time.perf_counter() - start:.2f}s")
+
+    # The old lookup scanned every node and split its path to find the children of one parent
+    def scan_owner(i):
+        parent_path = f"/locks/ticket_lock_{i % num_locks}"
+        children = [node for path, node in node_manager.nodes.items() if path.rsplit('/', 1)[0] == parent_path]
+        return min(children, key=lambda n: n.seq_num).client_id
+    print(f"Owner lookup with a full scan: {per_op(scan_owner, 20):,.1f} us/op")
+
+    print(f"Owner lookup: {per_op(lambda i: node_manager.get_current_lock_owner(f'/locks/ticket_lock_{i % num_locks}'), ops):,.2f} us/op")
+    print(f"Create node: {per_op(lambda i: node_manager.create_node(f'/locks/ticket_lock_{i % num_locks}', f'new_client_{i}', 3600), ops):,.2f} us/op")
+    print(f"Delete owner node and promote the next: {per_op(lambda i: node_manager.delete_node(f'/locks/ticket_lock_{i % num_locks}/{i // num_locks}'), ops):,.2f} us/op")
+    waiter = nodes_per_lock - 1
+    print(f"Delete waiting node: {per_op(lambda i: node_manager.delete_node(f'/locks/ticket_lock_{i % num_locks}/{waiter}'), min(ops, num_locks)):,.2f} us/op")
+
+
+def benchmark_memory(total_nodes=100_000, nodes_per_lock=10, lookups=100_000):
+    # Memory used per node, including the client IDs and expiry index, and the time of a full garbage collection,
+    # which has to visit every node.
+    num_locks = total_nodes // nodes_per_lock
+    tracemalloc.start()
+    node_manager = EphemeralNodeManager()
+    for i in range(total_nodes):
+        node_manager.create_node(f"/locks/ticket_lock_{i % num_locks}", f"client_{i}", 3600)
+    used, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Memory for {total_nodes} nodes: {used / total_nodes:.0f} bytes/node")
+    start = time.perf_counter()
+    gc.collect()
+    print(f"Full garbage collection: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    # Paths arrive in requests as new strings, so build each one as the API would
+    def lookup(i):
+        node_manager.get_node("".join(["/locks/ticket_lock_", str(i % num_locks), "/", str(i % nodes_per_lock)]))
+    print(f"Node lookup by path: {per_op(lookup, lookups):,.2f} us/op")
+    children = per_op(lambda i: [child.path for child in node_manager.nodes.get_parent(f"/locks/ticket_lock_{i % num_locks}").iter_children()], lookups)
+    print(f"List the children of a lock: {children:,.2f} us/op")
+
+
+def benchmark_expiry(total_nodes=100_000, nodes_per_lock=10, expiring=1_000):
+    # Cost of a cleanup pass with a large tree when only a few lock owners have expired. Each expiring lock has
+    # a single node, so its parent is deleted too.
+    node_manager = EphemeralNodeManager()
+    num_locks = total_nodes // nodes_per_lock
+    for i in range(total_nodes):
+        node_manager.create_node(f"/locks/ticket_lock_{i % num_locks}", f"client_{i}", 3600)
+    for i in range(expiring):
+        node_manager.create_node(f"/locks/short_lock_{i}", f"short_client_{i}", 0.01)
+    time.sleep(0.02)
+    now = time.monotonic()
+
+    # The old sweep checked the age of every node, then scanned every node again for empty parents
+    start = time.perf_counter()
+    [node for node in node_manager.nodes.values() if node.is_expired(now)]
+    [node for node in node_manager.nodes.values() if node.is_parent_node() and not node.has_children()]
+    print(f"Full sweep over {len(node_manager.nodes)} nodes: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    start = time.perf_counter()
+    expired = node_manager.cleanup_expired_nodes(now)
+    print(f"Cleanup of {len(expired)} expired nodes and their parents: {(time.perf_counter() - start) * 1000:.2f} ms")
+    start = time.perf_counter()
+    node_manager.cleanup_expired_nodes(now)
+    print(f"Cleanup with nothing expired: {(time.perf_counter() - start) * 1e6:.1f} us")
+
+
+def benchmark_lock_handoff(waiters=100, poll_interval=0.01):
+    # A chain of clients queued on one lock, each releasing it as soon as it owns it. Compares clients that poll the
+    # lock owner every poll_interval seconds with clients that wait on a watch on the node before their own.
+    def run(wait):
+        node_manager = EphemeralNodeManager()
+        owner_path = node_manager.create_node("/locks/handoff", "owner", 3600)
+        paths = [node_manager.create_node("/locks/handoff", f"client_{i}", 3600) for i in range(waiters)]
+        polls = []
+        threads = [threading.Thread(target=wait, args=(node_manager, i, path, polls)) for i, path in enumerate(paths)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2) # Let every client start waiting
+        start = time.perf_counter()
+        node_manager.delete_node(owner_path)
+        for thread in threads:
+            thread.join()
+        return (time.perf_counter() - start) / waiters * 1000, len(polls)
+
+    def poll(node_manager, i, path, polls):
+        while True:
+            polls.append(1)
+            if node_manager.get_current_lock_owner("/locks/handoff") == f"client_{i}":
+                node_manager.delete_node(path)
+                return
+            time.sleep(poll_interval)
+
+    def watch(node_manager, i, path, polls):
+        if node_manager.wait_for_ownership(path, 60):
+            node_manager.delete_node(path)
+
+    latency, polls = run(poll)
+    print(f"Polling every {poll_interval * 1000:.0f} ms: {latency:.2f} ms per handoff, {polls:,} owner queries for {waiters} handoffs")
+    latency, _ = run(watch)
+    print(f"Watching the predecessor: {latency:.2f} ms per handoff, one wakeup per handoff")
+
+
+def benchmark_session_expiry(locks=100_000, ops=10_000):
+    # A client holds many locks through one session, with another client queued on each lock.
+    # One heartbeat keeps all of them alive, and when the client stops sending heartbeats they are all
+    # deleted in one batch and every lock is handed to the next client.
+    node_manager = EphemeralNodeManager()
+    session = node_manager.create_session("crashed_client", 3600)
+    for i in range(locks):
+        node_manager.create_node(f"/locks/ticket_lock_{i}", "crashed_client", None, session.session_id)
+        node_manager.create_node(f"/locks/ticket_lock_{i}", f"client_{i}", 3600)
+    print(f"Heartbeat for a session owning {locks} nodes: {per_op(lambda i: node_manager.heartbeat(session.session_id), ops):,.2f} us/op")
+    start = time.perf_counter()
+    deleted = node_manager.cleanup_expired_sessions(session.deadline + 1)
+    elapsed = time.perf_counter() - start
+    promoted = sum(node_manager.get_current_lock_owner(f"/locks/ticket_lock_{i}") == f"client_{i}" for i in range(locks))
+    print(f"Session expiry deleted {len(deleted[session.session_id])} nodes and handed {promoted} locks over in {elapsed * 1000:.1f} ms")
+
+
+def benchmark_recovery(total_nodes=1_000_000, nodes_per_lock=10):
+    # Time to recover a large tree from the transaction log alone and from a snapshot, and to take the snapshot.
+    # While the snapshot is taken another thread keeps creating nodes, to show how long writes are held up.
+    num_locks = total_nodes // nodes_per_lock
+    directory = tempfile.mkdtemp(prefix="node_wal_")
+    try:
+        node_manager = EphemeralNodeManager(wal=TransactionLog(directory, fsync_policy="none"))
+        start = time.perf_counter()
+        for i in range(total_nodes):
+            node_manager.create_node(f"/locks/ticket_lock_{i % num_locks}", f"client_{i}", 3600)
+        node_manager.wal.close()
+        print(f"Logged {total_nodes} node creations in {time.perf_counter() - start:.2f}s")
+
+        for source in ("transaction log", "snapshot"):
+            # Free the previous tree first, so recovery does not share memory and garbage collection with it
+            node_manager = None
+            node_manager = EphemeralNodeManager(wal=TransactionLog(directory, fsync_policy="none"))
+            start = time.perf_counter()
+            restored = node_manager.recover(compact=False)
+            print(f"Recovered {restored} nodes from the {source} in {time.perf_counter() - start:.2f}s")
+            assert restored == total_nodes
+            # The recovered parent keeps its last sequence number and new nodes continue after the largest one
+            assert node_manager.nodes.get_parent("/locks/ticket_lock_0").seq_num == (nodes_per_lock - 1) * num_locks
+            assert next(node_manager.seq_nums) >= total_nodes
+            if source == "transaction log":
+                # The next recovery starts from a snapshot
+                latencies, paths, stop = [], [], threading.Event()
+
+                def write():
+                    i = 0
+                    while not stop.is_set():
+                        op_start = time.perf_counter()
+                        paths.append(node_manager.create_node(f"/locks/snapshot_lock_{i}", "client", 3600))
+                        latencies.append(time.perf_counter() - op_start)
+                        i += 1
+                writer = threading.Thread(target=write)
+                writer.start()
+                start = time.perf_counter()
+                node_manager.take_snapshot()
+                elapsed = time.perf_counter() - start
+                stop.set()
+                writer.join()
+                print(f"Snapshot of {total_nodes} nodes written in {elapsed:.2f}s "
+                      f"({os.path.getsize(os.path.join(directory, 'snapshot.json')) / total_nodes:.0f} bytes per node), "
+                      f"{len(latencies)} nodes created meanwhile, slowest create {max(latencies) * 1000:.1f} ms")
+                for path in paths:
+                    node_manager.delete_node(path)
+                node_manager.take_snapshot()
+            node_manager.wal.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_transaction_log(num_threads=16, ops_per_thread=500):
+    # Create/delete throughput with the transaction log under each fsync policy.
+    # With the always policy concurrent requests share an fsync, reported as the average batch size.
+    for fsync_policy in ("always", "interval", "none"):
+        directory = tempfile.mkdtemp(prefix="node_wal_")
+        node_manager = EphemeralNodeManager(wal=TransactionLog(directory, fsync_policy=fsync_policy))
+
+        def worker(thread_no):
+            client_id = f"client_{thread_no}"
+            for i in range(ops_per_thread):
+                node_manager.delete_node(node_manager.create_node(f"/locks/lock_{thread_no}_{i}", client_id, 60))
+
+        threads = [threading.Thread(target=worker, args=(thread_no,)) for thread_no in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        node_manager.wal.close()
+        stats = node_manager.wal.stats
+        print(f"fsync {fsync_policy}: {2 * ops_per_thread * num_threads / elapsed:,.0f} ops/sec with {num_threads} threads, "
+              f"{stats['fsyncs']} fsyncs, {stats['records'] / max(stats['batches'], 1):.1f} records per batch")
+        shutil.rmtree(directory)
+
+
+def benchmark_acquire_round_trips(ops=2_000):
+    # Trying for a lock through the API: creating a node and then asking for the lock owner, against one
+    # /create_node call that returns the owner. Uses Flask's test client, so this is the server side cost of the
+    # calls and does not include the network round trip saved by the single call. The transaction log is turned off,
+    # it is measured by benchmark_transaction_log.
+    os.environ["NODE_DATA_DIR"] = ""
+    from ephemeral_node_api import app
+    client = app.test_client()
+
+    def create_then_check(i):
+        client.post("/create_node", json={"path": f"/locks/two_calls_{i}", "client_id": "client", "expiry": 3600})
+        client.get("/current_lock_owner", query_string={"path": f"/locks/two_calls_{i}"})
+
+    def create(i):
+        client.post("/create_node", json={"path": f"/locks/one_call_{i}", "client_id": "client", "expiry": 3600}).get_json()["is_owner"]
+
+    def multi(i):
+        client.post("/multi", json={"ops": [{"op": "create", "path": f"/locks/multi_{i}", "client_id": "client", "expiry": 3600},
+                                            {"op": "get_children", "path": f"/locks/multi_{i}"}]})
+
+    print(f"Create node then get the lock owner: {per_op(create_then_check, ops):,.1f} us/op")
+    print(f"Create node returning the lock owner: {per_op(create, ops):,.1f} us/op")
+    print(f"Multi with create and get_children: {per_op(multi, ops):,.1f} us/op")
+
+
+if __name__ == "__main__":
+    total_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+
+    # Lock operations stay fast as the tree grows
+    for nodes in (total_nodes // 10, total_nodes, total_nodes * 10):
+        benchmark_children_index(nodes)
+
+    # Bytes per node and garbage collection time of a large tree
+    benchmark_memory(total_nodes * 10)
+
+    # Cleanup cost depends on the number of expired nodes, not on the size of the tree
+    for nodes in (total_nodes // 10, total_nodes, total_nodes * 10):
+        benchmark_expiry(nodes)
+
+    # Waiting clients are woken one at a time instead of polling
+    benchmark_lock_handoff()
+
+    # One heartbeat keeps a session's nodes alive and its expiry releases them all at once
+    benchmark_session_expiry(total_nodes)
+
+    # One API call to try for a lock instead of two
+    benchmark_acquire_round_trips()
+
+    # Restart recovery time and the cost of persisting nodes
+    benchmark_recovery(total_nodes * 10)
+    benchmark_transaction_log()
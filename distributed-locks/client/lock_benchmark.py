@@ -0,0 +1,384 @@
+"""
+Benchmarks for the distributed lock service internals.
+These run against the lock classes directly (no Flask server needed).
+"""
+import json, logging, os, random, shutil, sys, tempfile, threading, time, tracemalloc
+
+# The lock service modules live in the distributed_locks directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_locks"))
+
+from lock_object_manager import LockObjectManager
+from lock_exceptions import LockAlreadyHeldException
+from lock_wal import WriteAheadLog
+
+# The lock service logs every operation at DEBUG level. Silence it so we measure the data structures.
+logging.disable(logging.CRITICAL)
+
+
+def benchmark_expiry_sweep(total_locks=1_000_000, expired_fraction=0.01):
+    # Populate the lock manager with a large number of locks, a small fraction of which expire soon.
+    lock_manager = LockObjectManager()
+    start = time.perf_counter()
+    for i in range(total_locks):
+        expiry = 1 if random.random() < expired_fraction else 3600
+        lock_manager.acquire_lock(f"lock_{i}", f"client_{i}", expiry)
+    print(f"Acquired {total_locks} locks in {time.perf_counter() - start:.2f}s")
+
+    # Old approach: copy every lock and check its status.
+    start = time.perf_counter()
+    expired = [key for key, lock in list(lock_manager.get_locks().items()) if lock.get_status() == "expired"]
+    print(f"Full scan sweep over {total_locks} locks: {(time.perf_counter() - start) * 1000:.1f} ms ({len(expired)} expired)")
+
+    # Expiry index: sweep the way the cleaner does every 5 seconds, simulating the clock moving forward
+    # so we can measure how long after its deadline each lock gets removed.
+    now = time.monotonic()
+    sweep_times, lags, removed = [], [], 0
+    for sweep in range(1, 4):
+        sweep_now = now + sweep
+        start = time.perf_counter()
+        expired_locks = lock_manager.pop_expired_locks(now=sweep_now)
+        sweep_times.append((time.perf_counter() - start) * 1000)
+        lags.extend(sweep_now - lock.get_deadline() for lock in expired_locks)
+        removed += len(expired_locks)
+    print(f"Expiry index sweeps: {', '.join(f'{t:.1f} ms' for t in sweep_times)} ({removed} expired)")
+    if lags:
+        print(f"Expiry lag with 1s sweeps: avg {sum(lags) / len(lags):.3f}s, max {max(lags):.3f}s")
+
+    # Renewals leave stale heap entries behind. Make sure sweeps stay cheap with a lot of renewals.
+    for i in range(0, total_locks, 10):
+        if lock_manager.get_lock(f"lock_{i}"):
+            lock_manager.acquire_lock(f"lock_{i}", f"client_{i}", 3600)
+    start = time.perf_counter()
+    lock_manager.pop_expired_locks()
+    print(f"Sweep after {total_locks // 10} renewals: {(time.perf_counter() - start) * 1000:.1f} ms (heap size {sum(len(shard.expiry_heap) for shard in lock_manager.shards)})")
+
+
+def benchmark_lock_records(total_locks=1_000_000):
+    # Memory per lock: lock records, the lock table and the expiry index.
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    lock_manager = LockObjectManager()
+    keys = [f"lock_{i}" for i in range(total_locks)]
+    keys_memory = tracemalloc.get_traced_memory()[0] - baseline
+    start = time.perf_counter()
+    for key in keys:
+        lock_manager.acquire_lock(key, "client_1", 3600)
+    acquire_time = time.perf_counter() - start
+    used = tracemalloc.get_traced_memory()[0] - baseline - keys_memory
+    tracemalloc.stop()
+    print(f"Memory for {total_locks} locks: {used / total_locks:.0f} bytes per lock (excluding the key strings)")
+
+    # Throughput of the common operations.
+    print(f"New acquire (slowed down by tracemalloc): {total_locks / acquire_time:,.0f} ops/sec")
+    start = time.perf_counter()
+    for key in keys:
+        lock_manager.acquire_lock(key, "client_1", 3600)
+    print(f"Renew: {total_locks / (time.perf_counter() - start):,.0f} ops/sec")
+    start = time.perf_counter()
+    for key in keys:
+        lock_manager.get_lock(key).get_status()
+    print(f"Status check: {total_locks / (time.perf_counter() - start):,.0f} ops/sec")
+    start = time.perf_counter()
+    for key in keys:
+        lock_manager.delete_lock(key, "client_1")
+    print(f"Release: {total_locks / (time.perf_counter() - start):,.0f} ops/sec")
+
+
+def stress_test_mutual_exclusion(num_threads=16, num_keys=8, iterations=20_000):
+    # Many threads race for a few keys. Whoever acquires a key checks nobody else is inside the
+    # critical section for that key before releasing it. Fails if two clients ever hold the same lock.
+    lock_manager = LockObjectManager()
+    holders = {f"key_{i}": None for i in range(num_keys)}
+    violations, acquired = [], [0] * num_threads
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6) # Switch threads as often as possible to provoke races
+
+    def worker(thread_no):
+        client_id = f"client_{thread_no}"
+        for i in range(iterations):
+            key = f"key_{random.randrange(num_keys)}"
+            try:
+                lock_manager.acquire_lock(key, client_id, 60)
+            except LockAlreadyHeldException:
+                continue
+            if holders[key] is not None:
+                violations.append((key, holders[key], client_id))
+            holders[key] = client_id
+            acquired[thread_no] += 1
+            holders[key] = None
+            lock_manager.delete_lock(key, client_id)
+
+    threads = [threading.Thread(target=worker, args=(thread_no,)) for thread_no in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sys.setswitchinterval(old_interval)
+    assert not violations, f"Mutual exclusion violated: {violations[:5]}"
+    print(f"Mutual exclusion held for {sum(acquired)} acquisitions by {num_threads} threads on {num_keys} keys")
+
+
+def benchmark_shared_contention(num_threads=16, duration=3, hold_time=0.001, write_fraction=0.1, permits=4):
+    # Threads contend for one key, each holding it for hold_time as if doing I/O, and retry shortly when refused.
+    # Compares completed critical sections per second of exclusive locks with read/write locks (mostly readers)
+    # and with a semaphore, and checks that no reader ever overlaps a writer and no more than permits clients
+    # hold the semaphore.
+    def run(name, acquire, release, is_write):
+        lock_manager = LockObjectManager()
+        inside = {"readers": 0, "writers": 0}
+        mutex = threading.Lock()
+        violations, completed = [], [0] * num_threads
+        stop_at = time.monotonic() + duration
+
+        def worker(thread_no):
+            client_id = f"client_{thread_no}"
+            write = is_write()
+            while time.monotonic() < stop_at:
+                try:
+                    acquire(lock_manager, client_id, write)
+                except LockAlreadyHeldException:
+                    time.sleep(0.0002) # Retry the same operation
+                    continue
+                with mutex:
+                    inside["writers" if write else "readers"] += 1
+                    if inside["writers"] > 1 or (inside["writers"] and inside["readers"]) or inside["readers"] > permits_limit[name]:
+                        violations.append(dict(inside))
+                time.sleep(hold_time)
+                with mutex:
+                    inside["writers" if write else "readers"] -= 1
+                release(lock_manager, client_id)
+                completed[thread_no] += 1
+                write = is_write()
+
+        threads = [threading.Thread(target=worker, args=(thread_no,)) for thread_no in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not violations, f"{name} violated: {violations[:5]}"
+        print(f"{name}, {num_threads} threads: {sum(completed) / duration:,.0f} critical sections/sec")
+
+    # Readers that are not limited can all be inside at once
+    permits_limit = {"Exclusive lock": 0, "Read/write lock": num_threads, f"Semaphore with {permits} permits": permits}
+    run("Exclusive lock", lambda manager, client_id, write: manager.acquire_lock("inventory", client_id, 60),
+        lambda manager, client_id: manager.delete_lock("inventory", client_id), lambda: True)
+    run("Read/write lock",
+        lambda manager, client_id, write: (manager.acquire_write_lock if write else manager.acquire_read_lock)("inventory", client_id, 60),
+        lambda manager, client_id: manager.release_rw_lock("inventory", client_id), lambda: random.random() < write_fraction)
+    run(f"Semaphore with {permits} permits", lambda manager, client_id, write: manager.acquire_semaphore("inventory", client_id, 60, permits),
+        lambda manager, client_id: manager.release_semaphore("inventory", client_id), lambda: False)
+
+
+def benchmark_lock_listing(total_locks=1_000_000, num_events=1000):
+    # Dashboards list locks while clients acquire and release them. Compares dumping the whole table with
+    # listing it page by page from the ordered key index, and reports the worst acquire/release latency
+    # seen by a client while each listing runs.
+    lock_manager = LockObjectManager()
+    for i in range(total_locks):
+        lock_manager.acquire_lock(f"ticket_lock_{i % num_events}_{i // num_events}", "client_1", 3600)
+
+    def measure(name, listing):
+        latencies, done = [], threading.Event()
+
+        def client():
+            i = 0
+            while not done.is_set():
+                start = time.perf_counter()
+                lock_manager.acquire_lock(f"other_lock_{i % 1000}", "client_2", 60)
+                lock_manager.delete_lock(f"other_lock_{i % 1000}", "client_2")
+                latencies.append(time.perf_counter() - start)
+                i += 1
+
+        thread = threading.Thread(target=client)
+        thread.start()
+        time.sleep(0.1)
+        start = time.perf_counter()
+        listing()
+        elapsed = time.perf_counter() - start
+        done.set()
+        thread.join()
+        print(f"{name}: {elapsed * 1000:,.1f} ms, worst acquire/release meanwhile {max(latencies) * 1000:.1f} ms")
+
+    def dump_all():
+        # What /all_locks used to do: copy the table, then serialize it in one response
+        json.dumps({key: lock.get_status() for key, lock in lock_manager.get_locks().items()})
+
+    def walk_pages():
+        cursor = None
+        while True:
+            locks, cursor = lock_manager.list_locks(cursor=cursor, limit=1000)
+            json.dumps([{"lock_key": lock.key, "lock_status": lock.get_status()} for lock in locks])
+            if cursor is None:
+                return
+
+    measure(f"Dump of all {total_locks} locks", dump_all)
+    measure(f"All {total_locks} locks in pages of 1000", walk_pages)
+    measure("One page of 100 locks for one event", lambda: lock_manager.list_locks("ticket_lock_42_", limit=100))
+    measure(f"Counts by status of all {total_locks} locks", lock_manager.count_locks)
+    measure("Counts by status for one event", lambda: lock_manager.count_locks("ticket_lock_42_"))
+
+
+def test_hot_key_detection(total_ops=500_000, num_keys=100_000, num_hot_keys=5, hot_fraction=0.2):
+    # A few hot keys get a fraction of the attempts among many cold keys. The metrics' top-K sketch
+    # keeps a fixed number of counters per shard, and must still report exactly the hot keys on top.
+    lock_manager = LockObjectManager()
+    hot_keys = [f"hot_lock_{i}" for i in range(num_hot_keys)]
+    start = time.perf_counter()
+    for i in range(total_ops):
+        key = random.choice(hot_keys) if random.random() < hot_fraction else f"cold_lock_{random.randrange(num_keys)}"
+        try:
+            lock_manager.acquire_lock(key, f"client_{i % 7}", 60)
+        except LockAlreadyHeldException:
+            pass
+    elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    metrics = lock_manager.get_metrics(top_k=num_hot_keys)
+    found = {entry["key"] for entry in metrics["hot_keys"]}
+    assert found == set(hot_keys), f"Top keys {found} are not the hot keys"
+    print(f"Found the {num_hot_keys} hot keys among {num_keys} in {total_ops} attempts ({total_ops / elapsed:,.0f} attempts/sec). "
+          f"Reading the metrics took {(time.perf_counter() - start) * 1000:.1f} ms. Conflicts: {metrics['counters']['conflicts']}")
+
+
+def benchmark_thread_scaling(ops_per_thread=50_000, num_shards_list=(1, 16)):
+    # Acquire/release throughput on independent keys as threads are added, with one shard vs many shards.
+    for num_shards in num_shards_list:
+        for num_threads in (1, 2, 4, 8):
+            lock_manager = LockObjectManager(num_shards=num_shards)
+
+            def worker(thread_no):
+                client_id = f"client_{thread_no}"
+                for i in range(ops_per_thread):
+                    key = f"key_{thread_no}_{i % 1000}"
+                    lock_manager.acquire_lock(key, client_id, 60)
+                    lock_manager.delete_lock(key, client_id)
+
+            threads = [threading.Thread(target=worker, args=(thread_no,)) for thread_no in range(num_threads)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - start
+            print(f"{num_shards} shard(s), {num_threads} thread(s): {2 * ops_per_thread * num_threads / elapsed:,.0f} ops/sec")
+
+
+def benchmark_session_heartbeats(num_clients=100, locks_per_client=1000):
+    # Clients each holding many leases keep them alive. Per-lock renewal costs one call per lock,
+    # a session heartbeat costs one call per client whatever the number of locks.
+    lock_manager = LockObjectManager()
+    total_locks = num_clients * locks_per_client
+    sessions = []
+    for client_no in range(num_clients):
+        client_id = f"client_{client_no}"
+        session = lock_manager.create_session(client_id, 60)
+        sessions.append(session)
+        for i in range(locks_per_client):
+            lock_manager.acquire_lock(f"session_lock_{client_no}_{i}", client_id, 60, session_id=session.session_id)
+            lock_manager.acquire_lock(f"ttl_lock_{client_no}_{i}", client_id, 60)
+
+    start = time.perf_counter()
+    for client_no in range(num_clients):
+        for i in range(locks_per_client):
+            lock_manager.acquire_lock(f"ttl_lock_{client_no}_{i}", f"client_{client_no}", 60)
+    renew_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for session in sessions:
+        lock_manager.heartbeat(session.session_id, session.client_id)
+    heartbeat_time = time.perf_counter() - start
+    print(f"Keeping {total_locks} leases alive: {total_locks} renew calls in {renew_time * 1000:.1f} ms vs "
+          f"{num_clients} heartbeats in {heartbeat_time * 1000:.2f} ms")
+
+    # Let every session lapse and release all their locks in bulk
+    start = time.perf_counter()
+    released = lock_manager.pop_expired_sessions(now=time.monotonic() + 120)
+    elapsed = time.perf_counter() - start
+    assert sum(len(keys) for keys in released.values()) == total_locks
+    print(f"Released {total_locks} locks of {len(released)} expired sessions in {elapsed * 1000:.1f} ms")
+
+
+def benchmark_recovery(total_locks=1_000_000):
+    # Time to recover a large lock table from the write-ahead log alone, and from a snapshot.
+    directory = tempfile.mkdtemp(prefix="lock_wal_")
+    try:
+        lock_manager = LockObjectManager(wal=WriteAheadLog(directory, fsync_policy="none"))
+        start = time.perf_counter()
+        for i in range(total_locks):
+            lock_manager.acquire_lock(f"lock_{i}", f"client_{i % 100}", 3600)
+        lock_manager.wal.close()
+        print(f"Logged {total_locks} acquires in {time.perf_counter() - start:.2f}s")
+
+        for source in ("write-ahead log", "snapshot"):
+            lock_manager = LockObjectManager(wal=WriteAheadLog(directory, fsync_policy="none"))
+            start = time.perf_counter()
+            restored = lock_manager.recover(compact=False)
+            print(f"Recovered {restored} locks from the {source} in {time.perf_counter() - start:.2f}s")
+            assert restored == total_locks
+            # The next recovery starts from a snapshot
+            start = time.perf_counter()
+            lock_manager.take_snapshot()
+            if source == "write-ahead log":
+                print(f"Snapshot of {total_locks} locks written in {time.perf_counter() - start:.2f}s "
+                      f"({os.path.getsize(os.path.join(directory, 'snapshot.json')) / total_locks:.0f} bytes per lock)")
+            lock_manager.wal.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+def benchmark_fsync_policies(num_threads=16, ops_per_thread=500):
+    # Acquire/release throughput with the write-ahead log under each fsync policy.
+    # With the always policy concurrent requests share an fsync, reported as the average batch size.
+    for fsync_policy in ("always", "interval", "none"):
+        directory = tempfile.mkdtemp(prefix="lock_wal_")
+        lock_manager = LockObjectManager(wal=WriteAheadLog(directory, fsync_policy=fsync_policy))
+
+        def worker(thread_no):
+            client_id = f"client_{thread_no}"
+            for i in range(ops_per_thread):
+                key = f"key_{thread_no}_{i}"
+                lock_manager.acquire_lock(key, client_id, 60)
+                lock_manager.delete_lock(key, client_id)
+
+        threads = [threading.Thread(target=worker, args=(thread_no,)) for thread_no in range(num_threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        lock_manager.wal.close()
+        stats = lock_manager.wal.stats
+        print(f"fsync {fsync_policy}: {2 * ops_per_thread * num_threads / elapsed:,.0f} ops/sec with {num_threads} threads, "
+              f"{stats['fsyncs']} fsyncs, {stats['records'] / max(stats['batches'], 1):.1f} records per batch")
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    total_locks = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    # Cost of the expired lock cleaner sweep with a large lock population
+    benchmark_expiry_sweep(total_locks)
+
+    # Memory per lock and ops/sec of the lock manager
+    benchmark_lock_records(total_locks)
+
+    # Two clients must never hold the same lock, even with many threads
+    stress_test_mutual_exclusion()
+
+    # Throughput as threads scale
+    benchmark_thread_scaling()
+
+    # Read/write locks and semaphores vs exclusive locks on a contended key
+    benchmark_shared_contention()
+
+    # Listing locks while clients acquire and release them
+    benchmark_lock_listing(total_locks)
+
+    # The metrics must point at the keys with the most contention
+    test_hot_key_detection()
+
+    # Renewal cost with sessions vs renewing every lock
+    benchmark_session_heartbeats()
+
+    # Restart recovery time and the cost of persisting locks
+    benchmark_recovery(total_locks)
+    benchmark_fsync_policies()
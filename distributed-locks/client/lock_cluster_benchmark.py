@@ -0,0 +1,87 @@
+"""
+Benchmarks a cluster of lock servers running as local processes.
+Reports aggregate acquire/release throughput as lock servers are added, and checks that held locks
+survive adding and removing a lock server.
+"""
+import multiprocessing, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_locks"))
+
+from lock_cluster import LockCluster
+from lock_cluster_client import LockClusterClient
+
+
+def run_client(seed_url, client_no, duration):
+    # One client process acquiring and releasing random keys as fast as it can.
+    client = LockClusterClient([seed_url])
+    client_id = f"client_{client_no}"
+    ops = 0
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        key = f"bench_lock_{random.randrange(100_000)}"
+        if client.acquire_lock(key, client_id, 60):
+            client.release_lock(key, client_id)
+        ops += 2
+    return ops
+
+
+def benchmark_cluster_scaling(server_counts=(1, 2, 4), num_clients=16, duration=10):
+    # Clients run in their own processes so the load generator is not limited to one core.
+    for num_servers in server_counts:
+        cluster = LockCluster(num_servers=num_servers)
+        seed_url = cluster.get_urls()[0]
+        with multiprocessing.Pool(num_clients) as pool:
+            start = time.perf_counter()
+            ops = sum(pool.starmap(run_client, [(seed_url, client_no, duration) for client_no in range(num_clients)]))
+            elapsed = time.perf_counter() - start
+        print(f"{num_servers} lock server(s), {num_clients} clients: {ops / elapsed:,.0f} acquire/release ops/sec")
+        cluster.shutdown()
+
+
+def test_rebalancing(num_locks=2000):
+    # Held locks must keep their owner and fencing token when lock servers are added and removed.
+    cluster = LockCluster(num_servers=2)
+    client = LockClusterClient(cluster.get_urls())
+    keys = [f"seat_lock_{i}" for i in range(num_locks)]
+    tokens = {key: client.acquire_lock(key, "client_1", 60)["fencing_token"] for key in keys}
+    # Read/write locks and semaphores move with their holders too
+    shared_keys = keys[:200]
+    for key in shared_keys:
+        for client_id in ("client_1", "client_2"):
+            assert client._request(key, "/acquire_read_lock", {"key": key, "client_id": client_id, "expiry": 60}).status_code == 200
+        assert client._request(key, "/acquire_semaphore", {"key": key, "client_id": "client_1", "expiry": 60, "permits": 1}).status_code == 200
+
+    def check_locks(step):
+        for key in keys:
+            status = client.lock_status(key)
+            assert status and status["client_id"] == "client_1" and status["fencing_token"] == tokens[key], f"{key} lost after {step}"
+            assert client.acquire_lock(key, "client_2", 60) is None, f"{key} acquired by another client after {step}"
+        for key in shared_keys:
+            readers = client._request(key, f"/rw_lock_status/{key}", method="GET").json()["lock_status"]["readers"]
+            assert sorted(readers) == ["client_1", "client_2"], f"Readers of {key} lost after {step}"
+            semaphore = {"key": key, "client_id": "client_2", "expiry": 60, "permits": 1}
+            assert client._request(key, "/acquire_semaphore", semaphore).status_code == 409, f"Semaphore {key} lost after {step}"
+        print(f"All {num_locks} locks and {len(shared_keys)} read/write locks and semaphores still held after {step}. Topology version {client.ring.version}")
+
+    start = time.perf_counter()
+    new_server = cluster.add_server()
+    print(f"Added {new_server} in {time.perf_counter() - start:.2f}s")
+    check_locks(f"adding {new_server}")
+    old_server = next(iter(cluster.get_topology()["servers"]))
+    start = time.perf_counter()
+    cluster.remove_server(old_server)
+    print(f"Removed {old_server} in {time.perf_counter() - start:.2f}s")
+    check_locks(f"removing {old_server}")
+
+    # New holders of a moved key get a larger fencing token than the previous holder
+    client.release_locks(keys, "client_1")
+    assert all(client.acquire_lock(key, "client_2", 60)["fencing_token"] > tokens[key] for key in keys[:100])
+    cluster.shutdown()
+
+
+if __name__ == "__main__":
+    # Locks must survive lock servers being added and removed
+    test_rebalancing()
+
+    # Aggregate throughput as lock servers are added
+    benchmark_cluster_scaling()
@@ -0,0 +1,138 @@
+"""
+Routing client for a cluster of lock servers.
+The client fetches the ring topology from any lock server, places keys on the ring locally and sends each
+request directly to the lock server that owns the key. When a server answers that it no longer owns a key,
+its response carries the current topology and the request is retried with the new owner. While a key is being
+moved between servers it is retried after a short delay.
+"""
+import os, sys, time
+from typing import Dict, List, Optional
+import requests
+
+# The ring placement lives with the lock service modules in the distributed_locks directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_locks"))
+
+from lock_ring import LockRing
+
+
+class LockClusterClient:
+    def __init__(self, seed_urls: List[str], max_retries: int = 20, retry_delay: float = 0.05):
+        self.seed_urls = seed_urls # Lock servers to ask for the topology
+        self.max_retries = max_retries # Times a request is re-routed or retried while its key moves
+        self.retry_delay = retry_delay # Seconds to wait before retrying a key that is moving
+        self.session = requests.Session() # Keeps connections to the lock servers alive
+        self.ring: Optional[LockRing] = None
+        self.refresh_topology()
+
+    def refresh_topology(self):
+        ''' Fetches the topology from the first lock server that answers '''
+        urls = list(self.ring.servers.values()) if self.ring else []
+        for url in urls + self.seed_urls:
+            try:
+                response = self.session.get(f"{url}/topology", timeout=2)
+            except requests.exceptions.ConnectionError:
+                continue
+            if response.status_code == 200:
+                self._update_ring(response.json())
+                return
+        raise Exception("Could not fetch the lock cluster topology from any lock server")
+
+    def _update_ring(self, topology: Optional[dict]) -> bool:
+        ''' Switches to the topology if it is newer than ours. Returns whether it was '''
+        if topology and (self.ring is None or topology["version"] > self.ring.version):
+            self.ring = LockRing.from_dict(topology)
+            return True
+        return False
+
+    def _request(self, key: str, path: str, json: Optional[dict] = None, method: str = "POST") -> requests.Response:
+        ''' Sends a request to the lock server owning the key, following topology changes '''
+        for _ in range(self.max_retries + 1):
+            url = self.ring.servers[self.ring.get_server(key)]
+            try:
+                response = self.session.request(method, f"{url}{path}", json=json)
+            except requests.exceptions.ConnectionError:
+                # The lock server was probably removed from the cluster
+                self.refresh_topology()
+                continue
+            if response.status_code == 421:
+                if not self._update_ring(response.json().get("topology")):
+                    # The key's new owner has not committed the topology we routed with yet, or the server sent
+                    # an older one. Give the change time to complete and ask the cluster for its topology again.
+                    time.sleep(self.retry_delay)
+                    self.refresh_topology()
+                continue
+            if response.status_code == 503:
+                time.sleep(self.retry_delay)
+                self._update_ring(response.json().get("topology"))
+                continue
+            return response
+        raise Exception(f"Could not reach the owner of key {key} after {self.max_retries} retries")
+
+    def acquire_lock(self, key: str, client_id: str, expiry: int, wait_timeout: float = 0) -> Optional[dict]:
+        ''' Returns the lock info including its fencing token, or None if the lock is held by another client '''
+        response = self._request(key, "/acquire_lock", {"key": key, "client_id": client_id, "expiry": expiry, "wait_timeout": wait_timeout})
+        return response.json() if response.status_code == 200 else None
+
+    def release_lock(self, key: str, client_id: str) -> bool:
+        response = self._request(key, "/release_lock", {"key": key, "client_id": client_id})
+        return response.status_code == 200
+
+    def lock_status(self, key: str) -> Optional[dict]:
+        response = self._request(key, f"/lock_status/{key}", method="GET")
+        return response.json() if response.status_code == 200 else None
+
+    def acquire_locks(self, keys: List[str], client_id: str, expiry: int) -> Optional[Dict[str, int]]:
+        ''' Acquires all the keys or none of them. Keys are acquired one lock server at a time in a fixed order,
+            and released again if any server refuses. Returns the fencing token of each key, or None '''
+        tokens = {}
+        for server, server_keys in sorted(self.ring.group_by_server(sorted(set(keys))).items()):
+            try:
+                response = self._request(server_keys[0], "/acquire_locks", {"keys": server_keys, "client_id": client_id, "expiry": expiry})
+            except Exception:
+                response = None # The keys of the batch were split across servers by a topology change
+            if response is None or response.status_code != 200:
+                # Undo what we acquired so far
+                self.release_locks(list(tokens), client_id)
+                return None
+            tokens.update(response.json()["fencing_tokens"])
+        return tokens
+
+    def _batch(self, path: str, keys: List[str], client_id: str) -> Dict[str, str]:
+        ''' Sends a renew or release batch to each owning lock server. Keys that moved are re-routed '''
+        results = {}
+        pending = sorted(set(keys))
+        for _ in range(self.max_retries + 1):
+            if not pending:
+                break
+            retry = []
+            for server, server_keys in sorted(self.ring.group_by_server(pending).items()):
+                response = self._request(server_keys[0], path, {"keys": server_keys, "client_id": client_id})
+                for key, result in response.json()["results"].items():
+                    if result == "not owned":
+                        retry.append(key)
+                    else:
+                        results[key] = result
+            if retry:
+                time.sleep(self.retry_delay)
+                self.refresh_topology()
+            pending = retry
+        return results
+
+    def renew_locks(self, keys: List[str], client_id: str) -> Dict[str, str]:
+        return self._batch("/renew_locks", keys, client_id)
+
+    def release_locks(self, keys: List[str], client_id: str) -> Dict[str, str]:
+        return self._batch("/release_locks", keys, client_id)
+
+
+# ----- Testing -----
+
+if __name__ == "__main__":
+    # Start a cluster first with: python3 lock_cluster.py 3 (from the distributed_locks directory)
+    client = LockClusterClient(["http://127.0.0.1:6101"])
+    print("Topology:", client.ring.to_dict())
+    lock = client.acquire_lock("seat_lock_A1", "client_1", 10)
+    print("Client 1 Acquire Lock Response:", lock)
+    print("Client 2 Acquire Lock Response (should be None):", client.acquire_lock("seat_lock_A1", "client_2", 10))
+    print("Client 1 Acquire Locks Response:", client.acquire_locks([f"seat_lock_B{i}" for i in range(10)], "client_1", 10))
+    print("Client 1 Release Locks Response:", client.release_locks([f"seat_lock_B{i}" for i in range(10)] + ["seat_lock_A1"], "client_1"))
@@ -0,0 +1,77 @@
+"""
+Compares acquire latency of quorum locks across independent lock servers with a single lock server,
+and checks that quorum locks keep working while a minority of the servers is down.
+The lock servers run as local processes.
+"""
+import os, sys, time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "distributed_locks"))
+
+from lock_cluster import start_lock_server, stop_lock_server
+from redlock_client import RedlockClient
+
+
+def percentiles(latencies):
+    latencies = sorted(latencies)
+    pick = lambda p: latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000
+    return f"p50 {pick(50):.2f} ms, p95 {pick(95):.2f} ms, p99 {pick(99):.2f} ms"
+
+
+def benchmark_single_node(url, iterations):
+    session = requests.Session()
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        response = session.post(f"{url}/acquire_lock", json={"key": f"single_{i}", "client_id": "client_1", "expiry": 10})
+        latencies.append(time.perf_counter() - start)
+        assert response.status_code == 200
+        session.post(f"{url}/release_lock", json={"key": f"single_{i}", "client_id": "client_1"})
+    print(f"Single lock server acquire: {percentiles(latencies)}")
+
+
+def benchmark_quorum(urls, iterations):
+    client = RedlockClient(urls, timeout=0.5)
+    latencies = []
+    for i in range(iterations):
+        start = time.perf_counter()
+        lease = client.acquire(f"quorum_{len(urls)}_{i}", ttl=10)
+        latencies.append(time.perf_counter() - start)
+        assert lease is not None
+        client.release(lease)
+    print(f"Quorum of {client.quorum}/{len(urls)} lock servers acquire: {percentiles(latencies)}")
+
+
+def test_minority_failure(processes, urls):
+    # With 5 servers the lock survives 2 of them going down, but not 3.
+    client = RedlockClient(urls, timeout=0.5)
+    lease = client.acquire("seat_lock_A1", ttl=10)
+    assert lease is not None and client.acquire("seat_lock_A1", ttl=10) is None
+    assert client.extend(lease), "Holder could not extend its lease"
+    client.release(lease)
+    assert not client.extend(lease), "Released lease was extended"
+    for process in processes[:2]:
+        stop_lock_server(process)
+    lease = client.acquire("seat_lock_A1", ttl=10)
+    assert lease is not None, "Quorum lock should survive 2 of 5 servers down"
+    assert client.acquire("seat_lock_A1", ttl=10) is None, "Two clients hold the lock"
+    print(f"Quorum lock acquired with 2 of 5 lock servers down, validity {lease.get_validity():.2f}s")
+    client.release(lease)
+    stop_lock_server(processes[2])
+    assert client.acquire("seat_lock_A2", ttl=10) is None, "Quorum lock acquired without a majority"
+    print("Quorum lock correctly refused with 3 of 5 lock servers down")
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    ports = range(6201, 6206)
+    processes = [start_lock_server(port) for port in ports]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    try:
+        benchmark_single_node(urls[0], iterations)
+        benchmark_quorum(urls[:3], iterations)
+        benchmark_quorum(urls, iterations)
+        test_minority_failure(processes, urls)
+    finally:
+        for process in processes:
+            stop_lock_server(process)
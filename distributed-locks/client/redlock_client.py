@@ -0,0 +1,102 @@
+"""
+Quorum client for locks replicated across independent lock servers, in the style of Redis' Redlock.
+The same key is acquired on every lock server in parallel with a tight timeout. The lock is held if a majority
+of the servers granted it and some of its TTL is left after the time spent acquiring it and an allowance for
+clock drift. Otherwise it is released on every server. The lock keeps working while a minority of the servers
+is down or unreachable.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+import random
+import time
+import uuid
+import requests
+
+
+class RedlockLease:
+    def __init__(self, key: str, client_id: str, ttl: float, validity: float, tokens: Dict[str, int]):
+        self.key = key
+        self.client_id = client_id # Unique per acquire, so a lease can only be released by the client that holds it
+        self.ttl = ttl # TTL in seconds the lock was acquired with on each server
+        # Time on the monotonic clock until which the lock is safely held by this client
+        self.valid_until = time.monotonic() + validity
+        self.tokens = tokens # Fencing token returned by each server that granted the lock
+
+    def get_validity(self) -> float:
+        ''' Seconds left during which the lock is safely held '''
+        return max(0.0, self.valid_until - time.monotonic())
+
+
+class RedlockClient:
+    def __init__(self, server_urls: List[str], timeout: float = 0.05, clock_drift_factor: float = 0.01,
+                 retry_count: int = 3, retry_delay: float = 0.2):
+        self.server_urls = server_urls
+        self.quorum = len(server_urls) // 2 + 1 # Majority of the lock servers
+        self.timeout = timeout # Seconds to wait for each server. Kept much smaller than the TTL.
+        # Clocks on the servers may run slightly faster than ours. Allow for that and the network delay.
+        self.clock_drift_factor = clock_drift_factor
+        self.retry_count = retry_count # Attempts before giving up when the quorum is not reached
+        self.retry_delay = retry_delay # Maximum random delay between attempts, so competing clients do not retry in lock step
+        self.sessions = {url: requests.Session() for url in server_urls} # Keeps connections to the servers alive
+        self.executor = ThreadPoolExecutor(max_workers=len(server_urls))
+
+    def _call(self, url: str, path: str, json: dict) -> Optional[dict]:
+        ''' Returns the response of one server, or None if it refused or did not answer in time '''
+        try:
+            response = self.sessions[url].post(f"{url}{path}", json=json, timeout=self.timeout)
+        except requests.exceptions.RequestException:
+            return None
+        return response.json() if response.status_code == 200 else None
+
+    def _call_all(self, path: str, json: dict) -> Dict[str, Optional[dict]]:
+        futures = {url: self.executor.submit(self._call, url, path, json) for url in self.server_urls}
+        return {url: future.result() for url, future in futures.items()}
+
+    def acquire(self, key: str, ttl: float, client_id: Optional[str] = None) -> Optional[RedlockLease]:
+        ''' Acquires the lock on a majority of the servers. Returns the lease, or None if the quorum was not reached '''
+        client_id = client_id or uuid.uuid4().hex
+        for attempt in range(self.retry_count):
+            start = time.monotonic()
+            results = self._call_all("/acquire_lock", {"key": key, "client_id": client_id, "expiry": ttl})
+            tokens = {url: result["fencing_token"] for url, result in results.items() if result is not None}
+            drift = ttl * self.clock_drift_factor + 0.002
+            validity = ttl - (time.monotonic() - start) - drift
+            if len(tokens) >= self.quorum and validity > 0:
+                return RedlockLease(key, client_id, ttl, validity, tokens)
+            # Release on every server, including those whose answer was lost, so the lock is free for others
+            self._call_all("/release_lock", {"key": key, "client_id": client_id})
+            if attempt < self.retry_count - 1:
+                time.sleep(random.uniform(0, self.retry_delay))
+        return None
+
+    def extend(self, lease: RedlockLease) -> bool:
+        ''' Restarts the TTL of a held lease on a majority of the servers. Only servers on which this client still
+            holds the lock count, a server where it expired is not acquired again '''
+        start = time.monotonic()
+        results = self._call_all("/renew_locks", {"keys": [lease.key], "client_id": lease.client_id})
+        granted = sum(result is not None and result["results"].get(lease.key) == "renewed" for result in results.values())
+        validity = lease.ttl - (time.monotonic() - start) - (lease.ttl * self.clock_drift_factor + 0.002)
+        if granted >= self.quorum and validity > 0:
+            lease.valid_until = time.monotonic() + validity
+            return True
+        lease.valid_until = 0
+        return False
+
+    def release(self, lease: RedlockLease):
+        ''' Releases the lock on every server '''
+        self._call_all("/release_lock", {"key": lease.key, "client_id": lease.client_id})
+        lease.valid_until = 0
+
+
+# ----- Testing -----
+
+if __name__ == "__main__":
+    # Start three lock servers first, for example on ports 6201, 6202 and 6203
+    client = RedlockClient([f"http://127.0.0.1:{port}" for port in (6201, 6202, 6203)])
+    lease = client.acquire("seat_lock_A1", ttl=10)
+    print("Client 1 acquired lock with validity:", lease and lease.get_validity())
+    print("Client 2 acquire (should be None):", client.acquire("seat_lock_A1", ttl=10))
+    print("Client 1 extend:", client.extend(lease))
+    client.release(lease)
+    print("Client 1 extend after release (should be False):", client.extend(lease))
+    print("Client 2 acquire after release:", client.acquire("seat_lock_A1", ttl=10) is not None)
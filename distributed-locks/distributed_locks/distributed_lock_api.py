@@ -2,11 +2,15 @@
 Distributed lock API implementation using Flask.
 """
 import logging
+import os
+import sys
 
 from lock import Lock
 from lock_object_manager import LockObjectManager
-from lock_exceptions import LockAlreadyHeldException
+from lock_exceptions import LockAlreadyHeldException, LockBatchException, LockNotOwnedException, SessionExpiredException, WriteAheadLogException
+from lock_ring import LockRing
 from expired_lock_cleaner import ExpiredLockCleaner
+from lock_wal import SnapshotWriter, WriteAheadLog
 import time
 from flask import Flask, request
 import threading
@@ -16,24 +20,61 @@ import threading
 app = Flask(__name__)
 logging.basicConfig(filename='distributed_locks.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-lock_manager = LockObjectManager()
+
+# The port can be passed as an argument to run several lock servers on one host, for example as a cluster
+PORT = int(sys.argv[1]) if len(sys.argv) > 1 else 6000
+# Locks are persisted to a write-ahead log in LOCK_DATA_DIR and recovered on startup. Set it to an empty string to keep locks in memory only.
+# The default directory is per port, so lock servers started from the same directory do not share a log.
+LOCK_DATA_DIR = os.environ.get("LOCK_DATA_DIR", f"lock_data_{PORT}")
+FSYNC_POLICY = os.environ.get("FSYNC_POLICY", "always") # always, interval or none
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 60)) # Seconds between snapshots of the lock table
+
+wal = WriteAheadLog(LOCK_DATA_DIR, fsync_policy=FSYNC_POLICY) if LOCK_DATA_DIR else None
+lock_manager = LockObjectManager(wal=wal)
+if wal is not None:
+    lock_manager.recover()
+    snapshot_writer = SnapshotWriter(lock_manager, snapshot_interval=SNAPSHOT_INTERVAL)
+    snapshot_writer.start()
 expired_lock_cleaner = ExpiredLockCleaner(lock_manager, cleanup_interval=5)
 expired_lock_cleaner.start()
 
 
+@app.errorhandler(LockNotOwnedException)
+def lock_not_owned(e):
+    # In a cluster, tell the client who owns the key now so it can re-route without another call.
+    # While a key is moving between lock servers the client should retry shortly.
+    topology = lock_manager.ring.to_dict() if lock_manager.ring else None
+    return {"status": "error", "message": str(e), "topology": topology}, 503 if e.moving else 421
+
+@app.errorhandler(WriteAheadLogException)
+def write_ahead_log_failed(e):
+    # The change was made in memory but could not be persisted, so it would be lost on a restart.
+    logger.error("Request failed as the write-ahead log could not be written - %s", str(e))
+    return {"status": "error", "message": str(e)}, 503
+
+@app.route("/health", methods=["GET"])
+def health():
+    return {"status": "ok", "lock_count": lock_manager.get_lock_count()}, 200
+
+
 @app.route("/acquire_lock", methods=["POST"])
 def acquire_lock():
     data = request.json
-    if not "key" in data or not "client_id" in data or not "expiry" in data:
-        return {"status": "error", "message": "Missing required parameters: key, client_id, expiry"}, 400
+    # Locks acquired under a session expire with the session, so expiry is only required without one.
+    if not "key" in data or not "client_id" in data or not ("expiry" in data or "session_id" in data):
+        return {"status": "error", "message": "Missing required parameters: key, client_id, expiry or session_id"}, 400
     key = data.get("key")
     client_id = data.get("client_id")
-    expiry = data.get("expiry")
+    expiry = data.get("expiry", 0)
+    # Optional. Seconds to wait in the FIFO queue for the lock if it is held by another client.
+    wait_timeout = data.get("wait_timeout", 0)
     try:
-        lock = lock_manager.acquire_lock(key, client_id, expiry)
-        return {"status": "success", "lock_key": lock.key, "lock_status": lock.get_status()}, 200
+        lock = lock_manager.acquire_lock(key, client_id, expiry, wait_timeout, data.get("session_id"))
+        return {"status": "success", "lock_key": lock.key, "lock_status": lock.get_status(), "fencing_token": lock.token}, 200
     except LockAlreadyHeldException as e:
         return {"status": "error", "message": str(e)}, 409
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
 
 @app.route("/release_lock", methods=["POST"])
 def release_lock():
@@ -50,23 +91,249 @@ def release_lock():
     except LockAlreadyHeldException as e:
         return {"status": "error", "message": str(e)}, 409
 
+@app.route("/acquire_locks", methods=["POST"])
+def acquire_locks():
+    # Acquire several locks all-or-nothing in a single call.
+    data = request.json
+    if not "keys" in data or not "client_id" in data or not ("expiry" in data or "session_id" in data):
+        return {"status": "error", "message": "Missing required parameters: keys, client_id, expiry or session_id"}, 400
+    keys = data.get("keys")
+    client_id = data.get("client_id")
+    expiry = data.get("expiry", 0)
+    try:
+        locks = lock_manager.acquire_locks(keys, client_id, expiry, data.get("session_id"))
+        return {"status": "success", "locks": {key: lock.get_status() for key, lock in locks.items()},
+                "fencing_tokens": {key: lock.token for key, lock in locks.items()}}, 200
+    except LockBatchException as e:
+        return {"status": "error", "message": str(e), "results": e.results}, 409
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
+
+@app.route("/release_locks", methods=["POST"])
+def release_locks():
+    # Release several locks in a single call. Returns the result for each key.
+    data = request.json
+    if not "keys" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: keys, client_id"}, 400
+    results = lock_manager.delete_locks(data.get("keys"), data.get("client_id"))
+    status = "success" if all(result == "released" for result in results.values()) else "partial"
+    return {"status": status, "results": results}, 200
+
+@app.route("/renew_locks", methods=["POST"])
+def renew_locks():
+    # Renew several locks held by the client in a single call. Returns the result for each key.
+    data = request.json
+    if not "keys" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: keys, client_id"}, 400
+    results = lock_manager.renew_locks(data.get("keys"), data.get("client_id"))
+    status = "success" if all(result == "renewed" for result in results.values()) else "partial"
+    return {"status": status, "results": results}, 200
+
+@app.route("/create_session", methods=["POST"])
+def create_session():
+    # Start a session. Locks acquired with its session_id are held until the session expires or is closed.
+    data = request.json
+    if not "client_id" in data or not "ttl" in data:
+        return {"status": "error", "message": "Missing required parameters: client_id, ttl"}, 400
+    session = lock_manager.create_session(data.get("client_id"), data.get("ttl"))
+    return {"status": "success", "session_id": session.session_id, "ttl": session.ttl}, 200
+
+@app.route("/heartbeat", methods=["POST"])
+def heartbeat():
+    # Extend the session and every lock it holds with a single call.
+    data = request.json
+    if not "session_id" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: session_id, client_id"}, 400
+    try:
+        session = lock_manager.heartbeat(data.get("session_id"), data.get("client_id"))
+        return {"status": "success", "session_id": session.session_id, "lock_count": len(session.keys)}, 200
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
+
+@app.route("/close_session", methods=["POST"])
+def close_session():
+    # End the session and release all its locks.
+    data = request.json
+    if not "session_id" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: session_id, client_id"}, 400
+    try:
+        keys = lock_manager.close_session(data.get("session_id"), data.get("client_id"))
+        return {"status": "success", "released": keys}, 200
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
+
 @app.route("/lock_status/<key>", methods=["GET"])
 def lock_status(key):
     lock = lock_manager.get_lock(key)
     if lock:
-        return {"status": "success", "lock_key": lock.key, "lock_status": lock.get_status(), "client_id": lock.client_id}, 200
+        return {"status": "success", "lock_key": lock.key, "lock_status": lock.get_status(), "client_id": lock.client_id, "fencing_token": lock.token}, 200
     else:
         return {"status": "error", "message": f"Lock with key {key} not found."}, 404
     
+@app.route("/wait_stats", methods=["GET"])
+@app.route("/wait_stats/<key>", methods=["GET"])
+def wait_stats(key=None):
+    # Queue depth and wait times of clients waiting for locks.
+    return {"status": "success", "wait_stats": lock_manager.get_wait_stats(key)}, 200
+
+@app.route("/validate_token", methods=["POST"])
+def validate_token():
+    # Check a fencing token against the current holder of the lock without fetching the lock.
+    data = request.json
+    if not "key" in data or not "token" in data:
+        return {"status": "error", "message": "Missing required parameters: key, token"}, 400
+    return {"status": "success", "valid": lock_manager.validate_token(data.get("key"), data.get("token"))}, 200
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Acquire attempts, conflicts, takeovers of expired locks, hold and wait time histograms, and the hottest keys.
+    top_k = min(request.args.get("top_k", 10, type=int), 100)
+    return {"status": "success", "metrics": lock_manager.get_metrics(top_k)}, 200
+
+# Read/write lock and semaphore APIs. They use their own keys, separate from the exclusive locks above.
+
+@app.route("/acquire_read_lock", methods=["POST"])
+@app.route("/acquire_write_lock", methods=["POST"])
+def acquire_rw_lock():
+    # Many clients can hold the read lock at once, or one client the write lock.
+    # A client holding the read lock alone can upgrade to the write lock, and the writer can downgrade to a reader.
+    data = request.json
+    if not "key" in data or not "client_id" in data or not "expiry" in data:
+        return {"status": "error", "message": "Missing required parameters: key, client_id, expiry"}, 400
+    acquire = lock_manager.acquire_write_lock if request.path == "/acquire_write_lock" else lock_manager.acquire_read_lock
+    try:
+        acquire(data.get("key"), data.get("client_id"), data.get("expiry"))
+        return {"status": "success", "lock_key": data.get("key"), "lock_status": lock_manager.get_rw_lock_status(data.get("key"))}, 200
+    except LockAlreadyHeldException as e:
+        return {"status": "error", "message": str(e)}, 409
+
+@app.route("/release_rw_lock", methods=["POST"])
+def release_rw_lock():
+    data = request.json
+    if not "key" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: key, client_id"}, 400
+    key = data.get("key")
+    if lock_manager.release_rw_lock(key, data.get("client_id")):
+        return {"status": "success", "message": f"Read/write lock with key {key} released."}, 200
+    return {"status": "error", "message": f"Read/write lock with key {key} not held by the client."}, 404
+
+@app.route("/rw_lock_status/<key>", methods=["GET"])
+def rw_lock_status(key):
+    status = lock_manager.get_rw_lock_status(key)
+    if status is None:
+        return {"status": "error", "message": f"Read/write lock with key {key} not found."}, 404
+    return {"status": "success", "lock_key": key, "lock_status": status}, 200
+
+@app.route("/acquire_semaphore", methods=["POST"])
+def acquire_semaphore():
+    # Take one of the semaphore's permits. Up to permits clients can hold the semaphore at once.
+    data = request.json
+    if not "key" in data or not "client_id" in data or not "expiry" in data or not "permits" in data:
+        return {"status": "error", "message": "Missing required parameters: key, client_id, expiry, permits"}, 400
+    key = data.get("key")
+    try:
+        lock_manager.acquire_semaphore(key, data.get("client_id"), data.get("expiry"), data.get("permits"))
+        return {"status": "success", "lock_key": key, "semaphore_status": lock_manager.get_semaphore_status(key)}, 200
+    except LockAlreadyHeldException as e:
+        return {"status": "error", "message": str(e)}, 409
+    except ValueError as e:
+        return {"status": "error", "message": str(e)}, 400
+
+@app.route("/release_semaphore", methods=["POST"])
+def release_semaphore():
+    data = request.json
+    if not "key" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: key, client_id"}, 400
+    key = data.get("key")
+    if lock_manager.release_semaphore(key, data.get("client_id")):
+        return {"status": "success", "message": f"Semaphore permit with key {key} released."}, 200
+    return {"status": "error", "message": f"Semaphore with key {key} not held by the client."}, 404
+
+@app.route("/semaphore_status/<key>", methods=["GET"])
+def semaphore_status(key):
+    status = lock_manager.get_semaphore_status(key)
+    if status is None:
+        return {"status": "error", "message": f"Semaphore with key {key} not found."}, 404
+    return {"status": "success", "lock_key": key, "semaphore_status": status}, 200
+
+# Cluster APIs. Used by the lock cluster to tell each lock server which keys it owns and to move keys
+# between lock servers when one is added or removed.
+
+@app.route("/topology", methods=["GET"])
+def topology():
+    if lock_manager.ring is None:
+        return {"status": "error", "message": "This lock server is not part of a cluster."}, 400
+    return lock_manager.ring.to_dict(), 200
+
+@app.route("/set_ring", methods=["POST"])
+def set_ring():
+    data = request.json
+    if not "topology" in data or not "server_name" in data:
+        return {"status": "error", "message": "Missing required parameters: topology, server_name"}, 400
+    lock_manager.set_ring(LockRing.from_dict(data.get("topology")), data.get("server_name"))
+    return {"status": "success"}, 200
+
+@app.route("/prepare_ring", methods=["POST"])
+def prepare_ring():
+    # Stop serving the keys that change owner in the new ring
+    data = request.json
+    if not "topology" in data:
+        return {"status": "error", "message": "Missing required parameters: topology"}, 400
+    lock_manager.prepare_ring(LockRing.from_dict(data.get("topology")))
+    return {"status": "success"}, 200
+
+@app.route("/export_locks", methods=["POST"])
+def export_locks():
+    # Remove and return the locks that move to other lock servers in the prepared ring
+    if lock_manager.pending_ring is None:
+        return {"status": "error", "message": "No ring change has been prepared."}, 400
+    return {"status": "success", **lock_manager.export_locks()}, 200
+
+@app.route("/import_locks", methods=["POST"])
+def import_locks():
+    data = request.json
+    if not "locks" in data or not "next_token" in data:
+        return {"status": "error", "message": "Missing required parameters: locks, next_token"}, 400
+    lock_manager.import_locks(data.get("locks"), data.get("next_token"), data.get("rw_locks", []), data.get("semaphores", []))
+    return {"status": "success"}, 200
+
+@app.route("/commit_ring", methods=["POST"])
+def commit_ring():
+    if lock_manager.pending_ring is None:
+        return {"status": "error", "message": "No ring change has been prepared."}, 400
+    lock_manager.commit_ring()
+    return {"status": "success", "version": lock_manager.ring.version}, 200
+
+@app.route("/locks", methods=["GET"])
+def list_locks():
+    # One page of locks in key order. Optional query parameters: prefix, cursor (the next_cursor of the previous page) and limit.
+    prefix = request.args.get("prefix", "")
+    limit = min(request.args.get("limit", 100, type=int), 1000)
+    if limit < 1:
+        return {"status": "error", "message": "limit must be at least 1"}, 400
+    locks, next_cursor = lock_manager.list_locks(prefix, request.args.get("cursor"), limit)
+    locks_info = [{"lock_key": lock.key, "client_id": lock.client_id, "lock_status": lock.get_status(), "fencing_token": lock.token} for lock in locks]
+    return {"status": "success", "locks": locks_info, "next_cursor": next_cursor}, 200
+
+@app.route("/lock_counts", methods=["GET"])
+def lock_counts():
+    # Number of locks by status, optionally only those whose key starts with prefix.
+    return {"status": "success", "counts": lock_manager.count_locks(request.args.get("prefix", ""))}, 200
+
 @app.route("/all_locks", methods=["GET"])
 def all_locks():
-    locks = lock_manager.get_locks()
-    locks_info = {key: lock.get_status() for key, lock in locks.items()}
-    return {"status": "success", "locks": locks_info}, 200
+    # Every lock in one response: only for debugging small lock tables. Use /locks for anything else.
+    # Locks are read a page at a time, so acquires and releases are not held up while the response is built.
+    locks_info, cursor = {}, None
+    while True:
+        locks, cursor = lock_manager.list_locks(cursor=cursor, limit=1000)
+        locks_info.update((lock.key, lock.get_status()) for lock in locks)
+        if cursor is None:
+            return {"status": "success", "locks": locks_info}, 200
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=6000)
+    app.run(host="0.0.0.0", port=PORT)
 
     '''
     # Lets create two dummy clients trying to acquire the same lock.
@@ -33,15 +33,30 @@ class ExpiredLockCleaner:
 
     def cleanup_expired_locks(self):
         logger.debug("Running cleanup for expired locks at time: %s", datetime.now(timezone.utc))   
-        items = list(self.lock_manager.locks.items())
-        for key, lock in items:
-            # lock.update_status()
-            if lock.get_status() == "expired":
-                logger.debug("Cleaning up expired lock with key: %s", key)
-                try:
-                    self.lock_manager.delete_lock(key, lock.client_id)
-                except Exception as e:
-                    logger.error("Error deleting expired lock with key: %s - %s", key, str(e))
+        # The lock manager keeps its locks ordered by expiry, so this only touches the expired ones.
+        try:
+            expired_locks = self.lock_manager.pop_expired_locks()
+        except Exception as e:
+            logger.error("Error cleaning up expired locks - %s", str(e))
+            return
+        for lock in expired_locks:
+            logger.debug("Cleaned up expired lock with key: %s", lock.key)
+        # Read/write locks and semaphores expire holder by holder.
+        try:
+            expired_holders = self.lock_manager.pop_expired_shared_locks()
+        except Exception as e:
+            logger.error("Error cleaning up expired shared locks - %s", str(e))
+            return
+        for key, client_id in expired_holders:
+            logger.debug("Cleaned up expired holder: %s of shared lock with key: %s", client_id, key)
+        # Locks held by sessions that stopped sending heartbeats are released together with their session.
+        try:
+            expired_sessions = self.lock_manager.pop_expired_sessions()
+        except Exception as e:
+            logger.error("Error cleaning up expired sessions - %s", str(e))
+            return
+        for session_id, keys in expired_sessions.items():
+            logger.debug("Cleaned up expired session: %s and released %d locks", session_id, len(keys))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+"""
+This module provides an ordered index of lock keys, used to list locks page by page and by key prefix.
+Keys are kept in sorted chunks of bounded size, with the largest key of each chunk in a separate list.
+Finding a key is a binary search over the chunks and then within one chunk, and adding or removing a key
+only shifts the keys of its chunk, so the index stays cheap to update with millions of keys.
+"""
+from bisect import bisect_left, bisect_right
+from typing import Iterable, List, Optional
+
+CHUNK_SIZE = 512 # Chunks are split when they grow to twice this size
+
+
+class SortedKeyIndex:
+    def __init__(self, keys: Iterable[str] = ()):
+        keys = sorted(set(keys))
+        self.chunks: List[List[str]] = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+        self.maxes: List[str] = [chunk[-1] for chunk in self.chunks] # Largest key of each chunk
+        self.size = len(keys)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, key: str):
+        if not self.chunks:
+            self.chunks.append([key])
+            self.maxes.append(key)
+            self.size += 1
+            return
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            # Larger than every key: append to the last chunk
+            i -= 1
+            self.chunks[i].append(key)
+            self.maxes[i] = key
+        else:
+            chunk = self.chunks[i]
+            j = bisect_left(chunk, key)
+            if chunk[j] == key:
+                return
+            chunk.insert(j, key)
+        self.size += 1
+        chunk = self.chunks[i]
+        if len(chunk) >= 2 * CHUNK_SIZE:
+            self.chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self.maxes[i:i + 1] = [chunk[CHUNK_SIZE - 1], chunk[-1]]
+
+    def discard(self, key: str):
+        i = bisect_left(self.maxes, key)
+        if i == len(self.maxes):
+            return
+        chunk = self.chunks[i]
+        j = bisect_left(chunk, key)
+        if chunk[j] != key:
+            return
+        del chunk[j]
+        self.size -= 1
+        if not chunk:
+            del self.chunks[i]
+            del self.maxes[i]
+        elif j == len(chunk):
+            self.maxes[i] = chunk[-1]
+
+    def page(self, prefix: str = "", after: Optional[str] = None, limit: int = 100) -> List[str]:
+        # Up to limit keys starting with prefix, in order, after the key after if it is given.
+        if after is not None and after >= prefix:
+            start, find = after, bisect_right # Skip the cursor key itself
+        else:
+            start, find = prefix, bisect_left
+        keys = []
+        i = find(self.maxes, start)
+        j = find(self.chunks[i], start) if i < len(self.chunks) else 0
+        while i < len(self.chunks) and len(keys) < limit:
+            chunk = self.chunks[i]
+            for key in chunk[j:j + limit - len(keys)]:
+                if not key.startswith(prefix):
+                    return keys # Keys with the prefix are contiguous, so there are no more
+                keys.append(key)
+            i, j = i + 1, 0
+        return keys
@@ -1,34 +1,42 @@
 """
-This module provides a lightweight representation of a distributed lock. 
+This module provides a lightweight representation of a distributed lock.
 """
-from datetime import datetime, timedelta, timezone
+import time
 
 class Lock:
-    def __init__(self, key: str, client_id: str, expiry: int): 
+    # Locks are created in large numbers, so we use slots to keep each record small.
+    __slots__ = ("key", "client_id", "expiry", "deadline", "session", "token", "acquired_at")
+
+    def __init__(self, key: str, client_id: str, expiry: int, session=None, token: int = 0):
         self.key = key # Unique identifier for the lock
         self.client_id = client_id # Identifier for the client that holds the lock
         self.expiry = expiry # Lock time-to-live (TTL) in seconds
-        self.start_time = datetime.now(timezone.utc) # Time when the lock was acquired
-        self.status = "locked" # Current status of the lock
+        # Time on the monotonic clock after which the lock is expired.
+        # Unlike wall-clock time, the monotonic clock does not jump when the system time is adjusted.
+        self.acquired_at = time.monotonic() # Time on the monotonic clock the current holder acquired the lock
+        self.deadline = self.acquired_at + expiry
+        # Session the lock was acquired under, if any. Such a lock expires with its session instead of its own deadline.
+        self.session = session
+        # Fencing token handed to the client holding the lock. Every new holder of the key gets a larger token,
+        # so writes made by a holder whose lock has since been taken over can be rejected by comparing tokens.
+        self.token = token
 
     def __str__(self):
-        return f"Lock(key={self.key}, client_id={self.client_id}, expiry={self.expiry}, start_time={self.start_time}, status={self.status})"
+        return f"Lock(key={self.key}, client_id={self.client_id}, token={self.token}, expiry={self.expiry}, deadline={self.deadline}, status={self.status})"
 
     def reset_start_time(self):
-        # Reset the start time to the current time.
+        # Restart the TTL from the current time.
         # This is used in cases where the lock is renewed by the client.
-        self.start_time = datetime.now(timezone.utc)
-        self.status = "locked" # Update the status to locked
+        self.deadline = time.monotonic() + self.expiry
+
+    def get_deadline(self) -> float:
+        # Time on the monotonic clock at which the lock expires.
+        return self.deadline if self.session is None else self.session.deadline
+
+    @property
+    def status(self) -> str:
+        return self.get_status()
 
-    def update_status(self):
-        # Update the status of the lock based on its expiry.
-        if datetime.now(timezone.utc) - self.start_time > timedelta(seconds=self.expiry):
-            self.status = "expired"
-        else:
-            self.status = "locked"
-    
     def get_status(self) -> str:
-        # We add this check to ensure the status is updated if the cron job hasn't run recently.
-        if datetime.now(timezone.utc) - self.start_time > timedelta(seconds=self.expiry):
-            self.status = "expired"
-        return self.status
+        # The status is derived from the deadline, so it is always up to date even if the cleaner hasn't run recently.
+        return "expired" if time.monotonic() > self.get_deadline() else "locked"
@@ -0,0 +1,163 @@
+"""
+Runs a cluster of lock servers as local processes and partitions the lock keys across them.
+Each lock server is a distributed_lock_api process on its own port. Keys are placed on the servers with the
+same consistent hashing as the project's ConsistentHashingRing, so adding or removing a server only moves
+the keys next to its virtual nodes. Held locks, read/write locks and semaphores are moved to their new owner with their remaining TTL:
+  1. Every server is told the new ring and stops serving keys that change owner (clients get HTTP 503 and retry).
+  2. Each server exports the locks it loses, and they are imported by their new owners.
+  3. Every server switches to the new ring.
+Keys that do not move are served throughout.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from lock_ring import LockRing
+import atexit
+import logging
+import os
+import subprocess
+import sys
+import time
+import requests
+
+logging.basicConfig(filename='distributed_locks.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+LOCK_SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_lock_server(port: int, data_dir: Optional[str] = None, ready_timeout: int = 10) -> subprocess.Popen:
+    ''' Starts a distributed_lock_api process on the port and waits until it serves requests.
+        Locks are persisted in data_dir, or kept in memory only if it is not set '''
+    env = dict(os.environ)
+    env["LOCK_DATA_DIR"] = data_dir or ""
+    process = subprocess.Popen([sys.executable, "distributed_lock_api.py", str(port)], cwd=LOCK_SERVER_DIR,
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + ready_timeout
+    while time.monotonic() < deadline and process.poll() is None:
+        try:
+            if requests.get(f"{url}/health", timeout=1).status_code == 200:
+                logger.info("Started lock server with pid %d on %s", process.pid, url)
+                return process
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.05)
+    stop_lock_server(process)
+    raise Exception(f"Lock server did not become ready on {url}")
+
+
+def stop_lock_server(process: subprocess.Popen):
+    process.terminate()
+    try:
+        process.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+class LockCluster:
+    def __init__(self, num_servers: int = 3, port_base: int = 6100, replication_factor: int = 8,
+                 data_dir: Optional[str] = None, ready_timeout: int = 10):
+        self.port_base = port_base
+        self.cur_port = port_base # Last port handed out to a lock server
+        self.replication_factor = replication_factor # Virtual nodes per lock server
+        self.data_dir = data_dir # Each lock server persists its locks in a sub-directory. In memory only if not set.
+        self.ready_timeout = ready_timeout # Seconds to wait for a lock server to start serving requests
+        self.processes: Dict[str, subprocess.Popen] = {} # Lock server processes keyed by server name
+        self.ring = LockRing({}, replication_factor, version=0)
+        self.server_no = 0 # Used to name new lock servers
+        self.executor = ThreadPoolExecutor(max_workers=8)
+        atexit.register(self.shutdown)
+
+        servers = {}
+        for _ in range(num_servers):
+            name, url = self._start_server()
+            servers[name] = url
+        self.ring = LockRing(servers, replication_factor, version=1)
+        self._call_all("/set_ring", lambda name: {"topology": self.ring.to_dict(), "server_name": name})
+
+    def _start_server(self) -> tuple:
+        self.server_no += 1
+        self.cur_port += 1
+        name = f"lock-server-{self.server_no}"
+        data_dir = os.path.join(self.data_dir, name) if self.data_dir else None
+        self.processes[name] = start_lock_server(self.cur_port, data_dir, self.ready_timeout)
+        return name, f"http://127.0.0.1:{self.cur_port}"
+
+    def _stop_server(self, name: str):
+        stop_lock_server(self.processes.pop(name))
+        logger.info("Stopped lock server %s", name)
+
+    def _call(self, url: str, path: str, json: dict) -> dict:
+        response = requests.post(f"{url}{path}", json=json, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def _call_all(self, path: str, make_json, servers: Optional[Dict[str, str]] = None) -> Dict[str, dict]:
+        ''' Calls an API on every lock server in parallel. make_json builds the request body for a server name '''
+        servers = servers if servers is not None else self.ring.servers
+        futures = {name: self.executor.submit(self._call, url, path, make_json(name)) for name, url in servers.items()}
+        return {name: future.result() for name, future in futures.items()}
+
+    def _rebalance(self, new_ring: LockRing, servers: Dict[str, str]):
+        ''' Moves the locks of every server whose keys change owner to the new ring '''
+        start = time.perf_counter()
+        self._call_all("/prepare_ring", lambda name: {"topology": new_ring.to_dict()}, servers)
+        exports = self._call_all("/export_locks", lambda name: {}, servers)
+        # Group the exported locks by their new owner. Fencing tokens continue from the largest counter.
+        next_token = max(export["next_token"] for export in exports.values())
+        imports = {name: {"locks": [], "rw_locks": [], "semaphores": []} for name in new_ring.servers}
+        for export in exports.values():
+            for table in ("locks", "rw_locks", "semaphores"):
+                for lock in export[table]:
+                    imports[new_ring.get_server(lock[0])][table].append(lock)
+        self._call_all("/import_locks", lambda name: {**imports[name], "next_token": next_token}, new_ring.servers)
+        self._call_all("/commit_ring", lambda name: {}, servers)
+        self.ring = new_ring
+        moved = sum(len(locks) for tables in imports.values() for locks in tables.values())
+        logger.info("Moved %d locks to ring version %d in %.3f seconds", moved, new_ring.version, time.perf_counter() - start)
+        return moved
+
+    def add_server(self) -> str:
+        ''' Starts a new lock server and moves the keys it now owns to it. Returns its name '''
+        name, url = self._start_server()
+        # The new server starts on the current ring, in which it owns nothing, until the keys it gains have moved
+        self._call(url, "/set_ring", {"topology": self.ring.to_dict(), "server_name": name})
+        new_ring = LockRing({**self.ring.servers, name: url}, self.replication_factor, self.ring.version + 1)
+        self._rebalance(new_ring, new_ring.servers)
+        return name
+
+    def remove_server(self, name: str) -> bool:
+        ''' Moves all the keys of a lock server to the remaining servers and stops it '''
+        if name not in self.ring.servers or len(self.ring.servers) == 1:
+            logger.warning("Cannot remove lock server %s from the cluster", name)
+            return False
+        servers = dict(self.ring.servers)
+        new_ring = LockRing({server: url for server, url in servers.items() if server != name}, self.replication_factor, self.ring.version + 1)
+        self._rebalance(new_ring, servers)
+        self._stop_server(name)
+        return True
+
+    def get_topology(self) -> dict:
+        return self.ring.to_dict()
+
+    def get_urls(self) -> List[str]:
+        return list(self.ring.servers.values())
+
+    def shutdown(self):
+        for name in list(self.processes):
+            self._stop_server(name)
+
+
+# ----- Testing -----
+
+if __name__ == "__main__":
+    # Starts a cluster of lock servers and keeps it running. Clients can use any server as a seed for the topology.
+    num_servers = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    cluster = LockCluster(num_servers=num_servers)
+    print(f"Started {num_servers} lock servers: {cluster.get_urls()}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        cluster.shutdown()
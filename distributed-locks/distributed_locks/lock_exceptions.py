@@ -4,4 +4,28 @@ List of exceptions related to lock operations.
 class LockAlreadyHeldException(Exception):
     # Raised when attempting to acquire a lock that is already held by another client."""
     def __init__(self, error_message: str):
-        super().__init__(error_message)
\ No newline at end of file
+        super().__init__(error_message)
+
+class LockBatchException(LockAlreadyHeldException):
+    # Raised when a batch of locks cannot be acquired because some of them are held by other clients.
+    # Carries the result for each key in the batch.
+    def __init__(self, error_message: str, results: dict):
+        super().__init__(error_message)
+        self.results = results
+
+class SessionExpiredException(Exception):
+    # Raised when a session does not exist, has expired or belongs to another client.
+    def __init__(self, error_message: str):
+        super().__init__(error_message)
+
+class LockNotOwnedException(Exception):
+    # Raised by a lock server of a cluster for a key owned by another lock server.
+    # moving is True while the key is being transferred to its new owner, in which case the client should retry shortly.
+    def __init__(self, error_message: str, moving: bool = False):
+        super().__init__(error_message)
+        self.moving = moving
+
+class WriteAheadLogException(Exception):
+    # Raised when changes cannot be written to the write-ahead log, so they will not survive a restart.
+    def __init__(self, error_message: str):
+        super().__init__(error_message)
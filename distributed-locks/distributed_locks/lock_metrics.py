@@ -0,0 +1,105 @@
+"""
+This module provides the contention and hold-time statistics kept by the lock manager.
+Every lock shard has its own LockMetrics, updated under the shard's mutex, so recording a statistic never
+waits for another lock. The shards' metrics are merged when they are read.
+"""
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Upper bounds in seconds of the histogram buckets. Values above the last bound go into an overflow bucket.
+HISTOGRAM_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 600, 3600)
+
+COUNTERS = ("attempts", "acquired", "renewed", "conflicts", "takeovers", "expired", "released", "wait_timeouts")
+
+
+class Histogram:
+    def __init__(self, bounds: Tuple[float, ...] = HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def merge(self, other: "Histogram"):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.total += other.total
+
+    def quantile(self, q: float) -> Optional[float]:
+        # Upper bound of the bucket holding the q-th quantile. Returns None if it is in the overflow bucket.
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return None if self.counts[-1] else 0.0
+
+    def to_dict(self) -> dict:
+        buckets = {str(bound): count for bound, count in zip(self.bounds, self.counts)}
+        buckets["+Inf"] = self.counts[-1]
+        return {"count": self.count, "sum": self.total, "avg": self.total / self.count if self.count else 0.0,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99), "buckets": buckets}
+
+
+class HeavyHitters:
+    # Finds the most frequent keys in a stream in fixed memory, using the Misra-Gries algorithm.
+    # Keeps at most capacity counters. When a key without a counter arrives and all are in use, every counter is
+    # decremented and those reaching zero are dropped. Counts are lower bounds, off by at most total / (capacity + 1),
+    # and any key seen more often than that is guaranteed to have a counter. Each update is O(1) amortized.
+    def __init__(self, capacity: int = 64):
+        self.capacity = capacity
+        self.counters: Dict[str, int] = {}
+
+    def add(self, key: str):
+        counters = self.counters
+        if key in counters:
+            counters[key] += 1
+        elif len(counters) < self.capacity:
+            counters[key] = 1
+        else:
+            for counted in list(counters):
+                if counters[counted] == 1:
+                    del counters[counted]
+                else:
+                    counters[counted] -= 1
+
+
+class LockMetrics:
+    def __init__(self, sketch_capacity: int = 64):
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.hold_times = Histogram() # Seconds from acquiring a lock to releasing it or it expiring
+        self.wait_times = Histogram() # Seconds clients waited in the queue for a lock
+        self.hot_keys = HeavyHitters(sketch_capacity) # Keys with the most acquire attempts
+        self.contended_keys = HeavyHitters(sketch_capacity) # Keys with the most conflicts
+
+    def record_attempt(self, key: str):
+        self.counters["attempts"] += 1
+        self.hot_keys.add(key)
+
+    def record_conflict(self, key: str):
+        self.counters["conflicts"] += 1
+        self.contended_keys.add(key)
+
+
+def merge_metrics(shard_metrics: Iterable[LockMetrics], top_k: int = 10) -> dict:
+    # Combine the metrics of all shards. Every key lives in one shard, so the shards' sketches are merged by union.
+    counters = dict.fromkeys(COUNTERS, 0)
+    hold_times, wait_times = Histogram(), Histogram()
+    hot_keys, contended_keys = {}, {}
+    for metrics in shard_metrics:
+        for name, value in metrics.counters.items():
+            counters[name] += value
+        hold_times.merge(metrics.hold_times)
+        wait_times.merge(metrics.wait_times)
+        hot_keys.update(metrics.hot_keys.counters)
+        contended_keys.update(metrics.contended_keys.counters)
+
+    def top(counts: Dict[str, int]) -> List[dict]:
+        return [{"key": key, "count": count} for key, count in sorted(counts.items(), key=lambda item: -item[1])[:top_k]]
+
+    return {"counters": counters, "hold_times": hold_times.to_dict(), "wait_times": wait_times.to_dict(),
+            "hot_keys": top(hot_keys), "contended_keys": top(contended_keys)}
@@ -1,62 +1,970 @@
 """
 This class manages unique lock objects in a distributed system.
 It ensures that locks are created, retrieved, and deleted properly.
+The lock table is partitioned into shards, each with its own mutex, so that operations on a key are atomic
+and operations on keys in different shards do not wait for each other.
 """
-from datetime import datetime, timedelta, timezone
+from key_index import SortedKeyIndex
 from lock import Lock
-from typing import Dict, Optional
-from lock_exceptions import LockAlreadyHeldException
+from lock_metrics import LockMetrics, merge_metrics
+from lock_ring import LockRing
+from lock_wal import WriteAheadLog
+from session import Session
+from shared_lock import ReadWriteLock, Semaphore
+from typing import Deque, Dict, Iterator, List, Optional, Tuple
+from lock_exceptions import LockAlreadyHeldException, LockBatchException, LockNotOwnedException, SessionExpiredException
+from collections import deque
+from contextlib import ExitStack
+import copy
+import gc
+import heapq
+import itertools
 import logging
+import threading
+import time
+import uuid
 
 logging.basicConfig(filename='distributed_locks.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 
-class LockObjectManager:
-    def __init__(self):
+class LockWaiter:
+    # A client blocked in acquire_lock waiting for a held lock.
+    __slots__ = ("client_id", "expiry", "session", "event", "lock", "enqueue_time")
+
+    def __init__(self, client_id: str, expiry: int, session: Optional[Session] = None):
+        self.client_id = client_id
+        self.expiry = expiry # TTL of the lock once it is handed to this waiter
+        self.session = session # Session the lock is acquired under, if any
+        self.event = threading.Event() # Set when the lock is handed to this waiter
+        self.lock: Optional[Lock] = None
+        self.enqueue_time = time.monotonic()
+
+
+class LockShard:
+    # One partition of the lock table. All access to locks and expiry_heap must hold the mutex.
+    def __init__(self, fencing_tokens: Iterator[int], wal: Optional[WriteAheadLog] = None):
+        self.mutex = threading.Lock()
+        self.fencing_tokens = fencing_tokens # Shared by all shards of the lock manager
+        self.wal = wal # Write-ahead log shared by all shards, if locks are persisted
         self.locks: Dict[str, Lock] = {}  # Dictionary to hold lock objects
+        self.key_index = SortedKeyIndex() # Keys of locks in sorted order, for listing locks page by page
+        # Min-heap of (deadline, sequence, key) ordered by expiry so the cleaner only looks at expired locks.
+        # Entries are invalidated lazily: renewing or releasing a lock leaves its old entry behind,
+        # which is skipped when popped because the deadline no longer matches the lock.
+        self.expiry_heap: List[tuple] = []
+        self.heap_sequence = itertools.count() # Tie breaker so keys are never compared
+        # FIFO queue of waiters per held key. When the lock is released or expires it is handed to the first waiter.
+        self.waiters: Dict[str, Deque[LockWaiter]] = {}
+        self.wait_stats: Dict[str, dict] = {} # Wait counts and times per key that ever had a waiter
+        self.metrics = LockMetrics() # Contention and hold-time statistics of this shard's locks
+        # Read/write locks and semaphores. They are separate from the exclusive locks, so the same key can be used
+        # for an exclusive lock, a read/write lock and a semaphore without them affecting each other.
+        # Each of their holders is indexed in shared_heap as (deadline, sequence, key, client_id, table).
+        self.rw_locks: Dict[str, ReadWriteLock] = {}
+        self.semaphores: Dict[str, Semaphore] = {}
+        self.shared_heap: List[tuple] = []
+
+    def schedule_expiry(self, lock: Lock):
+        # Index the lock by its current deadline. Locks held by a session expire with the session instead.
+        if lock.session is not None:
+            return
+        heapq.heappush(self.expiry_heap, (lock.deadline, next(self.heap_sequence), lock.key))
+        # Rebuild the heap if stale entries from renewals and releases start to dominate it.
+        if len(self.expiry_heap) > 2 * len(self.locks) + 1024:
+            self.expiry_heap = [(lock.deadline, next(self.heap_sequence), key) for key, lock in self.locks.items() if lock.session is None]
+            heapq.heapify(self.expiry_heap)
+
+    def pop_expired(self, now: float) -> List[Lock]:
+        # Remove and return the locks in this shard whose deadline has passed.
+        expired_locks = []
+        while self.expiry_heap and self.expiry_heap[0][0] < now:
+            deadline, _, key = heapq.heappop(self.expiry_heap)
+            lock = self.locks.get(key)
+            if lock is None or lock.deadline != deadline or lock.session is not None:
+                continue # Stale entry: the lock was released, renewed or taken over by a session
+            logger.debug("Removing expired lock with key: %s held by client: %s", key, lock.client_id)
+            self.remove_lock(key)
+            self.record_release(lock, now)
+            expired_locks.append(lock)
+            self.grant_next_waiter(key)
+        return expired_locks
+
+    def schedule_shared_expiry(self, table: Dict[str, object], key: str, client_id: Optional[str], deadline: float):
+        # Index a holder of a read/write lock or semaphore by its deadline. Stale entries are skipped like for locks.
+        # Entries without a client only check whether the lock can be dropped.
+        heapq.heappush(self.shared_heap, (deadline, next(self.heap_sequence), key, client_id, table))
+
+    def pop_expired_shared(self, now: float) -> List[tuple]:
+        # Remove holders of read/write locks and semaphores whose deadline has passed.
+        # Returns (key, client_id) for each removed holder.
+        expired = []
+        while self.shared_heap and self.shared_heap[0][0] < now:
+            deadline, _, key, client_id, table = heapq.heappop(self.shared_heap)
+            shared_lock = table.get(key)
+            if shared_lock is None:
+                continue
+            if client_id is not None:
+                if not shared_lock.expire_holder(client_id, deadline):
+                    continue # Stale entry: the holder released or renewed
+                logger.debug("Removing expired holder: %s of shared lock with key: %s", client_id, key)
+                expired.append((key, client_id))
+            self.discard_if_free(table, key, now)
+        return expired
+
+    def discard_if_free(self, table: Dict[str, object], key: str, now: float):
+        # Drop a read/write lock or semaphore nobody holds any more.
+        shared_lock = table[key]
+        if shared_lock.is_free(now):
+            del table[key]
+        elif isinstance(shared_lock, ReadWriteLock) and shared_lock.writer is None and not shared_lock.readers:
+            # Only refused writers are left. Check again once they stop keeping readers out.
+            self.schedule_shared_expiry(table, key, None, shared_lock.get_intent_deadline())
+
+    def add_shared(self, table: Dict[str, object], shared_lock, now: float):
+        # Add a read/write lock or semaphore restored from the log or moved from another lock server,
+        # and index its holders by deadline. A lock whose holders all expired is not added.
+        holders = shared_lock.get_holders()
+        if not holders:
+            return
+        table[shared_lock.key] = shared_lock
+        for client_id, deadline in holders.items():
+            self.schedule_shared_expiry(table, shared_lock.key, client_id, deadline)
+
+    def add_lock(self, lock: Lock):
+        self.locks[lock.key] = lock
+        self.key_index.add(lock.key)
+
+    def remove_lock(self, key: str) -> Lock:
+        # Remove a lock from the table and from the session holding it.
+        lock = self.locks.pop(key)
+        self.key_index.discard(key)
+        if lock.session is not None:
+            lock.session.detach(key)
+        if self.wal is not None:
+            self.wal.append(["R", key])
+        return lock
+
+    def remove_expired_lock(self, lock: Lock, now: float):
+        # Remove a lock its holder let expire, so it can be handed to another client.
+        self.remove_lock(lock.key)
+        self.record_release(lock, now)
+        self.metrics.counters["takeovers"] += 1
+
+    def record_release(self, lock: Lock, now: float, deadline: Optional[float] = None):
+        # Count a holder losing its lock and record how long it was held. A lock that expired was held until its deadline.
+        deadline = lock.get_deadline() if deadline is None else deadline
+        self.metrics.counters["expired" if now > deadline else "released"] += 1
+        self.metrics.hold_times.observe(min(now, deadline) - lock.acquired_at)
+
+    def log_lock(self, lock: Lock):
+        # Record the new state of a lock in the write-ahead log. Must be called with the mutex held
+        # so records for a key are logged in the order the changes were made.
+        if self.wal is not None:
+            if lock.session is None:
+                wall_deadline = time.time() + (lock.deadline - time.monotonic())
+                self.wal.append(["L", lock.key, lock.client_id, lock.expiry, lock.token, wall_deadline, None])
+            else:
+                self.wal.append(["L", lock.key, lock.client_id, lock.expiry, lock.token, None, lock.session.session_id])
+
+    def log_rw_lock(self, key: str):
+        # Record the holders of a read/write lock in the write-ahead log, or that it has none.
+        # Must be called with the mutex held. Holders removed by the cleaner are not logged,
+        # they are dropped on recovery as their deadline has passed.
+        if self.wal is not None:
+            rw_lock = self.rw_locks.get(key)
+            state = rw_lock.to_record(time.time() - time.monotonic()) if rw_lock is not None else [None, None, {}]
+            self.wal.append(["W", key] + state)
+
+    def log_semaphore(self, key: str):
+        # Record the holders of a semaphore in the write-ahead log, or that it has none.
+        if self.wal is not None:
+            semaphore = self.semaphores.get(key)
+            state = semaphore.to_record(time.time() - time.monotonic()) if semaphore is not None else [None, {}]
+            self.wal.append(["M", key] + state)
+
+    def grant_next_waiter(self, key: str) -> Optional[Lock]:
+        # Hand a free lock to the first waiter in the queue and wake it up.
+        queue = self.waiters.get(key)
+        while queue:
+            waiter = queue.popleft()
+            if not queue:
+                del self.waiters[key]
+            if waiter.session is not None and not waiter.session.attach(key):
+                # The waiter's session expired while it was waiting. Wake it up without the lock.
+                waiter.event.set()
+                continue
+            lock = Lock(key, waiter.client_id, waiter.expiry, waiter.session, next(self.fencing_tokens))
+            self.add_lock(lock)
+            self.schedule_expiry(lock)
+            self.log_lock(lock)
+            self.metrics.counters["acquired"] += 1
+            self.record_wait(key, time.monotonic() - waiter.enqueue_time)
+            logger.debug("Handing lock with key: %s to waiting client: %s", key, waiter.client_id)
+            waiter.lock = lock
+            waiter.event.set()
+            return lock
+        return None
+
+    def record_wait(self, key: str, wait_time: float, timed_out: bool = False):
+        stats = self.wait_stats.get(key)
+        if stats is None:
+            stats = self.wait_stats[key] = {"waits": 0, "timeouts": 0, "total_wait_time": 0.0, "max_wait_time": 0.0}
+        stats["waits"] += 1
+        stats["timeouts"] += timed_out
+        stats["total_wait_time"] += wait_time
+        stats["max_wait_time"] = max(stats["max_wait_time"], wait_time)
+        self.metrics.wait_times.observe(wait_time)
+        if timed_out:
+            self.metrics.counters["wait_timeouts"] += 1
+            self.metrics.record_conflict(key)
 
-    def acquire_lock(self, key: str, client_id: str, expiry: int) -> Lock:
+
+class LockObjectManager:
+    def __init__(self, num_shards: int = 16, wal: Optional[WriteAheadLog] = None):
+        # Fencing tokens come from one counter for the whole lock table. A token is only ever handed out once,
+        # so tokens increase for every key without keeping a counter for each key that was ever locked.
+        self.fencing_tokens = itertools.count(1)
+        # Changes are logged to the write-ahead log, if one is given, so the lock table can be recovered after a restart.
+        self.wal = wal
+        self.shards = [LockShard(self.fencing_tokens, wal) for _ in range(num_shards)]
+        # Client sessions. A heartbeat only moves the session's deadline, so it costs the same however many locks
+        # the session holds. Sessions are indexed by deadline in a min-heap like the locks, and an entry whose session
+        # has since been extended is pushed back with the new deadline when it is popped.
+        self.sessions: Dict[str, Session] = {}
+        self.session_heap: List[tuple] = []
+        self.session_sequence = itertools.count()
+        self.sessions_mutex = threading.Lock() # Guards sessions and session_heap
+        # When the lock server is part of a cluster, the ring decides which keys it owns. While keys are moved
+        # between lock servers, pending_ring is the ring being moved to and keys changing owner are not served.
+        # Ownership is checked under the shard mutex, so no change can slip in while a shard's locks are exported.
+        self.server_name: Optional[str] = None
+        self.ring: Optional[LockRing] = None
+        self.pending_ring: Optional[LockRing] = None
+
+    def _get_shard(self, key: str) -> LockShard:
+        return self.shards[hash(key) % len(self.shards)]
+
+    def _lock_shards(self, keys: List[str], stack: ExitStack) -> None:
+        # Take the mutexes of all shards holding these keys. Shards are always locked in the same order
+        # so that two batch operations can never deadlock each other.
+        for shard_no in sorted({hash(key) % len(self.shards) for key in keys}):
+            stack.enter_context(self.shards[shard_no].mutex)
+
+    def acquire_lock(self, key: str, client_id: str, expiry: int, wait_timeout: float = 0, session_id: Optional[str] = None) -> Lock:
+        # Acquire or renew a lock. If the lock is held by another client and wait_timeout is set, wait up to
+        # wait_timeout seconds in a FIFO queue for the lock to be released or expire.
+        # Locks acquired under a session are kept alive by the session's heartbeats and expiry is ignored.
         logger.debug("Attempting to acquire lock with key: %s for client: %s with expiry %s", key, client_id, expiry)
+        session = self.get_session(session_id, client_id) if session_id is not None else None
+        shard = self._get_shard(key)
+        with shard.mutex:
+            shard.metrics.record_attempt(key)
+            try:
+                lock = self._acquire_in_shard(shard, key, client_id, expiry, session)
+            except LockAlreadyHeldException:
+                if not wait_timeout:
+                    shard.metrics.record_conflict(key)
+                    raise
+                lock = None
+            if lock is None:
+                waiter = LockWaiter(client_id, expiry, session)
+                shard.waiters.setdefault(key, deque()).append(waiter)
+                logger.debug("Client: %s waiting for lock with key: %s behind %d other waiters", client_id, key, len(shard.waiters[key]) - 1)
+        if lock is None:
+            lock = self._wait_for_lock(shard, key, waiter, wait_timeout)
+        self._commit()
+        return lock
+
+    def _commit(self):
+        # Wait for the changes made so far to be written to the write-ahead log.
+        # Called after releasing the shard mutexes so that concurrent requests are committed together.
+        if self.wal is not None:
+            self.wal.commit()
+
+    def _wait_for_lock(self, shard: LockShard, key: str, waiter: LockWaiter, wait_timeout: float) -> Lock:
+        # Block until the lock is handed to the waiter or the wait times out.
+        # Releases and expiries found by the cleaner hand the lock over directly. The waiter also wakes up
+        # when the current holder's lock expires, so handoff on expiry does not wait for the next cleanup.
+        give_up_at = time.monotonic() + wait_timeout
+        while True:
+            with shard.mutex:
+                lock = shard.locks.get(key)
+                until_expiry = lock.get_deadline() - time.monotonic() if lock is not None else 0
+            if waiter.event.wait(max(0, min(give_up_at - time.monotonic(), until_expiry))):
+                return self._handed_lock(waiter)
+            with shard.mutex:
+                if waiter.event.is_set():
+                    return self._handed_lock(waiter)
+                lock = shard.locks.get(key)
+                queue = shard.waiters[key]
+                if (lock is None or lock.get_status() == "expired") and queue[0] is waiter:
+                    # The holder's lock has expired and we are first in line
+                    if lock is not None:
+                        shard.remove_expired_lock(lock, time.monotonic())
+                    shard.grant_next_waiter(key)
+                    return self._handed_lock(waiter)
+                if time.monotonic() >= give_up_at:
+                    queue.remove(waiter)
+                    if not queue:
+                        del shard.waiters[key]
+                    elif lock is None or lock.get_status() == "expired":
+                        # We were first in line for a free lock, so pass it on to the next waiter
+                        if lock is not None:
+                            shard.remove_expired_lock(lock, time.monotonic())
+                        shard.grant_next_waiter(key)
+                    shard.record_wait(key, time.monotonic() - waiter.enqueue_time, timed_out=True)
+                    logger.debug("Client: %s timed out waiting for lock with key: %s", waiter.client_id, key)
+                    raise LockAlreadyHeldException(f"Timed out after {wait_timeout} seconds waiting for lock {key}")
+
+    def _handed_lock(self, waiter: LockWaiter) -> Lock:
+        if waiter.lock is None:
+            if waiter.session is not None and waiter.session.closed:
+                raise SessionExpiredException(f"Session {waiter.session.session_id} expired while waiting for the lock")
+            raise LockNotOwnedException("The lock moved to another lock server while waiting for it", moving=True)
+        return waiter.lock
+
+    def _check_owner(self, key: str):
+        # Raises a LockNotOwnedException if the key belongs to another lock server of the cluster.
+        if self.ring is None:
+            return
+        if self.ring.get_server(key) != self.server_name:
+            raise LockNotOwnedException(f"Lock with key {key} is owned by another lock server")
+        if self.pending_ring is not None and self.pending_ring.get_server(key) != self.server_name:
+            raise LockNotOwnedException(f"Lock with key {key} is moving to another lock server", moving=True)
+
+    def _owns(self, key: str) -> bool:
+        try:
+            self._check_owner(key)
+            return True
+        except LockNotOwnedException:
+            return False
+
+    def _acquire_in_shard(self, shard: LockShard, key: str, client_id: str, expiry: int, session: Optional[Session] = None) -> Lock:
+        # Acquire or renew a lock. The caller must hold the shard's mutex.
+        self._check_owner(key)
+        lock = shard.locks.get(key)
+        if lock is not None and lock.client_id != client_id and lock.get_status() == "expired" and key in shard.waiters:
+            # Clients waiting in the queue get an expired lock before new clients.
+            shard.remove_expired_lock(lock, time.monotonic())
+            waiter_lock = shard.grant_next_waiter(key)
+            if waiter_lock is not None:
+                logger.debug("Expired lock with key: %s handed to waiting client: %s", key, waiter_lock.client_id)
+                raise LockAlreadyHeldException(f"Lock is already held by another client {waiter_lock.client_id}")
+            # The sessions of all the waiters had expired, so the lock is free for the caller.
+            lock = None
         # Create a new lock object and store it in the dictionary.
-        if key not in self.locks: 
+        if lock is None:
             logger.debug("Creating new lock with key: %s for client: %s", key, client_id)
-            lock = Lock(key, client_id, expiry)
-            self.locks[key] = lock
-            return lock
-        elif self.locks[key].client_id == client_id:
+            lock = Lock(key, client_id, expiry, token=next(self.fencing_tokens))
+            shard.add_lock(lock)
+            shard.metrics.counters["acquired"] += 1
+        elif lock.client_id == client_id:
             # If the lock already exists and is held by the same client, renew it.
             logger.debug("Renewing lock with key: %s for client: %s", key, client_id)
-            self.locks[key].reset_start_time()
-            return self.locks[key]
-        elif self.locks[key].get_status() == "expired":
+            lock.reset_start_time()
+            shard.metrics.counters["renewed"] += 1
+        elif lock.get_status() == "expired":
             # If the lock has expired, allow a new client to acquire it.
             logger.debug("Acquiring expired lock with key: %s for new client: %s", key, client_id)
-            self.locks[key].client_id = client_id
-            self.locks[key].reset_start_time()
-            return self.locks[key]
+            shard.record_release(lock, time.monotonic())
+            shard.metrics.counters["takeovers"] += 1
+            shard.metrics.counters["acquired"] += 1
+            lock.client_id = client_id
+            lock.token = next(self.fencing_tokens)
+            lock.reset_start_time()
+            lock.acquired_at = time.monotonic()
         else:
-            logger.error("Lock with key: %s is already held by another client: %s", key, self.locks[key].client_id)
-            raise LockAlreadyHeldException(f"Lock is already held by another client {self.locks[key].client_id}")
-                        
+            logger.error("Lock with key: %s is already held by another client: %s", key, lock.client_id)
+            raise LockAlreadyHeldException(f"Lock is already held by another client {lock.client_id}")
+        if lock.session is not session:
+            # Move the lock to the session it is now held under
+            if lock.session is not None:
+                lock.session.detach(key)
+            lock.session = None
+            if session is not None:
+                if not session.attach(key):
+                    shard.remove_lock(key)
+                    shard.grant_next_waiter(key)
+                    raise SessionExpiredException(f"Session {session.session_id} has expired")
+                lock.session = session
+        shard.schedule_expiry(lock)
+        shard.log_lock(lock)
+        return lock
+
+    def acquire_locks(self, keys: List[str], client_id: str, expiry: int, session_id: Optional[str] = None) -> Dict[str, Lock]:
+        # Acquire a set of locks all-or-nothing. Keys are handled in sorted order.
+        # Raises a LockBatchException with the result for each key if any of them is held by another client.
+        session = self.get_session(session_id, client_id) if session_id is not None else None
+        keys = sorted(set(keys))
+        logger.debug("Attempting to acquire locks with keys: %s for client: %s with expiry %s", keys, client_id, expiry)
+        with ExitStack() as stack:
+            self._lock_shards(keys, stack)
+            for key in keys:
+                self._check_owner(key)
+            results = {}
+            for key in keys:
+                shard = self._get_shard(key)
+                shard.metrics.record_attempt(key)
+                lock = shard.locks.get(key)
+                # Expired locks with clients waiting for them are kept for the waiters
+                if lock is None or lock.client_id == client_id or (lock.get_status() == "expired" and key not in shard.waiters):
+                    results[key] = "available"
+                else:
+                    results[key] = f"held by another client {lock.client_id}"
+                    shard.metrics.record_conflict(key)
+            if any(result != "available" for result in results.values()):
+                logger.error("Could not acquire all locks with keys: %s for client: %s: %s", keys, client_id, results)
+                raise LockBatchException("One or more locks are already held by another client", results)
+            locks = {key: self._acquire_in_shard(self._get_shard(key), key, client_id, expiry, session) for key in keys}
+        self._commit()
+        return locks
+
+    def renew_locks(self, keys: List[str], client_id: str) -> Dict[str, str]:
+        # Renew every lock in the list held by the client. Returns the result for each key.
+        results = {}
+        for key in sorted(set(keys)):
+            shard = self._get_shard(key)
+            with shard.mutex:
+                lock = shard.locks.get(key)
+                if not self._owns(key):
+                    results[key] = "not owned"
+                elif lock is None:
+                    results[key] = "not found"
+                elif lock.client_id != client_id:
+                    results[key] = f"held by another client {lock.client_id}"
+                else:
+                    lock.reset_start_time()
+                    shard.schedule_expiry(lock)
+                    shard.log_lock(lock)
+                    shard.metrics.counters["renewed"] += 1
+                    results[key] = "renewed"
+        self._commit()
+        return results
+
     def get_lock(self, key: str) -> Optional[Lock]:
         # Retrieve a lock object by its key.
         logger.info("Retrieving lock with key: %s", key)
-        return self.locks.get(key)
-    
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            return shard.locks.get(key)
+
+    def validate_token(self, key: str, token: int) -> bool:
+        # True if the token belongs to the client currently holding the lock.
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            lock = shard.locks.get(key)
+            return lock is not None and lock.token == token and lock.get_status() == "locked"
+
     def get_locks(self) -> Dict[str, Lock]:
-        # Retrieve all lock objects: Only used for debugging purposes.
+        # Retrieve a copy of all lock objects: Only used for debugging purposes.
         logger.debug("Retrieving all locks.")
-        return self.locks
+        locks = {}
+        for shard in self.shards:
+            with shard.mutex:
+                locks.update(shard.locks)
+        return locks
+
+    def get_lock_count(self) -> int:
+        return sum(len(shard.locks) for shard in self.shards)
+
+    def list_locks(self, prefix: str = "", cursor: Optional[str] = None, limit: int = 100) -> Tuple[List[Lock], Optional[str]]:
+        # One page of locks whose key starts with prefix, in key order, after the cursor key.
+        # Returns the locks and the cursor for the next page, or None after the last page.
+        # The shards' keys are merged in order, reading a small batch from a shard's index whenever
+        # the merge runs out of its keys. Each shard's mutex is only held while reading one batch.
+        batch_size = limit // len(self.shards) + 16
+        merged = heapq.merge(*(self._iter_shard_locks(shard, prefix, cursor, batch_size) for shard in self.shards),
+                             key=lambda lock: lock.key)
+        locks = list(itertools.islice(merged, limit))
+        next_cursor = locks[-1].key if len(locks) == limit else None
+        return locks, next_cursor
+
+    def _iter_shard_locks(self, shard: LockShard, prefix: str, cursor: Optional[str], batch_size: int) -> Iterator[Lock]:
+        while True:
+            with shard.mutex:
+                keys = shard.key_index.page(prefix, cursor, batch_size)
+                locks = [shard.locks[key] for key in keys]
+            yield from locks
+            if len(keys) < batch_size:
+                return
+            cursor = keys[-1]
+
+    def count_locks(self, prefix: str = "", batch_size: int = 1000) -> Dict[str, int]:
+        # Number of locks by status whose key starts with prefix. Keys are counted in batches,
+        # releasing the shard's mutex between batches so acquires and releases are not held up.
+        counts = {"locked": 0, "expired": 0, "session": 0}
+        for shard in self.shards:
+            cursor = None
+            while True:
+                with shard.mutex:
+                    keys = shard.key_index.page(prefix, cursor, batch_size)
+                    for key in keys:
+                        lock = shard.locks[key]
+                        counts[lock.get_status()] += 1
+                        counts["session"] += lock.session is not None
+                if len(keys) < batch_size:
+                    break
+                cursor = keys[-1]
+        counts["total"] = counts["locked"] + counts["expired"]
+        return counts
 
     def delete_lock(self, key: str, client_id: str) -> bool:
         # Delete a lock object by its key. Returns False if not found.
+        released = self._delete_lock(key, client_id)
+        self._commit()
+        return released
+
+    def _delete_lock(self, key: str, client_id: str) -> bool:
         logger.info("Deleting lock with key: %s and client_id: %s", key, client_id)
-        if key in self.locks:
-            if self.locks[key].client_id != client_id:
-                logger.error("Client %s attempted to release lock %s held by client %s", client_id, key, self.locks[key].client_id)
-                raise LockAlreadyHeldException(f"Lock with key {key} is held by another client {self.locks[key].client_id}")
-            del self.locks[key]
-            return True
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            lock = shard.locks.get(key)
+            if lock is not None:
+                if lock.client_id != client_id:
+                    logger.error("Client %s attempted to release lock %s held by client %s", client_id, key, lock.client_id)
+                    raise LockAlreadyHeldException(f"Lock with key {key} is held by another client {lock.client_id}")
+                shard.remove_lock(key)
+                shard.record_release(lock, time.monotonic())
+                shard.grant_next_waiter(key)
+                return True
         logger.error("Lock with key: %s not found for deletion", key)
-        return False    
+        return False
+
+    def delete_locks(self, keys: List[str], client_id: str) -> Dict[str, str]:
+        # Release every lock in the list held by the client. Returns the result for each key.
+        results = {}
+        for key in sorted(set(keys)):
+            try:
+                results[key] = "released" if self._delete_lock(key, client_id) else "not found"
+            except LockAlreadyHeldException as e:
+                results[key] = str(e)
+            except LockNotOwnedException:
+                results[key] = "not owned"
+        self._commit()
+        return results
+
+    def pop_expired_locks(self, now: Optional[float] = None) -> List[Lock]:
+        # Remove and return all locks whose deadline (on the monotonic clock) has passed.
+        # Shards are swept one at a time so the other shards keep serving requests.
+        now = time.monotonic() if now is None else now
+        expired_locks = []
+        for shard in self.shards:
+            with shard.mutex:
+                expired_locks.extend(shard.pop_expired(now))
+        return expired_locks
+
+    def get_metrics(self, top_k: int = 10) -> dict:
+        # Contention and hold-time statistics since the lock server started, with the top_k hottest
+        # and most contended keys. The shards' statistics are copied one shard at a time.
+        shard_metrics = []
+        for shard in self.shards:
+            with shard.mutex:
+                shard_metrics.append(copy.deepcopy(shard.metrics))
+        metrics = merge_metrics(shard_metrics, top_k)
+        metrics["lock_count"] = self.get_lock_count()
+        metrics["session_count"] = len(self.sessions)
+        return metrics
+
+    def get_wait_stats(self, key: Optional[str] = None) -> Dict[str, dict]:
+        # Current queue depth and wait times for one key, or for every key that has had waiters.
+        shards = [self._get_shard(key)] if key is not None else self.shards
+        stats = {}
+        for shard in shards:
+            with shard.mutex:
+                keys = [key] if key is not None else set(shard.wait_stats) | set(shard.waiters)
+                for stats_key in keys:
+                    key_stats = dict(shard.wait_stats.get(stats_key, {"waits": 0, "timeouts": 0, "total_wait_time": 0.0, "max_wait_time": 0.0}))
+                    key_stats["queue_depth"] = len(shard.waiters.get(stats_key, ()))
+                    key_stats["avg_wait_time"] = key_stats["total_wait_time"] / key_stats["waits"] if key_stats["waits"] else 0.0
+                    stats[stats_key] = key_stats
+        return stats
+
+    # Read/write lock and semaphore related methods
+
+    def acquire_read_lock(self, key: str, client_id: str, expiry: int) -> float:
+        # Acquire or renew a read lock. Any number of clients can hold the read lock at once.
+        # Returns the deadline on the monotonic clock.
+        return self._acquire_shared(key, lambda rw_lock, now: rw_lock.acquire_read(client_id, expiry, now), client_id)
+
+    def acquire_write_lock(self, key: str, client_id: str, expiry: int) -> float:
+        # Acquire or renew the write lock, or upgrade the client's read lock if no one else reads.
+        # Returns the deadline on the monotonic clock.
+        return self._acquire_shared(key, lambda rw_lock, now: rw_lock.acquire_write(client_id, expiry, now), client_id)
+
+    def _acquire_shared(self, key: str, acquire, client_id: str) -> float:
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            rw_lock = shard.rw_locks.get(key)
+            if rw_lock is None:
+                rw_lock = shard.rw_locks[key] = ReadWriteLock(key)
+            now = time.monotonic()
+            try:
+                deadline = acquire(rw_lock, now)
+            except LockAlreadyHeldException:
+                logger.debug("Client: %s refused read/write lock with key: %s", client_id, key)
+                shard.discard_if_free(shard.rw_locks, key, now)
+                raise
+            shard.schedule_shared_expiry(shard.rw_locks, key, client_id, deadline)
+            shard.log_rw_lock(key)
+        self._commit()
+        return deadline
+
+    def release_rw_lock(self, key: str, client_id: str) -> bool:
+        # Release the read or write lock held by the client. Returns False if it held neither.
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            rw_lock = shard.rw_locks.get(key)
+            if rw_lock is None or not rw_lock.release(client_id):
+                return False
+            shard.discard_if_free(shard.rw_locks, key, time.monotonic())
+            shard.log_rw_lock(key)
+        self._commit()
+        return True
+
+    def get_rw_lock_status(self, key: str) -> Optional[dict]:
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            rw_lock = shard.rw_locks.get(key)
+            return rw_lock.get_status(time.monotonic()) if rw_lock is not None else None
+
+    def acquire_semaphore(self, key: str, client_id: str, expiry: int, permits: int) -> float:
+        # Acquire or renew one of the semaphore's permits. The first client to acquire the semaphore sets the
+        # number of permits, and it is fixed until no one holds it. Returns the deadline on the monotonic clock.
+        if permits < 1:
+            raise ValueError("permits must be at least 1")
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            semaphore = shard.semaphores.get(key)
+            if semaphore is None:
+                semaphore = shard.semaphores[key] = Semaphore(key, permits)
+            elif semaphore.permits != permits:
+                raise ValueError(f"Semaphore {key} has {semaphore.permits} permits, not {permits}")
+            try:
+                deadline = semaphore.acquire(client_id, expiry, time.monotonic())
+            except LockAlreadyHeldException:
+                logger.debug("Client: %s refused semaphore with key: %s", client_id, key)
+                raise
+            shard.schedule_shared_expiry(shard.semaphores, key, client_id, deadline)
+            shard.log_semaphore(key)
+        self._commit()
+        return deadline
+
+    def release_semaphore(self, key: str, client_id: str) -> bool:
+        # Release the client's permit. Returns False if it held none.
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            semaphore = shard.semaphores.get(key)
+            if semaphore is None or not semaphore.release(client_id):
+                return False
+            shard.discard_if_free(shard.semaphores, key, time.monotonic())
+            shard.log_semaphore(key)
+        self._commit()
+        return True
+
+    def get_semaphore_status(self, key: str) -> Optional[dict]:
+        shard = self._get_shard(key)
+        with shard.mutex:
+            self._check_owner(key)
+            semaphore = shard.semaphores.get(key)
+            return semaphore.get_status(time.monotonic()) if semaphore is not None else None
+
+    def pop_expired_shared_locks(self, now: Optional[float] = None) -> List[tuple]:
+        # Remove holders of read/write locks and semaphores whose deadline has passed.
+        # Returns (key, client_id) for each removed holder.
+        now = time.monotonic() if now is None else now
+        expired = []
+        for shard in self.shards:
+            with shard.mutex:
+                expired.extend(shard.pop_expired_shared(now))
+        return expired
+
+    # Session related methods
+
+    def create_session(self, client_id: str, ttl: int) -> Session:
+        session = Session(uuid.uuid4().hex, client_id, ttl)
+        with self.sessions_mutex:
+            self.sessions[session.session_id] = session
+            heapq.heappush(self.session_heap, (session.deadline, next(self.session_sequence), session.session_id))
+        self._log_session(session)
+        self._commit()
+        logger.debug("Created session: %s for client: %s with ttl %s", session.session_id, client_id, ttl)
+        return session
+
+    def _log_session(self, session: Session):
+        if self.wal is not None:
+            with session.mutex:
+                wall_deadline = time.time() + (session.deadline - time.monotonic())
+                self.wal.append(["S", session.session_id, session.client_id, session.ttl, wall_deadline])
+
+    def get_session(self, session_id: str, client_id: Optional[str] = None) -> Session:
+        # Retrieve an active session. Raises a SessionExpiredException if it has expired or belongs to another client.
+        session = self.sessions.get(session_id)
+        if session is None or session.get_status() == "expired":
+            raise SessionExpiredException(f"Session {session_id} not found or expired")
+        if client_id is not None and session.client_id != client_id:
+            raise SessionExpiredException(f"Session {session_id} belongs to another client {session.client_id}")
+        return session
+
+    def heartbeat(self, session_id: str, client_id: Optional[str] = None) -> Session:
+        # Extend the session and every lock it holds in one step.
+        session = self.get_session(session_id, client_id)
+        session.heartbeat()
+        self._log_session(session)
+        self._commit()
+        return session
+
+    def close_session(self, session_id: str, client_id: Optional[str] = None) -> List[str]:
+        # Close the session and release all its locks. Returns the released keys.
+        session = self.get_session(session_id, client_id)
+        with self.sessions_mutex:
+            self.sessions.pop(session_id, None)
+        logger.debug("Closing session: %s for client: %s", session_id, session.client_id)
+        released = self._release_session(session)
+        self._commit()
+        return released
+
+    def _release_session(self, session: Session) -> List[str]:
+        released = []
+        # The session's locks were held until now if it is closed, or until its deadline if it expired
+        now, deadline = time.monotonic(), session.deadline
+        keys = session.close()
+        if self.wal is not None:
+            self.wal.append(["C", session.session_id])
+        for key in keys:
+            shard = self._get_shard(key)
+            with shard.mutex:
+                lock = shard.locks.get(key)
+                if lock is not None and lock.session is session:
+                    shard.remove_lock(key)
+                    shard.record_release(lock, now, deadline)
+                    shard.grant_next_waiter(key)
+                    released.append(key)
+        return released
+
+    def pop_expired_sessions(self, now: Optional[float] = None) -> Dict[str, List[str]]:
+        # Remove sessions whose deadline has passed and release their locks in bulk.
+        # Returns the released keys for each expired session.
+        now = time.monotonic() if now is None else now
+        expired_sessions = []
+        with self.sessions_mutex:
+            while self.session_heap and self.session_heap[0][0] < now:
+                _, _, session_id = heapq.heappop(self.session_heap)
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue # The session was closed
+                if session.deadline >= now:
+                    # Extended by heartbeats since it was indexed
+                    heapq.heappush(self.session_heap, (session.deadline, next(self.session_sequence), session_id))
+                    continue
+                del self.sessions[session_id]
+                expired_sessions.append(session)
+        released = {}
+        for session in expired_sessions:
+            logger.debug("Session: %s for client: %s expired", session.session_id, session.client_id)
+            released[session.session_id] = self._release_session(session)
+        return released
+
+    # Persistence related methods
+
+    def take_snapshot(self):
+        # Write a snapshot of all locks and sessions and drop the log segments it covers.
+        # The snapshot is taken shard by shard while requests continue. Log records are full states, so
+        # replaying records from the new segment that are already reflected in the snapshot is harmless.
+        segment = self.wal.rotate()
+        now, wall_now = time.monotonic(), time.time()
+        with self.sessions_mutex:
+            sessions = list(self.sessions.values())
+        snapshot_sessions = [[session.session_id, session.client_id, session.ttl, wall_now + session.deadline - now]
+                             for session in sessions if not session.closed]
+        snapshot_locks, snapshot_rw_locks, snapshot_semaphores = [], [], []
+        for shard in self.shards:
+            with shard.mutex:
+                for lock in shard.locks.values():
+                    if lock.session is None:
+                        snapshot_locks.append([lock.key, lock.client_id, lock.expiry, lock.token, wall_now + lock.deadline - now, None])
+                    else:
+                        snapshot_locks.append([lock.key, lock.client_id, lock.expiry, lock.token, None, lock.session.session_id])
+                snapshot_rw_locks.extend([key] + rw_lock.to_record(wall_now - now) for key, rw_lock in shard.rw_locks.items())
+                snapshot_semaphores.extend([key] + semaphore.to_record(wall_now - now) for key, semaphore in shard.semaphores.items())
+        # Read last so the snapshot's counter is past every token in it
+        next_token = next(self.fencing_tokens)
+        self.wal.write_snapshot({"next_token": next_token, "sessions": snapshot_sessions, "locks": snapshot_locks,
+                                 "rw_locks": snapshot_rw_locks, "semaphores": snapshot_semaphores}, segment)
+
+    def recover(self, compact: bool = True) -> int:
+        # Rebuild the lock table from the last snapshot and the write-ahead log. Must be called before serving requests.
+        # Deadlines are re-derived on the monotonic clock from the persisted wall-clock deadlines,
+        # and locks and sessions that expired while the service was down are dropped.
+        # Returns the number of locks recovered.
+        start = time.perf_counter()
+        # Recovery allocates millions of objects that all survive. Pause the garbage collector
+        # so it does not repeatedly scan them, which otherwise dominates recovery time.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            restored = self._restore()
+        finally:
+            if gc_enabled:
+                gc.enable()
+        logger.info("Recovered %d locks and %d sessions in %.3f seconds", restored, len(self.sessions), time.perf_counter() - start)
+        if compact:
+            # Snapshot right away so the next recovery does not replay the same log again
+            self.take_snapshot()
+        return restored
+
+    def _restore(self) -> int:
+        snapshot, records = self.wal.load()
+        sessions, locks, rw_locks, semaphores, next_token = {}, {}, {}, {}, 1
+        if snapshot:
+            next_token = snapshot["next_token"]
+            sessions = {session[0]: session[1:] for session in snapshot["sessions"]}
+            locks = {lock[0]: lock[1:] for lock in snapshot["locks"]}
+            # Snapshots taken before read/write locks and semaphores were persisted have neither
+            rw_locks = {rw_lock[0]: rw_lock[1:] for rw_lock in snapshot.get("rw_locks", [])}
+            semaphores = {semaphore[0]: semaphore[1:] for semaphore in snapshot.get("semaphores", [])}
+        for record in records:
+            op = record[0]
+            if op == "L":
+                locks[record[1]] = record[2:]
+                next_token = max(next_token, record[4] + 1)
+            elif op == "R":
+                locks.pop(record[1], None)
+            elif op == "S":
+                sessions[record[1]] = record[2:]
+            elif op == "C":
+                sessions.pop(record[1], None)
+            elif op == "W":
+                rw_locks[record[1]] = record[2:]
+            elif op == "M":
+                semaphores[record[1]] = record[2:]
+
+        now, wall_now = time.monotonic(), time.time()
+        self.fencing_tokens = itertools.count(next_token)
+        with self.sessions_mutex:
+            for session_id, (client_id, ttl, wall_deadline) in sessions.items():
+                if wall_deadline > wall_now:
+                    session = Session(session_id, client_id, ttl)
+                    session.deadline = now + wall_deadline - wall_now
+                    self.sessions[session_id] = session
+                    heapq.heappush(self.session_heap, (session.deadline, next(self.session_sequence), session_id))
+        restored = 0
+        for shard in self.shards:
+            shard.fencing_tokens = self.fencing_tokens
+        # Nothing else runs during recovery, so fill the shards directly and build each expiry heap in one go
+        for key, (client_id, expiry, token, wall_deadline, session_id) in locks.items():
+            if session_id is not None:
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue # The session expired or was closed
+                lock = Lock(key, client_id, expiry, session, token)
+                session.keys.add(key)
+            elif wall_deadline > wall_now:
+                lock = Lock(key, client_id, expiry, token=token)
+                lock.deadline = now + wall_deadline - wall_now
+            else:
+                continue
+            shard = self._get_shard(key)
+            shard.locks[key] = lock
+            if session_id is None:
+                shard.expiry_heap.append((lock.deadline, next(shard.heap_sequence), key))
+            restored += 1
+        for shard in self.shards:
+            heapq.heapify(shard.expiry_heap)
+            shard.key_index = SortedKeyIndex(shard.locks)
+        # Locks whose last record has no holders, or whose holders all expired, are not added
+        for key, record in rw_locks.items():
+            shard = self._get_shard(key)
+            shard.add_shared(shard.rw_locks, ReadWriteLock.from_record(key, record, now - wall_now, now), now)
+        for key, record in semaphores.items():
+            if record[0] is not None:
+                shard = self._get_shard(key)
+                shard.add_shared(shard.semaphores, Semaphore.from_record(key, record, now - wall_now, now), now)
+        return restored
+
+    # Cluster related methods. Used by the lock cluster to move keys when lock servers are added or removed
+
+    def set_ring(self, ring: LockRing, server_name: str):
+        self.server_name = server_name
+        self.ring = ring
+        self.pending_ring = None
+
+    def prepare_ring(self, ring: LockRing):
+        # Stop serving keys that change owner in the new ring until the move is committed.
+        self.pending_ring = ring
+
+    def commit_ring(self):
+        self.ring, self.pending_ring = self.pending_ring, None
+
+    def export_locks(self) -> dict:
+        # Remove and return the locks this server loses in the pending ring, with their remaining TTL.
+        # Clients waiting for those locks are woken up and told to retry with the new owner.
+        # Also returns the next fencing token, so the new owner never hands out a smaller token for a moved key.
+        now = time.monotonic()
+        exported, exported_rw_locks, exported_semaphores = [], [], []
+        for shard in self.shards:
+            with shard.mutex:
+                for key in [key for key in shard.locks if self.pending_ring.get_server(key) != self.server_name]:
+                    lock = shard.remove_lock(key)
+                    remaining = lock.get_deadline() - now
+                    if remaining > 0:
+                        exported.append([key, lock.client_id, lock.expiry, lock.token, remaining])
+                for key in [key for key in shard.waiters if self.pending_ring.get_server(key) != self.server_name]:
+                    for waiter in shard.waiters.pop(key):
+                        waiter.event.set()
+                # Holders of read/write locks and semaphores move with their remaining TTL too
+                for key in [key for key in shard.rw_locks if self.pending_ring.get_server(key) != self.server_name]:
+                    exported_rw_locks.append([key] + shard.rw_locks.pop(key).to_record(-now))
+                    shard.log_rw_lock(key)
+                for key in [key for key in shard.semaphores if self.pending_ring.get_server(key) != self.server_name]:
+                    exported_semaphores.append([key] + shard.semaphores.pop(key).to_record(-now))
+                    shard.log_semaphore(key)
+        self._commit()
+        logger.info("Exported %d locks, %d read/write locks and %d semaphores moving to other lock servers",
+                    len(exported), len(exported_rw_locks), len(exported_semaphores))
+        return {"locks": exported, "rw_locks": exported_rw_locks, "semaphores": exported_semaphores, "next_token": next(self.fencing_tokens)}
+
+    def import_locks(self, locks: List[list], next_token: int, rw_locks: List[list] = (), semaphores: List[list] = ()):
+        # Add locks moved from another lock server. Locks held under a session on the old server become plain TTL locks.
+        self.advance_fencing_tokens(next_token)
+        now = time.monotonic()
+        for key, client_id, expiry, token, remaining in locks:
+            shard = self._get_shard(key)
+            with shard.mutex:
+                lock = Lock(key, client_id, expiry, token=token)
+                lock.deadline = now + remaining
+                shard.add_lock(lock)
+                shard.schedule_expiry(lock)
+                shard.log_lock(lock)
+        for key, *record in rw_locks:
+            shard = self._get_shard(key)
+            with shard.mutex:
+                shard.add_shared(shard.rw_locks, ReadWriteLock.from_record(key, record, now, now), now)
+                shard.log_rw_lock(key)
+        for key, *record in semaphores:
+            shard = self._get_shard(key)
+            with shard.mutex:
+                shard.add_shared(shard.semaphores, Semaphore.from_record(key, record, now, now), now)
+                shard.log_semaphore(key)
+        self._commit()
+        logger.info("Imported %d locks, %d read/write locks and %d semaphores from another lock server",
+                    len(locks), len(rw_locks), len(semaphores))
+
+    def advance_fencing_tokens(self, next_token: int):
+        # Make sure every token handed out from now on is at least next_token.
+        # Tokens are only drawn under a shard mutex, so holding all of them makes the swap atomic.
+        with ExitStack() as stack:
+            for shard in self.shards:
+                stack.enter_context(shard.mutex)
+            self.fencing_tokens = itertools.count(max(next(self.fencing_tokens), next_token))
+            for shard in self.shards:
+                shard.fencing_tokens = self.fencing_tokens
+
@@ -0,0 +1,46 @@
+"""
+Placement of lock keys across the lock servers of a cluster.
+Uses the same consistent hashing as the project's ConsistentHashingRing: every server is placed on the ring
+at the MD5 hash of "<server>-<i>" for each of its virtual nodes, and a key belongs to the first virtual node
+clockwise from the key's hash. Adding or removing a server only moves the keys next to its virtual nodes.
+"""
+from typing import Dict, List
+import bisect
+import hashlib
+
+
+class LockRing:
+    def __init__(self, servers: Dict[str, str], replication_factor: int = 8, version: int = 0):
+        self.servers = dict(servers) # Map of server name to the URL of its lock server
+        self.replication_factor = replication_factor # Virtual nodes per server
+        self.version = version # Incremented by the cluster on every topology change
+        self.virtual_node_map = {} # Map of virtual node hashes to server names
+        for server in self.servers:
+            for i in range(replication_factor):
+                self.virtual_node_map[self._get_hash_key(f"{server}-{i}")] = server
+        self.sorted_keys = sorted(self.virtual_node_map) # Sorted list of hash keys
+
+    def _get_hash_key(self, key: str) -> int:
+        ''' Returns a hash value for the given key using MD5 '''
+        return int(hashlib.md5(key.encode()).hexdigest(), 16)
+
+    def get_server(self, key: str) -> str:
+        ''' Returns the name of the server that owns the key '''
+        if not self.sorted_keys:
+            raise Exception("No servers available in the hash ring")
+        index = bisect.bisect(self.sorted_keys, self._get_hash_key(key)) % len(self.sorted_keys)
+        return self.virtual_node_map[self.sorted_keys[index]]
+
+    def group_by_server(self, keys: List[str]) -> Dict[str, List[str]]:
+        ''' Splits a list of keys by the server that owns them '''
+        groups = {}
+        for key in keys:
+            groups.setdefault(self.get_server(key), []).append(key)
+        return groups
+
+    def to_dict(self) -> dict:
+        return {"version": self.version, "replication_factor": self.replication_factor, "servers": self.servers}
+
+    @classmethod
+    def from_dict(cls, topology: dict) -> "LockRing":
+        return cls(topology["servers"], topology["replication_factor"], topology["version"])
@@ -0,0 +1,48 @@
+"""
+This module provides a client session that owns a set of locks.
+Locks acquired under a session have no TTL of their own. They stay held as long as the session is kept alive
+with heartbeats, and are all released together when the session expires or is closed.
+"""
+import threading
+import time
+
+class Session:
+    __slots__ = ("session_id", "client_id", "ttl", "deadline", "keys", "closed", "mutex")
+
+    def __init__(self, session_id: str, client_id: str, ttl: int):
+        self.session_id = session_id # Unique identifier for the session
+        self.client_id = client_id # Identifier for the client that owns the session
+        self.ttl = ttl # Session time-to-live (TTL) in seconds, restarted by every heartbeat
+        self.deadline = time.monotonic() + ttl # Time on the monotonic clock after which the session is expired
+        self.keys = set() # Keys of the locks held by the session
+        self.closed = False # Set once the session's locks are being released. No locks can be added after that.
+        self.mutex = threading.Lock() # Guards keys and closed
+
+    def __str__(self):
+        return f"Session(session_id={self.session_id}, client_id={self.client_id}, ttl={self.ttl}, locks={len(self.keys)}, status={self.get_status()})"
+
+    def heartbeat(self):
+        # Extend the session, and with it every lock held by the session.
+        self.deadline = time.monotonic() + self.ttl
+
+    def get_status(self) -> str:
+        return "expired" if self.closed or time.monotonic() > self.deadline else "active"
+
+    def attach(self, key: str) -> bool:
+        # Record a lock held by the session. Returns False if the session has been closed.
+        with self.mutex:
+            if self.closed:
+                return False
+            self.keys.add(key)
+            return True
+
+    def detach(self, key: str):
+        with self.mutex:
+            self.keys.discard(key)
+
+    def close(self) -> list:
+        # Close the session and return the keys of its locks so they can be released.
+        with self.mutex:
+            self.closed = True
+            self.deadline = 0
+            return list(self.keys)
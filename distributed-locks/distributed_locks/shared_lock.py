@@ -0,0 +1,172 @@
+"""
+This module provides locks that can be held by several clients at once: read/write locks and counting semaphores.
+Every holder has its own deadline on the monotonic clock, so one holder expiring does not affect the others.
+Expired holders are ignored by every check, and removed by the expired lock cleaner or when they get in the way.
+Holders are persisted and moved between lock servers as records whose deadlines are shifted by an offset,
+to wall-clock time for the write-ahead log or to the remaining TTL when a key moves to another lock server.
+"""
+from typing import Dict, Optional
+from lock_exceptions import LockAlreadyHeldException
+
+# Seconds a refused writer keeps new readers out. A writer that retries within this time keeps its place,
+# a writer that gave up stops blocking readers soon after.
+WRITER_INTENT_TTL = 1.0
+
+
+class ReadWriteLock:
+    # Held by any number of readers or by a single writer. Writers are preferred: once a writer has been refused
+    # because of readers, new readers are refused until it gets the lock, so a stream of readers cannot starve it.
+    __slots__ = ("key", "readers", "writer", "writer_deadline", "waiting_writers")
+
+    def __init__(self, key: str):
+        self.key = key # Unique identifier for the lock
+        self.readers: Dict[str, float] = {} # Deadline of each reader
+        self.writer: Optional[str] = None # Client holding the write lock
+        self.writer_deadline = 0.0
+        self.waiting_writers: Dict[str, float] = {} # Writers refused because of readers, until when they keep readers out
+
+    def _prune_readers(self, now: float):
+        for client_id in [client_id for client_id, deadline in self.readers.items() if now > deadline]:
+            del self.readers[client_id]
+
+    def _has_writer(self, now: float) -> bool:
+        return self.writer is not None and now <= self.writer_deadline
+
+    def _writer_waiting(self, client_id: str, now: float) -> bool:
+        return any(now <= until for waiting, until in self.waiting_writers.items() if waiting != client_id)
+
+    def acquire_read(self, client_id: str, expiry: float, now: float) -> float:
+        # Acquire or renew a read lock. The writer downgrades to a reader. Returns the deadline.
+        if self._has_writer(now) and self.writer != client_id:
+            raise LockAlreadyHeldException(f"Write lock is held by another client {self.writer}")
+        if client_id not in self.readers and self.writer != client_id and self._writer_waiting(client_id, now):
+            raise LockAlreadyHeldException("A writer is waiting for the lock")
+        if self.writer == client_id:
+            self.writer = None
+        self.waiting_writers.pop(client_id, None) # Reading instead, so no longer waiting to write
+        self.readers[client_id] = now + expiry
+        return self.readers[client_id]
+
+    def acquire_write(self, client_id: str, expiry: float, now: float) -> float:
+        # Acquire or renew the write lock. A reader upgrades to the writer if it is the only reader.
+        # Returns the deadline.
+        if self._has_writer(now) and self.writer != client_id:
+            raise LockAlreadyHeldException(f"Write lock is held by another client {self.writer}")
+        self._prune_readers(now)
+        if any(reader != client_id for reader in self.readers):
+            if client_id in self.readers and any(waiting in self.readers for waiting in self.waiting_writers if waiting != client_id):
+                # Two readers waiting for each other to upgrade would never get the lock
+                raise LockAlreadyHeldException("Another reader is already upgrading. Release the read lock and retry.")
+            for waiting in [waiting for waiting, until in self.waiting_writers.items() if now > until]:
+                del self.waiting_writers[waiting]
+            self.waiting_writers[client_id] = now + WRITER_INTENT_TTL
+            raise LockAlreadyHeldException(f"Read lock is held by {len(self.readers)} clients")
+        self.readers.pop(client_id, None)
+        self.waiting_writers.pop(client_id, None)
+        self.writer = client_id
+        self.writer_deadline = now + expiry
+        return self.writer_deadline
+
+    def release(self, client_id: str) -> bool:
+        # Release the read or write lock held by the client. Returns False if it held neither.
+        self.waiting_writers.pop(client_id, None)
+        if self.writer == client_id:
+            self.writer = None
+            return True
+        return self.readers.pop(client_id, None) is not None
+
+    def expire_holder(self, client_id: str, deadline: float) -> bool:
+        # Remove a holder if it still has this deadline, i.e. it has not renewed or re-acquired since.
+        if self.writer == client_id and self.writer_deadline == deadline:
+            self.writer = None
+            return True
+        if self.readers.get(client_id) == deadline:
+            del self.readers[client_id]
+            return True
+        return False
+
+    def get_intent_deadline(self) -> float:
+        # Time until which refused writers keep new readers out
+        return max(self.waiting_writers.values(), default=0.0)
+
+    def is_free(self, now: float) -> bool:
+        return self.writer is None and not self.readers and not any(now <= until for until in self.waiting_writers.values())
+
+    def get_holders(self) -> Dict[str, float]:
+        # Deadline of every holder, the writer included
+        holders = dict(self.readers)
+        if self.writer is not None:
+            holders[self.writer] = self.writer_deadline
+        return holders
+
+    def to_record(self, offset: float) -> list:
+        # [writer, writer deadline, reader deadlines] with every deadline shifted by offset.
+        # Refused writers only keep readers out for a moment, so they are left out.
+        writer_deadline = self.writer_deadline + offset if self.writer is not None else None
+        return [self.writer, writer_deadline, {client_id: deadline + offset for client_id, deadline in self.readers.items()}]
+
+    @classmethod
+    def from_record(cls, key: str, record: list, offset: float, now: float) -> "ReadWriteLock":
+        # Rebuild a read/write lock from to_record, shifting deadlines back by offset and dropping expired holders
+        writer, writer_deadline, readers = record
+        rw_lock = cls(key)
+        if writer is not None and writer_deadline + offset >= now:
+            rw_lock.writer = writer
+            rw_lock.writer_deadline = writer_deadline + offset
+        rw_lock.readers = {client_id: deadline + offset for client_id, deadline in readers.items() if deadline + offset >= now}
+        return rw_lock
+
+    def get_status(self, now: float) -> dict:
+        self._prune_readers(now)
+        return {"writer": self.writer if self._has_writer(now) else None, "readers": list(self.readers),
+                "waiting_writers": [client_id for client_id, until in self.waiting_writers.items() if now <= until]}
+
+
+class Semaphore:
+    # Held by up to permits clients at once.
+    __slots__ = ("key", "permits", "holders")
+
+    def __init__(self, key: str, permits: int):
+        self.key = key # Unique identifier for the semaphore
+        self.permits = permits # Maximum number of concurrent holders
+        self.holders: Dict[str, float] = {} # Deadline of each holder
+
+    def acquire(self, client_id: str, expiry: float, now: float) -> float:
+        # Acquire or renew a permit. Returns the deadline.
+        if client_id not in self.holders and len(self.holders) >= self.permits:
+            for holder in [holder for holder, deadline in self.holders.items() if now > deadline]:
+                del self.holders[holder]
+            if len(self.holders) >= self.permits:
+                raise LockAlreadyHeldException(f"All {self.permits} permits are held")
+        self.holders[client_id] = now + expiry
+        return self.holders[client_id]
+
+    def release(self, client_id: str) -> bool:
+        return self.holders.pop(client_id, None) is not None
+
+    def expire_holder(self, client_id: str, deadline: float) -> bool:
+        if self.holders.get(client_id) == deadline:
+            del self.holders[client_id]
+            return True
+        return False
+
+    def is_free(self, now: float) -> bool:
+        return not self.holders
+
+    def get_holders(self) -> Dict[str, float]:
+        return dict(self.holders)
+
+    def to_record(self, offset: float) -> list:
+        # [permits, holder deadlines] with every deadline shifted by offset
+        return [self.permits, {client_id: deadline + offset for client_id, deadline in self.holders.items()}]
+
+    @classmethod
+    def from_record(cls, key: str, record: list, offset: float, now: float) -> "Semaphore":
+        permits, holders = record
+        semaphore = cls(key, permits)
+        semaphore.holders = {client_id: deadline + offset for client_id, deadline in holders.items() if deadline + offset >= now}
+        return semaphore
+
+    def get_status(self, now: float) -> dict:
+        holders = [holder for holder, deadline in self.holders.items() if now <= deadline]
+        return {"permits": self.permits, "holders": holders, "available": self.permits - len(holders)}
@@ -3,32 +3,106 @@ Ephemeral node implementation for managing ephemeral nodes in a distributed syst
 """
 
 from datetime import datetime, timezone
+from typing import Dict, Iterator, Optional
+from session import Session
+import time
 
 class EphemeralNode:
-    def __init__(self, path: str, client_id: str, session_expiry: int, seq_num: int = 0, is_parent: bool = False):
-        self.path = path
+    # Slotted so that trees with millions of nodes stay compact
+    __slots__ = ("name", "parent", "client_id", "creation_time", "session_expiry", "deadline", "session", "seq_num",
+                 "is_parent", "version", "children", "head", "tail", "prev_node", "next_node")
+
+    def __init__(self, path: Optional[str], client_id: str, session_expiry: int, seq_num: int = 0, is_parent: bool = False,
+                 session: Optional[Session] = None, parent: Optional["EphemeralNode"] = None):
+        # Full path of a parent node. Sequence nodes hold a reference to their parent instead and derive their path
+        # from it, so their path string is not stored.
+        self.name = path
+        self.parent = parent
         self.client_id = client_id
         self.creation_time = None  # Set to current time when node is the current lock owner
         self.session_expiry = session_expiry  # Session expiry time in seconds
-        self.seq_num = seq_num # For parent nodes this value is incremented for each child node created.
+        self.deadline = None # Time on the monotonic clock after which the lock owner's node is expired
+        self.session = session # Session owning the node, if any. The node then lives as long as the session.
+        self.seq_num = seq_num # For parent nodes, the sequence number of the last child node created.
         self.is_parent = is_parent # Flag to indicate if this node is a parent node
+        # Incremented when a parent node's children change and when a sequence node becomes the lock owner.
+        # Checked by multi-op transactions to make sure a node has not changed since the client read it.
+        self.version = 0
+        # Parent nodes index their sequence nodes by sequence number. The children are also linked to their neighbours
+        # in sequence order, so the first child and each child's predecessor, the node a waiting client watches,
+        # are found in O(1).
+        self.children: Optional[Dict[int, EphemeralNode]] = {} if is_parent else None
+        self.head: Optional[EphemeralNode] = None # First child, which owns the lock. Only used for parent nodes.
+        self.tail: Optional[EphemeralNode] = None # Last child. Only used for parent nodes.
+        self.prev_node: Optional[EphemeralNode] = None # Sibling with the next smaller sequence number
+        self.next_node: Optional[EphemeralNode] = None # Sibling with the next larger sequence number
+
+    @property
+    def path(self) -> str:
+        return self.name if self.parent is None else f"{self.parent.name}/{self.seq_num}"
 
     def __str__(self):
-        return f"EphemeralNode(path={self.path}, client_id={self.client_id}, creation_time={self.creation_time}, session_expiry={self.session_expiry}, seq_num={self.seq_num}, is_parent={self.is_parent})"
-    
-    def increment_seq_num(self):
-        # Only used for parent nodes to track child nodes.
-        self.seq_num += 1
+        return f"EphemeralNode(path={self.path}, client_id={self.client_id}, creation_time={self.creation_time}, session_expiry={self.session_expiry}, seq_num={self.seq_num}, is_parent={self.is_parent}, session_id={self.session.session_id if self.session else None})"
 
     def is_parent_node(self) -> bool:
         return self.is_parent
-    
-    def is_expired(self, current_time: datetime) -> bool:
-        # Check if the ephemeral node has expired based on session expiry time.
-        if self.creation_time is None:
+
+    def add_child(self, node: "EphemeralNode"):
+        # Only used for parent nodes. Children are added in increasing sequence order.
+        self.insert_child(node, self.tail)
+
+    def insert_child(self, node: "EphemeralNode", prev_node: Optional["EphemeralNode"]):
+        # Only used for parent nodes. Links the child in after prev_node, or first if prev_node is None.
+        self.children[node.seq_num] = node
+        self.version += 1
+        node.prev_node = prev_node
+        node.next_node = self.head if prev_node is None else prev_node.next_node
+        if prev_node is None:
+            self.head = node
+        else:
+            prev_node.next_node = node
+        if node.next_node is None:
+            self.tail = node
+        else:
+            node.next_node.prev_node = node
+
+    def remove_child(self, seq_num: int):
+        # Only used for parent nodes. Unlinks the child from its neighbours.
+        node = self.children.pop(seq_num)
+        self.version += 1
+        if node.prev_node is None:
+            self.head = node.next_node
+        else:
+            node.prev_node.next_node = node.next_node
+        if node.next_node is None:
+            self.tail = node.prev_node
+        else:
+            node.next_node.prev_node = node.prev_node
+        node.prev_node = node.next_node = None
+
+    def first_child(self) -> Optional["EphemeralNode"]:
+        # The child with the smallest sequence number, which owns the lock.
+        return self.head
+
+    def iter_children(self) -> Iterator["EphemeralNode"]:
+        # The children in sequence order
+        node = self.head
+        while node is not None:
+            yield node
+            node = node.next_node
+
+    def has_children(self) -> bool:
+        return bool(self.children)
+
+    def is_expired(self, now: float) -> bool:
+        # Check if the ephemeral node has expired based on session expiry time, given the time on the monotonic clock.
+        # Nodes owned by a session expire with the session instead.
+        if self.deadline is None or self.session is not None:
             return False
-        return (current_time - self.creation_time).total_seconds() > self.session_expiry
-    
-    #  Resets the creation time to current time when the node becomes the lock owner
+        return now > self.deadline
+
+    #  Resets the creation time to current time when the node becomes the lock owner, which starts its expiry
     def reset_creation_time(self):
-        self.creation_time = datetime.now(timezone.utc)
\ No newline at end of file
+        self.creation_time = datetime.now(timezone.utc)
+        if self.session is None:
+            self.deadline = time.monotonic() + self.session_expiry
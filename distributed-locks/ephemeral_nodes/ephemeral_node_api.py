@@ -5,9 +5,12 @@ API for managing ephemeral nodes in a distributed system.
 from ephemeral_node_manager import EphemeralNodeManager
 from expired_lock_cleaner import ExpiredLockCleaner
 from ephemeral_node import EphemeralNode
+from node_exceptions import MultiOpException, SessionExpiredException, TransactionLogException
+from node_wal import SnapshotWriter, TransactionLog
 from datetime import datetime, timezone
 from typing import Optional
 import logging
+import os
 from flask import Flask, request, jsonify
 import time
 
@@ -15,10 +18,28 @@ import time
 app = Flask(__name__)
 logging.basicConfig(filename='distributed_locks.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
-node_manager = EphemeralNodeManager()
-expired_lock_cleaner = ExpiredLockCleaner(node_manager=node_manager, cleanup_interval=10)
+
+# Nodes are persisted to a transaction log in NODE_DATA_DIR and recovered on startup. Set it to an empty string to keep nodes in memory only.
+NODE_DATA_DIR = os.environ.get("NODE_DATA_DIR", "node_data")
+FSYNC_POLICY = os.environ.get("FSYNC_POLICY", "always") # always, interval or none
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 60)) # Seconds between snapshots of the node tree
+
+wal = TransactionLog(NODE_DATA_DIR, fsync_policy=FSYNC_POLICY) if NODE_DATA_DIR else None
+node_manager = EphemeralNodeManager(wal=wal)
+if wal is not None:
+    node_manager.recover()
+    snapshot_writer = SnapshotWriter(node_manager, snapshot_interval=SNAPSHOT_INTERVAL)
+    snapshot_writer.start()
+# A cleanup pass only touches expired nodes, so it can run every second and hand expired locks over sooner
+expired_lock_cleaner = ExpiredLockCleaner(node_manager=node_manager, cleanup_interval=1)
 expired_lock_cleaner.start()
 
+@app.errorhandler(TransactionLogException)
+def transaction_log_failed(e):
+    # The change was made in memory but could not be persisted, so it would be lost on a restart.
+    logger.error("Request failed as the transaction log could not be written - %s", str(e))
+    return {"status": "error", "message": str(e)}, 503
+
 # API Endpoint to Create Ephemeral Node
 @app.route("/create_node", methods=["POST"])
 def create_node():
@@ -27,13 +48,20 @@ def create_node():
     path = data.get("path")
     client_id = data.get("client_id")
     expiry = data.get("expiry")
+    # Optional. Nodes created under a session live until the session expires or is closed, and expiry is ignored.
+    session_id = data.get("session_id")
+    if not path or not client_id:
+        return {"status": "error", "message": "Missing required parameters: path, client_id"}, 400
+    if session_id is None and not node_manager.is_valid_expiry(expiry):
+        return {"status": "error", "message": "expiry must be a positive number of seconds unless session_id is given"}, 400
     try:
-        child_path = node_manager.create_node(path, client_id, expiry)
-        if child_path:
-            node = node_manager.get_node(child_path)
-            return {"status": "success", "node_path": node.path, "client_id": node.client_id}, 200
-        else:
-            return {"status": "error", "message": "Failed to create node."}, 400
+        # Also returns whether the new node owns the lock and the node it waits for otherwise
+        node_info = node_manager.create_lock_node(path, client_id, expiry, session_id)
+        return dict(node_info, status="success"), 200
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
+    except TransactionLogException:
+        raise
     except Exception as e:
         return {"status": "error", "message": str(e)}, 400
     
@@ -48,6 +76,8 @@ def delete_node():
             return {"status": "success", "message": f"Node at path {path} deleted."}, 200
         else:
             return {"status": "error", "message": f"Node at path {path} not found."}, 404
+    except TransactionLogException:
+        raise
     except Exception as e:
         return {"status": "error", "message": str(e)}, 400
     
@@ -79,7 +109,89 @@ def current_lock_owner():
         return {"status": "success", "current_lock_owner": owner}, 200
     else:
         return {"status": "error", "message": f"No lock owner found for path {path}."}, 404
-    
+
+# API Endpoint to Run Several Operations Atomically. Takes a list of create, delete, check and get_children operations
+# and applies all of them or none, in one round trip.
+@app.route("/multi", methods=["POST"])
+def multi():
+    data = request.json
+    if not isinstance(data.get("ops"), list):
+        return {"status": "error", "message": "Missing required parameter: ops"}, 400
+    try:
+        results = node_manager.multi(data.get("ops"))
+        return {"status": "success", "results": results}, 200
+    except MultiOpException as e:
+        return {"status": "error", "message": str(e), "failed_op": e.index}, 409
+
+# API Endpoint to Create a Session. Nodes created with its session_id live until the session expires or is closed.
+@app.route("/create_session", methods=["POST"])
+def create_session():
+    data = request.json
+    if not "client_id" in data or not "ttl" in data:
+        return {"status": "error", "message": "Missing required parameters: client_id, ttl"}, 400
+    if not node_manager.is_valid_expiry(data.get("ttl")):
+        return {"status": "error", "message": "ttl must be a positive number of seconds"}, 400
+    session = node_manager.create_session(data.get("client_id"), data.get("ttl"))
+    return {"status": "success", "session_id": session.session_id, "ttl": session.ttl}, 200
+
+# API Endpoint to Extend a Session and every node it owns with a single call
+@app.route("/heartbeat", methods=["POST"])
+def heartbeat():
+    data = request.json
+    if not "session_id" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: session_id, client_id"}, 400
+    try:
+        session = node_manager.heartbeat(data.get("session_id"), data.get("client_id"))
+        return {"status": "success", "session_id": session.session_id, "node_count": len(session.nodes)}, 200
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
+
+# API Endpoint to Close a Session and delete all its nodes
+@app.route("/close_session", methods=["POST"])
+def close_session():
+    data = request.json
+    if not "session_id" in data or not "client_id" in data:
+        return {"status": "error", "message": "Missing required parameters: session_id, client_id"}, 400
+    try:
+        paths = node_manager.close_session(data.get("session_id"), data.get("client_id"))
+        return {"status": "success", "deleted": paths}, 200
+    except SessionExpiredException as e:
+        return {"status": "error", "message": str(e)}, 410
+
+# API Endpoint to Watch a Node. Long-polls until the node is deleted or expires, or timeout seconds pass.
+@app.route("/watch_node", methods=["POST"])
+def watch_node():
+    data = request.json
+    if not "path" in data or not "timeout" in data:
+        return {"status": "error", "message": "Missing required parameters: path, timeout"}, 400
+    if not node_manager.is_valid_timeout(data.get("timeout")):
+        return {"status": "error", "message": "timeout must be a number of seconds, 0 or more"}, 400
+    path = data.get("path")
+    logger.info("Received request to watch node at path %s", path)
+    if node_manager.wait_for_deletion(path, data.get("timeout")):
+        return {"status": "success", "event": "deleted", "node_path": path}, 200
+    return {"status": "success", "event": None, "node_path": path}, 200
+
+# API Endpoint to Wait for a Lock. Long-polls until the client's sequence node owns the lock, watching only the node
+# before it, so a release wakes the next waiter alone.
+@app.route("/wait_for_lock", methods=["POST"])
+def wait_for_lock():
+    data = request.json
+    if not "path" in data or not "timeout" in data:
+        return {"status": "error", "message": "Missing required parameters: path, timeout"}, 400
+    if not node_manager.is_valid_timeout(data.get("timeout")):
+        return {"status": "error", "message": "timeout must be a number of seconds, 0 or more"}, 400
+    path = data.get("path")
+    logger.info("Received request to wait for lock with node at path %s", path)
+    if node_manager.wait_for_ownership(path, data.get("timeout")):
+        node = node_manager.get_node(path)
+        if node is not None:
+            return {"status": "success", "node_path": path, "current_lock_owner": node.client_id}, 200
+    if node_manager.get_node(path) is None:
+        return {"status": "error", "message": f"Node at path {path} not found."}, 404
+    return {"status": "error", "message": f"Node at path {path} does not own the lock yet.",
+            "predecessor": node_manager.get_predecessor(path)}, 409
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=6001)
 
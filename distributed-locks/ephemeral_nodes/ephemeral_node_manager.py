@@ -1,108 +1,671 @@
 """
 Ephemeral node manager implementation for managing ephemeral nodes in a distributed system.
 Simulation of distributed locks in Zookeeper-like environment.
+Each parent node indexes its sequence nodes in sequence order, so finding the lock owner or whether
+a parent has children does not scan the other nodes. Owners' nodes are indexed by deadline for the cleaner,
+and a parent is deleted as soon as its last child is. Sequence numbers come from one counter for the whole tree,
+so a parent created again at the path of a deleted one never reissues the path of a node a stale client may still
+think it holds.
+Clients waiting for a lock watch the node just before their own, like ZooKeeper's lock recipe. Deleting
+or expiring a node wakes only the clients watching that node, so a release wakes the next waiter alone.
+Nodes can be owned by a client session instead of having their own expiry. One heartbeat keeps all of a
+session's nodes alive, and when the session expires they are deleted together and their successors promoted.
+The nodes are kept in a NodeStore, which stores each parent path once and links sequence nodes to their parent.
+If a TransactionLog is given, every change to a node or session is logged, and the tree, including the sequence
+counter, is rebuilt from the last snapshot and the log on startup.
 """
 
 from ephemeral_node import EphemeralNode
+from node_exceptions import MultiOpException, SessionExpiredException
+from node_store import NodeStore
+from node_wal import TransactionLog
+from session import Session
 from datetime import datetime, timezone
-from typing import Dict, Optional
+from typing import Callable, Dict, Iterator, List, Optional
+import gc
+import heapq
+import itertools
 import logging
+import math
+import threading
+import time
+import uuid
 
 logging.basicConfig(filename='ephemeral_node_manager.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 class EphemeralNodeManager:
-    def __init__(self):
-        self.nodes: Dict[str, EphemeralNode] = {}  # Dictionary to hold ephemeral nodes
+    def __init__(self, wal: Optional[TransactionLog] = None):
+        self.nodes = NodeStore()  # Store holding the ephemeral nodes, looked up by path
+        # Guards the nodes and the parents' child indexes, which the API threads and the cleaner update together.
+        self.mutex = threading.RLock()
+        # One-shot watches on node paths, set when the node is deleted or expires
+        self.watches: Dict[str, List[threading.Event]] = {}
+        # Lock owners' nodes indexed by deadline in a min-heap of (deadline, sequence, node), so the cleaner only
+        # pops expired nodes. Entries of deleted nodes are left in the heap and skipped when popped.
+        self.expiry_heap: List[tuple] = []
+        self.heap_sequence = itertools.count()
+        # Client sessions. A heartbeat only moves the session's deadline, so it costs the same however many nodes
+        # the session owns. Sessions are indexed by deadline in a min-heap, and an entry whose session was extended
+        # since it was pushed is pushed again with the new deadline when it reaches the top.
+        self.sessions: Dict[str, Session] = {}
+        self.session_heap: List[tuple] = []
+        self.session_sequence = itertools.count()
+        # Sequence numbers of new nodes, shared by all parents. A number is never handed out twice, also after a restart.
+        self.seq_nums = itertools.count()
+        self.wal = wal # Transaction log, if the tree is persisted
+        # Nodes changed by the current operation, logged with their new state once it completes
+        self.changed_nodes: List[EphemeralNode] = []
 
-    # Internal helper to get parent path
-    def _get_parent_path(self, path: str) -> str:
-        if '/' not in path or path == '/':
-            return ''
-        return '/'.join(path.rstrip('/').split('/')[:-1])
+    # Internal helper to get the parent node of a given parent path, if it exists
+    def _get_parent_node(self, parent_path: str) -> Optional[EphemeralNode]:
+        return self.nodes.parents.get(parent_path)
 
-    # Internal helper to get child nodes of a given parent path
+    # Internal helper to get child nodes of a given parent path, in sequence order
     def _get_child_nodes(self, parent_path: str) -> Dict[str, EphemeralNode]:
-        child_nodes = {}
-        for path, node in self.nodes.items():
-            if self._get_parent_path(path) == parent_path:
-                child_nodes[path] = node
-        return child_nodes
-    
+        parent_node = self._get_parent_node(parent_path)
+        if parent_node is None:
+            return {}
+        return {node.path: node for node in parent_node.iter_children()}
+
     def get_nodes(self) -> Dict[str, EphemeralNode]:
-        # Retrieve all ephemeral nodes: Only used internally.
+        # Retrieve a copy of all ephemeral nodes: Only used internally.
         logger.debug("Retrieving all ephemeral nodes.")
-        return self.nodes
-    
+        with self.mutex:
+            return dict(self.nodes.items())
+
     # Get current lock owner for a given parent path
     def get_current_lock_owner(self, parent_path: str) -> Optional[str]:
-        child_nodes = self._get_child_nodes(parent_path)
-        if not child_nodes: # No child nodes exist
-            return None
-        # Find the child node with the smallest sequence number
-        min_seq_node = min(child_nodes.values(), key=lambda n: n.seq_num)
-        return min_seq_node.client_id
-
-    # Create an ephemeral node
-    def create_node(self, parent_path: str, client_id: str, session_expiry: int) -> str:
+        with self.mutex:
+            parent_node = self._get_parent_node(parent_path)
+            owner_node = parent_node.first_child() if parent_node is not None else None
+            # The child node with the smallest sequence number owns the lock
+            return owner_node.client_id if owner_node is not None else None
+
+    # Get the path of the node just before the given sequence node, which a waiting client watches.
+    # Returns None if the node owns the lock or does not exist.
+    def get_predecessor(self, path: str) -> Optional[str]:
+        with self.mutex:
+            node = self.nodes.get(path)
+            if node is None or node.prev_node is None:
+                return None
+            return node.prev_node.path
+
+    # Register a one-shot watch that is set when the node at path is deleted or expires.
+    # Returns None if the node does not exist, so there is nothing to wait for.
+    def add_watch(self, path: str) -> Optional[threading.Event]:
+        with self.mutex:
+            if path not in self.nodes:
+                return None
+            watch = threading.Event()
+            self.watches.setdefault(path, []).append(watch)
+            return watch
+
+    # Drop a watch that was not triggered, e.g. because its client stopped waiting
+    def remove_watch(self, path: str, watch: threading.Event):
+        with self.mutex:
+            path_watches = self.watches.get(path)
+            if path_watches and watch in path_watches:
+                path_watches.remove(watch)
+                if not path_watches:
+                    del self.watches[path]
+
+    # Internal helper to wake the clients watching a deleted node
+    def _trigger_watches(self, path: str):
+        for watch in self.watches.pop(path, ()):
+            watch.set()
+
+    # Wait until the node at path is deleted or expires. Returns False if timeout seconds pass first.
+    def wait_for_deletion(self, path: str, timeout: float) -> bool:
+        watch = self.add_watch(path)
+        if watch is None:
+            return True
+        if watch.wait(timeout):
+            return True
+        self.remove_watch(path, watch)
+        return False
+
+    # Wait until the sequence node at path owns its lock. Returns False if timeout seconds pass first or the
+    # node is deleted. Only the predecessor is watched, so the client is woken when the node before it goes away,
+    # not on every change to the lock. If that node was itself waiting, the new predecessor is watched next.
+    def wait_for_ownership(self, path: str, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            with self.mutex:
+                node = self.nodes.get(path)
+                if node is None or node.is_parent_node():
+                    return False
+                if node.prev_node is None:
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                predecessor = node.prev_node.path
+                watch = self.add_watch(predecessor)
+            logger.debug("Node %s is waiting for its predecessor %s", path, predecessor)
+            if not watch.wait(remaining):
+                self.remove_watch(predecessor, watch)
+
+    # Create an ephemeral node. Nodes created under a session are deleted when the session expires and
+    # session_expiry is ignored.
+    def create_node(self, parent_path: str, client_id: str, session_expiry: int, session_id: Optional[str] = None) -> str:
+        with self.mutex:
+            path = self._create_or_rollback(parent_path, client_id, session_expiry, session_id).path
+            self._log_changes()
+        self._commit()
+        return path
+
+    # Create an ephemeral node and return its lock status, whether it owns the lock and the node it waits for,
+    # read in the same step so the client needs no second call.
+    def create_lock_node(self, parent_path: str, client_id: str, session_expiry: int, session_id: Optional[str] = None) -> dict:
+        with self.mutex:
+            node_info = self._get_node_info(self._create_or_rollback(parent_path, client_id, session_expiry, session_id))
+            self._log_changes()
+        self._commit()
+        return node_info
+
+    # Internal helper to create a single node, leaving the tree and the changes to log as they were if it fails
+    def _create_or_rollback(self, parent_path: str, client_id: str, session_expiry: int, session_id: Optional[str]) -> EphemeralNode:
+        undo: List[Callable] = []
+        try:
+            return self._create_node(parent_path, client_id, session_expiry, session_id, undo)
+        except Exception:
+            self._rollback(undo)
+            raise
+
+    # Whether expiry is a valid lifetime in seconds for a node that is not owned by a session, or for a session
+    @staticmethod
+    def is_valid_expiry(expiry) -> bool:
+        return isinstance(expiry, (int, float)) and not isinstance(expiry, bool) and math.isfinite(expiry) and expiry > 0
+
+    # Whether timeout is a valid number of seconds to wait for a node. A timeout of 0 does not wait.
+    @staticmethod
+    def is_valid_timeout(timeout) -> bool:
+        return isinstance(timeout, (int, float)) and not isinstance(timeout, bool) and math.isfinite(timeout) and timeout >= 0
+
+    # Internal helper to create a node. Must be called with the mutex held. If undo is given, a function
+    # restoring the previous state is appended to it before anything is changed. The arguments are checked
+    # first, so a request that fails leaves nothing behind.
+    def _create_node(self, parent_path: str, client_id: str, session_expiry: int, session_id: Optional[str] = None,
+                     undo: Optional[List[Callable]] = None) -> EphemeralNode:
         logger.debug("Creating ephemeral node at path: %s for client: %s", parent_path, client_id)
-        seq_num = 0
-        if parent_path:
-            if not parent_path in self.nodes:
-                # We create the parent node first if it does not exist.
-                logger.debug("Parent path %s does not exist. Creating parent node.", parent_path)
-                parent_node = EphemeralNode(parent_path, None, session_expiry, seq_num = 0, is_parent=True)
-                self.nodes[parent_path] = parent_node
-            else:
-                logger.debug("Parent path %s exists", parent_path)
-                # Get the current seq number for this parent path
-                parent_node = self.nodes[parent_path]
-                parent_node.increment_seq_num()
-                seq_num = parent_node.seq_num
-            path = f"{parent_path}/{seq_num}"
-            node = EphemeralNode(path, client_id, session_expiry, seq_num)
-            current_owner = self.get_current_lock_owner(parent_path)
-            if current_owner is None or current_owner == client_id:
-                node.reset_creation_time()  
-            self.nodes[path] = node
-            return path      
-        else:
+        if not parent_path:
             logger.error("Cannot create node without a valid parent path for client %s.", client_id)
             raise Exception(f"Cannot create node without a valid parent path for client {client_id}.")
+        session = self.get_session(session_id, client_id) if session_id is not None else None
+        if session is None and not self.is_valid_expiry(session_expiry):
+            # The expiry starts when the node becomes the lock owner, which may be long after it is created
+            logger.error("Invalid expiry %s for node at path %s for client %s.", session_expiry, parent_path, client_id)
+            raise ValueError(f"Expiry must be a positive number of seconds for a node without a session, not {session_expiry}.")
+        parent_node = self._get_parent_node(parent_path)
+        if parent_node is None and parent_path in self.nodes:
+            logger.error("Cannot create node under sequence node %s for client %s.", parent_path, client_id)
+            raise Exception(f"Cannot create node under sequence node {parent_path}.")
+        created_parent = parent_node is None
+        # A number handed out by a creation that is undone is skipped, which does no harm
+        seq_num = next(self.seq_nums)
+        if created_parent:
+            # We create the parent node first if it does not exist.
+            logger.debug("Parent path %s does not exist. Creating parent node.", parent_path)
+            parent_node = EphemeralNode(parent_path, None, session_expiry, seq_num=seq_num, is_parent=True)
+        else:
+            logger.debug("Parent path %s exists", parent_path)
+        parent_seq_num, parent_version = parent_node.seq_num, parent_node.version
+        node = EphemeralNode(None, client_id, session_expiry, seq_num, session=session, parent=parent_node)
+
+        if undo is not None:
+            def restore():
+                if self.nodes.is_stored(node):
+                    self.nodes.remove_child(parent_node, seq_num)
+                if session is not None:
+                    session.nodes.discard(node)
+                if created_parent and self.nodes.get_parent(parent_path) is parent_node:
+                    self.nodes.remove_parent(parent_node)
+                parent_node.seq_num = parent_seq_num
+                parent_node.version = parent_version
+            undo.append(restore)
+
+        if created_parent:
+            self.nodes.add_parent(parent_node)
+        parent_node.seq_num = seq_num
+        self._mark_changed(parent_node, node)
+        if session is not None:
+            session.nodes.add(node)
+        current_owner = parent_node.first_child()
+        if current_owner is None or current_owner.client_id == client_id:
+            self._start_expiry(node)
+        self.nodes.insert_child(parent_node, node, parent_node.tail)
+        return node
+
+    # Internal helper to describe a node and its place in the lock queue of its parent
+    def _get_node_info(self, node: EphemeralNode) -> dict:
+        owner_node = node.parent.first_child() if node.parent is not None else None
+        return {"node_path": node.path, "client_id": node.client_id, "version": node.version,
+                "is_owner": owner_node is node, "predecessor": node.prev_node.path if node.prev_node is not None else None,
+                "current_lock_owner": owner_node.client_id if owner_node is not None else None}
 
     # Retrieve an ephemeral node by its path
     def get_node(self, path: str) -> Optional[EphemeralNode]:
         logger.info("Retrieving ephemeral node at path: %s", path)
-        return self.nodes[path] if path in self.nodes else None
+        return self.nodes.get(path)
 
     # Delete an ephemeral node by its path
     def delete_node(self, path: str) -> bool:
         logger.info("Deleting ephemeral node at path: %s", path)
-        if path in self.nodes:
-            if self.nodes[path].is_parent_node():
-                # If it's a parent node, ensure no child nodes exist
-                child_nodes = self._get_child_nodes(path)
-                if child_nodes:
-                    logger.error("Cannot delete parent node at path: %s as it has child nodes.", path)
-                    return False
-            del self.nodes[path]
-            return True
-        return False
+        with self.mutex:
+            deleted = self._delete_and_notify(path)
+            self._log_changes()
+        self._commit()
+        return deleted
 
-    # Cleanup expired ephemeral nodes
-    def cleanup_expired_nodes(self):
+    # Internal helper to delete a node and wake the clients watching it. Must be called with the mutex held.
+    def _delete_and_notify(self, path: str) -> bool:
+        deleted_paths = self._delete_node(path)
+        for deleted_path in deleted_paths:
+            self._trigger_watches(deleted_path)
+        return bool(deleted_paths)
+
+    # Internal helper to delete a node. Must be called with the mutex held. Returns the deleted paths, which
+    # include the parent if this was its last child, without triggering their watches. If undo is given,
+    # a function restoring the previous state is appended to it.
+    def _delete_node(self, path: str, undo: Optional[List[Callable]] = None) -> List[str]:
+        node = self.nodes.get(path)
+        if node is None:
+            return []
+        deleted_paths = [path]
+        self._mark_changed(node)
+        parent_node, prev_node, new_owner, parent_version, owner_state = None, None, None, 0, None
+        if node.is_parent_node():
+            # If it's a parent node, ensure no child nodes exist
+            if node.has_children():
+                logger.error("Cannot delete parent node at path: %s as it has child nodes.", path)
+                return []
+            self.nodes.remove_parent(node)
+        else:
+            parent_node = node.parent
+            parent_path = parent_node.name
+            was_owner = parent_node.first_child() is node
+            prev_node, parent_version = node.prev_node, parent_node.version
+            self.nodes.remove_child(parent_node, node.seq_num)
+            self._mark_changed(parent_node)
+            new_owner = parent_node.first_child()
+            if was_owner and new_owner is not None:
+                # The next node in sequence order becomes the lock owner and its expiry starts now
+                owner_state = (new_owner.creation_time, new_owner.deadline, new_owner.version)
+                self._start_expiry(new_owner)
+                logger.debug("New lock owner for parent path %s is client %s with creation time %s", parent_path, new_owner.client_id, new_owner.creation_time)
+            elif new_owner is None:
+                # The parent's last child is gone. The parent is deleted with it instead of by a periodic sweep.
+                logger.debug("Cleaning up leaf node at path: %s", parent_path)
+                self.nodes.remove_parent(parent_node)
+                deleted_paths.append(parent_path)
+        if node.session is not None:
+            node.session.nodes.discard(node)
+
+        if undo is not None:
+            def restore():
+                if node.session is not None:
+                    node.session.nodes.add(node)
+                if parent_node is None:
+                    self.nodes.add_parent(node)
+                else:
+                    self.nodes.add_parent(parent_node)
+                    self.nodes.insert_child(parent_node, node, prev_node)
+                    parent_node.version = parent_version
+                    if owner_state is not None:
+                        # The promoted node's expiry entry goes stale with its old deadline
+                        new_owner.creation_time, new_owner.deadline, new_owner.version = owner_state
+            undo.append(restore)
+        return deleted_paths
+
+    # Internal helper to start the expiry of a node that became the lock owner, and index it by its deadline
+    def _start_expiry(self, node: EphemeralNode):
+        node.reset_creation_time()
+        node.version += 1
+        self._mark_changed(node)
+        if node.session is not None:
+            return # Nodes owned by a session expire with the session
+        heapq.heappush(self.expiry_heap, (node.deadline, next(self.heap_sequence), node))
+        # Rebuild the heap if stale entries from deleted nodes start to dominate it.
+        if len(self.expiry_heap) > 2 * len(self.nodes) + 1024:
+            self.expiry_heap = [(node.deadline, next(self.heap_sequence), node) for node in self.nodes.values()
+                                if node.deadline is not None and node.session is None]
+            heapq.heapify(self.expiry_heap)
+
+    # Cleanup expired ephemeral nodes. Only the nodes whose deadline has passed are popped from the expiry heap,
+    # so the cost depends on the number of expired nodes and not on the size of the tree. Returns their paths.
+    def cleanup_expired_nodes(self, now: Optional[float] = None) -> List[str]:
         logger.debug("Running cleanup for expired ephemeral nodes at time: %s", datetime.now(timezone.utc))
-        current_time = datetime.now(timezone.utc)
-        expired_paths = [path for path, node in self.nodes.items() if node.is_expired(current_time)]
-        for path in expired_paths:
-            logger.debug("Cleaning up expired ephemeral node at path: %s", path)
-            self.delete_node(path)
-            # Find the paths's parent and check next current lock owner
-            parent_path = self._get_parent_path(path)
-            child_nodes = self._get_child_nodes(parent_path)
-            if child_nodes:
-                # Find the child node with the smallest sequence number
-                min_seq_node = min(child_nodes.values(), key=lambda n: n.seq_num)
-                logger.debug("Resetting creation time for new lock owner node at path: %s", min_seq_node.path)
-                min_seq_node.reset_creation_time()
-                logger.debug("New lock owner for parent path %s is client %s with creation time %s", parent_path, min_seq_node.client_id, min_seq_node.creation_time)
+        now = time.monotonic() if now is None else now
+        expired_paths = []
+        with self.mutex:
+            while self.expiry_heap and self.expiry_heap[0][0] < now:
+                deadline, _, node = heapq.heappop(self.expiry_heap)
+                if node.deadline != deadline or node.session is not None or not self.nodes.is_stored(node):
+                    continue # Stale entry: the node was deleted, or its deadline was restored by a failed transaction
+                # Deleting the owner's node hands the lock to the next node of its parent
+                path = node.path
+                logger.debug("Cleaning up expired ephemeral node at path: %s", path)
+                self._delete_and_notify(path)
+                expired_paths.append(path)
+            self._log_changes()
+        self._commit()
+        return expired_paths
+
+    # Multi-op transaction related methods
+
+    # Run a list of operations atomically: either all of them are applied or none are. Each operation is a dict with
+    # an "op" of "create", "delete", "check" or "get_children" and a "path", plus:
+    #   create: client_id and expiry or session_id, like create_node. path is the parent path.
+    #   delete: optional version. Fails if the node does not exist, has children or its version differs.
+    #   check: optional version. Fails if the node does not exist or its version differs.
+    # Returns the result of each operation. Raises a MultiOpException if an operation fails, after undoing the
+    # operations before it. Watches on deleted nodes are only triggered once the whole transaction has succeeded.
+    def multi(self, ops: List[dict]) -> List[dict]:
+        with self.mutex:
+            undo: List[Callable] = []
+            deleted_paths: List[str] = []
+            results = []
+            for index, op in enumerate(ops):
+                try:
+                    results.append(self._run_op(op, undo, deleted_paths))
+                except Exception as e:
+                    logger.debug("Multi-op transaction failed at operation %d: %s", index, e)
+                    self._rollback(undo)
+                    raise MultiOpException(f"Operation {index} failed: {e}", index)
+            for path in deleted_paths:
+                self._trigger_watches(path)
+            self._log_changes()
+        self._commit()
+        return results
+
+    # Internal helper to undo the changes of a failed operation. Nothing changed, so there is nothing to log either.
+    def _rollback(self, undo: List[Callable]):
+        for restore in reversed(undo):
+            restore()
+        self.changed_nodes.clear()
+
+    # Internal helper to run one operation of a multi-op transaction
+    def _run_op(self, op: dict, undo: List[Callable], deleted_paths: List[str]) -> dict:
+        op_type, path = op.get("op"), op.get("path")
+        if op_type == "create":
+            node = self._create_node(path, op.get("client_id"), op.get("expiry"), op.get("session_id"), undo)
+            return dict(self._get_node_info(node), op=op_type)
+        if op_type == "get_children":
+            parent_node = self._get_parent_node(path)
+            children = [{"node_path": child.path, "client_id": child.client_id} for child in parent_node.iter_children()] if parent_node else []
+            return {"op": op_type, "path": path, "version": parent_node.version if parent_node else None, "children": children}
+        if op_type not in ("delete", "check"):
+            raise Exception(f"Unknown operation {op_type}.")
+        node = self.nodes.get(path)
+        if node is None:
+            raise Exception(f"Node at path {path} not found.")
+        version = op.get("version")
+        if version is not None and node.version != version:
+            raise Exception(f"Node at path {path} has version {node.version}, expected {version}.")
+        if op_type == "delete":
+            paths = self._delete_node(path, undo)
+            if not paths:
+                raise Exception(f"Cannot delete parent node at path {path} as it has child nodes.")
+            deleted_paths.extend(paths)
+        return {"op": op_type, "path": path, "version": node.version}
+
+    # Session related methods
+
+    def create_session(self, client_id: str, ttl: int) -> Session:
+        session = Session(uuid.uuid4().hex, client_id, ttl)
+        with self.mutex:
+            self.sessions[session.session_id] = session
+            heapq.heappush(self.session_heap, (session.deadline, next(self.session_sequence), session.session_id))
+            self._log_session(session)
+        self._commit()
+        logger.debug("Created session: %s for client: %s with ttl %s", session.session_id, client_id, ttl)
+        return session
+
+    def get_session(self, session_id: str, client_id: Optional[str] = None) -> Session:
+        # Retrieve an active session. Raises a SessionExpiredException if it has expired or belongs to another client.
+        session = self.sessions.get(session_id)
+        if session is None or session.get_status() == "expired":
+            raise SessionExpiredException(f"Session {session_id} not found or expired")
+        if client_id is not None and session.client_id != client_id:
+            raise SessionExpiredException(f"Session {session_id} belongs to another client {session.client_id}")
+        return session
+
+    def heartbeat(self, session_id: str, client_id: Optional[str] = None) -> Session:
+        # Extend the session and every node it owns in one step.
+        with self.mutex:
+            session = self.get_session(session_id, client_id)
+            session.heartbeat()
+            self._log_session(session)
+        self._commit()
+        return session
+
+    def close_session(self, session_id: str, client_id: Optional[str] = None) -> List[str]:
+        # Close the session and delete all its nodes. Returns the deleted paths.
+        with self.mutex:
+            session = self.get_session(session_id, client_id)
+            del self.sessions[session_id]
+            logger.debug("Closing session: %s for client: %s", session_id, session.client_id)
+            deleted = self._delete_session_nodes(session)
+            self._log_changes()
+        self._commit()
+        return deleted
+
+    # Internal helper to delete all the nodes of a closed or expired session in one batch.
+    # The mutex is held throughout, so a waiter woken by one of the deletions sees the nodes after the whole batch.
+    def _delete_session_nodes(self, session: Session) -> List[str]:
+        deleted = []
+        with self.mutex:
+            if self.wal is not None:
+                self.wal.append(("C", session.session_id))
+            for node in session.close():
+                path = node.path
+                if self._delete_and_notify(path):
+                    deleted.append(path)
+        return deleted
+
+    # Delete sessions whose deadline has passed together with their nodes.
+    # Returns the deleted paths for each expired session.
+    def cleanup_expired_sessions(self, now: Optional[float] = None) -> Dict[str, List[str]]:
+        now = time.monotonic() if now is None else now
+        deleted = {}
+        with self.mutex:
+            while self.session_heap and self.session_heap[0][0] < now:
+                _, _, session_id = heapq.heappop(self.session_heap)
+                session = self.sessions.get(session_id)
+                if session is None:
+                    continue # The session was closed
+                if session.deadline >= now:
+                    # Extended by heartbeats since it was indexed
+                    heapq.heappush(self.session_heap, (session.deadline, next(self.session_sequence), session_id))
+                    continue
+                del self.sessions[session_id]
+                logger.debug("Session: %s for client: %s expired", session_id, session.client_id)
+                deleted[session_id] = self._delete_session_nodes(session)
+            self._log_changes()
+        self._commit()
+        return deleted
+
+    # Persistence related methods. The log holds these records, each the full new state of a node, parent or session:
+    #   ["N", path, client_id, session_expiry, session_id, version, created_at]  sequence node created or changed
+    #   ["D", path]                                                              sequence node deleted
+    #   ["P", path, seq_num, version]                                            parent created or its children changed
+    #   ["R", path]                                                              parent deleted
+    #   ["S", session_id, client_id, ttl, wall_deadline]                         session created or extended
+    #   ["C", session_id]                                                        session closed or expired
+    # created_at is the wall-clock time the node became the lock owner, or None if it is waiting.
+    # The sequence counter is not logged. On recovery it continues after the largest sequence number in the
+    # snapshot and the log, so every number a client may have been given is skipped.
+
+    # Internal helper to remember nodes changed by the current operation, to be logged once it completes
+    def _mark_changed(self, *nodes: EphemeralNode):
+        if self.wal is not None:
+            self.changed_nodes.extend(nodes)
+
+    # Internal helper to log the new state of the nodes changed by an operation. Must be called with the mutex held
+    # so records for a path are logged in the order the changes were made.
+    def _log_changes(self):
+        if self.wal is None:
+            return
+        # A node changed several times is logged once. A deleted node is always marked before a node that later
+        # reuses its path, so the records for a path stay in order.
+        for node in dict.fromkeys(self.changed_nodes):
+            if not self.nodes.is_stored(node):
+                self.wal.append(("R", node.name) if node.is_parent else ("D", node.path))
+            elif node.is_parent:
+                self.wal.append(("P", node.name, node.seq_num, node.version))
+            else:
+                self.wal.append(("N", node.path) + self._get_node_state(node))
+        self.changed_nodes.clear()
+
+    def _log_session(self, session: Session):
+        if self.wal is not None:
+            wall_deadline = time.time() + (session.deadline - time.monotonic())
+            self.wal.append(("S", session.session_id, session.client_id, session.ttl, wall_deadline))
+
+    # Internal helper to get the persisted state of a sequence node. Records and snapshot entries are tuples: a tuple
+    # of strings and numbers is untracked by the garbage collector, so a backlog of them waiting to be written is
+    # never promoted to the oldest generation and does not trigger full collections of the whole tree.
+    def _get_node_state(self, node: EphemeralNode) -> tuple:
+        created_at = node.creation_time.timestamp() if node.creation_time is not None else None
+        return (node.client_id, node.session_expiry, node.session.session_id if node.session else None, node.version, created_at)
+
+    def _commit(self):
+        # Wait for the changes made so far to be written to the transaction log.
+        # Called after releasing the mutex so that concurrent requests are committed together.
+        if self.wal is not None:
+            self.wal.commit()
+
+    def take_snapshot(self, batch_size: int = 100):
+        # Write a fuzzy snapshot of the tree and sessions and drop the log segments it covers. The mutex is only held
+        # while reading batch_size parents, so requests continue while the snapshot is taken. Log records hold the
+        # full state of a node, so replaying records from the new segment that are already in the snapshot is harmless.
+        segment = self.wal.rotate()
+        now, wall_now = time.monotonic(), time.time()
+        with self.mutex:
+            snapshot_sessions = [[session.session_id, session.client_id, session.ttl, wall_now + session.deadline - now]
+                                 for session in self.sessions.values()]
+            next_seq_num = next(self.seq_nums)
+            parent_paths = list(self.nodes.parents)
+        self.wal.write_snapshot({"sessions": snapshot_sessions, "next_seq_num": next_seq_num},
+                                self._iter_snapshot_parents(parent_paths, batch_size), segment)
+
+    # Internal helper to read the parents for a snapshot in batches. Each parent is stored with its children,
+    # so the parent path is not repeated for every child.
+    def _iter_snapshot_parents(self, parent_paths: List[str], batch_size: int) -> Iterator[list]:
+        for start in range(0, len(parent_paths), batch_size):
+            batch = []
+            with self.mutex:
+                for path in parent_paths[start:start + batch_size]:
+                    parent_node = self.nodes.get_parent(path)
+                    if parent_node is not None:
+                        children = tuple([(child.seq_num,) + self._get_node_state(child) for child in parent_node.iter_children()])
+                        batch.append((path, parent_node.seq_num, parent_node.version, children))
+            yield batch
+            # Let requests waiting for the mutex take it before the next batch. The mutex is not fair, so without
+            # this the snapshot thread can take it again straight away and hold up writes for seconds.
+            time.sleep(0)
+
+    def recover(self, compact: bool = True) -> int:
+        # Rebuild the tree from the last snapshot and the transaction log. Must be called before serving requests.
+        # Deadlines are re-derived on the monotonic clock from the persisted wall-clock times. Nodes and sessions
+        # that expired while the service was down are then deleted by the usual cleanup, which hands their locks on.
+        # Returns the number of sequence nodes recovered.
+        start = time.perf_counter()
+        # Recovery allocates millions of objects that all survive. Pause the garbage collector
+        # so it does not repeatedly scan them, which otherwise dominates recovery time.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with self.mutex:
+                self._restore()
+        finally:
+            if gc_enabled:
+                gc.enable()
+                # The first collection has to move every recovered node to the oldest generation. Run it now,
+                # before requests are served, instead of as a pause in the middle of one.
+                gc.collect()
+        self.cleanup_expired_sessions()
+        self.cleanup_expired_nodes()
+        restored = self.nodes.child_count
+        logger.info("Recovered %d nodes and %d sessions in %.3f seconds", restored, len(self.sessions), time.perf_counter() - start)
+        if compact:
+            # Snapshot right away so the next recovery does not replay the same log again
+            self.take_snapshot()
+        return restored
+
+    def _restore(self):
+        snapshot, entries, records = self.wal.load()
+        sessions, parents, children, next_seq_num = {}, {}, {}, 0
+        if snapshot:
+            sessions = {session[0]: session[1:] for session in snapshot["sessions"]}
+            # Older snapshots kept a counter for each deleted parent instead of the tree's counter
+            next_seq_num = max([snapshot.get("next_seq_num", 0)] + [seq_num + 1 for seq_num in snapshot.get("seq_nums", {}).values()])
+            for path, seq_num, version, parent_children in entries:
+                parents[path] = (seq_num, version)
+                children[path] = {child[0]: child[1:] for child in parent_children}
+                next_seq_num = max(next_seq_num, seq_num + 1)
+        for record in records:
+            op = record[0]
+            if op == "N" or op == "D":
+                parent_path, _, seq = record[1].rpartition('/')
+                if op == "N":
+                    children.setdefault(parent_path, {})[int(seq)] = record[2:]
+                    next_seq_num = max(next_seq_num, int(seq) + 1)
+                else:
+                    children.get(parent_path, {}).pop(int(seq), None)
+            elif op == "P":
+                parents[record[1]] = (record[2], record[3])
+                next_seq_num = max(next_seq_num, record[2] + 1)
+            elif op == "R":
+                parents.pop(record[1], None)
+                if len(record) > 2:
+                    # Older records carry the counter of the deleted parent
+                    next_seq_num = max(next_seq_num, record[2] + 1)
+            elif op == "S":
+                sessions[record[1]] = record[2:]
+            elif op == "C":
+                sessions.pop(record[1], None)
+
+        now, wall_now = time.monotonic(), time.time()
+        for session_id, (client_id, ttl, wall_deadline) in sessions.items():
+            session = Session(session_id, client_id, ttl)
+            session.deadline = now + wall_deadline - wall_now
+            self.sessions[session_id] = session
+            self.session_heap.append((session.deadline, next(self.session_sequence), session_id))
+        # New nodes never reuse a sequence number a client may still hold
+        self.seq_nums = itertools.count(next_seq_num)
+        # Nothing else runs during recovery, so link the children in sequence order and build the heaps in one go
+        for parent_path, parent_children in children.items():
+            if not parent_children:
+                continue
+            seq_num, parent_version = parents.get(parent_path, (0, 0))
+            parent_node = EphemeralNode(parent_path, None, None, max(seq_num, max(parent_children)), is_parent=True)
+            self.nodes.add_parent(parent_node)
+            for seq in sorted(parent_children):
+                client_id, session_expiry, session_id, version, created_at = parent_children[seq]
+                session = None
+                if session_id is not None:
+                    session = self.sessions.get(session_id)
+                    if session is None:
+                        continue # The session was closed
+                node = EphemeralNode(None, client_id, session_expiry, seq, session=session, parent=parent_node)
+                node.version = version
+                if created_at is not None:
+                    node.creation_time = datetime.fromtimestamp(created_at, timezone.utc)
+                    if session is None:
+                        node.deadline = now + created_at + session_expiry - wall_now
+                        self.expiry_heap.append((node.deadline, next(self.heap_sequence), node))
+                if session is not None:
+                    session.nodes.add(node)
+                self.nodes.insert_child(parent_node, node, parent_node.tail)
+            parent_node.version = parent_version
+            owner_node = parent_node.first_child()
+            if owner_node is None:
+                self.nodes.remove_parent(parent_node)
+            elif owner_node.creation_time is None:
+                # The nodes before it belonged to closed sessions, so its expiry starts now
+                self._start_expiry(owner_node)
+        heapq.heapify(self.session_heap)
+        heapq.heapify(self.expiry_heap)
+        self._log_changes()
@@ -30,23 +30,20 @@ class ExpiredLockCleaner:
     def _run_cleanup(self):
         while not self.stop_event.is_set():
             time.sleep(self.cleanup_interval)
+            self.cleanup_expired_sessions()
             self.cleanup_expired_locks()
-            self.cleanup_leaf_nodes()
 
     def cleanup_expired_locks(self):
         logger.debug("Running cleanup for expired locks at time: %s", datetime.now(timezone.utc))   
-        self.node_manager.cleanup_expired_nodes()
+        # Empty parent nodes are deleted along with their last child
+        for path in self.node_manager.cleanup_expired_nodes():
+            logger.debug("Cleaned up expired ephemeral node at path: %s", path)
+
+    def cleanup_expired_sessions(self):
+        # Nodes owned by sessions that stopped sending heartbeats are deleted together with their session.
+        for session_id, paths in self.node_manager.cleanup_expired_sessions().items():
+            logger.debug("Cleaned up expired session: %s and deleted %d nodes", session_id, len(paths))
 
-    def cleanup_leaf_nodes(self): # We only cleanup parent nodes that have no children.
-        logger.debug("Cleaning up leaf nodes at time: %s", datetime.now(timezone.utc))   
-        items = list(self.node_manager.nodes.items())     
-        for path, node in items:
-            if not node.is_parent_node():
-                continue
-            child_nodes = self.node_manager._get_child_nodes(path)
-            if not child_nodes:
-                logger.debug("Cleaning up leaf node at path: %s", path)
-                self.node_manager.delete_node(path)
 
 if __name__ == "__main__":
     node_manager = EphemeralNodeManager()
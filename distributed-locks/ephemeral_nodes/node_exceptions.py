@@ -0,0 +1,19 @@
+"""
+List of exceptions related to ephemeral node operations.
+"""
+class SessionExpiredException(Exception):
+    # Raised when a session does not exist, has expired or belongs to another client.
+    def __init__(self, error_message: str):
+        super().__init__(error_message)
+
+class MultiOpException(Exception):
+    # Raised when an operation of a multi-op transaction fails. None of the transaction's operations are applied.
+    # index is the position of the failed operation in the transaction.
+    def __init__(self, error_message: str, index: int):
+        super().__init__(error_message)
+        self.index = index
+
+class TransactionLogException(Exception):
+    # Raised when changes cannot be written to the transaction log, so they will not survive a restart.
+    def __init__(self, error_message: str):
+        super().__init__(error_message)
@@ -0,0 +1,65 @@
+"""
+This module provides the store holding the ephemeral node tree.
+Parent nodes are kept in a dict by path, so each parent path string is stored once. Sequence nodes are only kept
+in their parent's children, keyed by sequence number, and reference their parent instead of storing their own
+path. Looking up a sequence node splits the last segment off its path once, and finding a node's parent follows
+a reference instead of splitting strings.
+"""
+from ephemeral_node import EphemeralNode
+from typing import Dict, Iterator, Optional, Tuple
+
+class NodeStore:
+    def __init__(self):
+        self.parents: Dict[str, EphemeralNode] = {}
+        self.child_count = 0 # Number of sequence nodes in the store
+
+    def __len__(self) -> int:
+        return len(self.parents) + self.child_count
+
+    def __contains__(self, path: str) -> bool:
+        return self.get(path) is not None
+
+    def get(self, path: str) -> Optional[EphemeralNode]:
+        # Most lookups are for sequence nodes, so the path is split before trying it as a parent path
+        parent_path, _, seq = path.rpartition('/')
+        if seq.isdecimal():
+            parent_node = self.parents.get(parent_path)
+            if parent_node is not None:
+                node = parent_node.children.get(int(seq))
+                if node is not None:
+                    return node
+        return self.parents.get(path)
+
+    def get_parent(self, path: str) -> Optional[EphemeralNode]:
+        return self.parents.get(path)
+
+    def is_stored(self, node: EphemeralNode) -> bool:
+        # Whether the node is still in the tree, without building its path
+        parent_node = node.parent
+        if parent_node is None:
+            return self.parents.get(node.name) is node
+        return self.parents.get(parent_node.name) is parent_node and parent_node.children.get(node.seq_num) is node
+
+    def add_parent(self, node: EphemeralNode):
+        self.parents[node.name] = node
+
+    def remove_parent(self, node: EphemeralNode):
+        del self.parents[node.name]
+
+    def insert_child(self, parent_node: EphemeralNode, node: EphemeralNode, prev_node: Optional[EphemeralNode]):
+        parent_node.insert_child(node, prev_node)
+        self.child_count += 1
+
+    def remove_child(self, parent_node: EphemeralNode, seq_num: int):
+        parent_node.remove_child(seq_num)
+        self.child_count -= 1
+
+    def values(self) -> Iterator[EphemeralNode]:
+        # Every node, each parent followed by its children in sequence order
+        for parent_node in list(self.parents.values()):
+            yield parent_node
+            yield from parent_node.iter_children()
+
+    def items(self) -> Iterator[Tuple[str, EphemeralNode]]:
+        for node in self.values():
+            yield node.path, node
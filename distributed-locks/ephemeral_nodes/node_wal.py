@@ -0,0 +1,249 @@
+"""
+Transaction log and fuzzy snapshots for the ephemeral node tree, so nodes, parents' sequence counters and sessions
+survive a restart of the ephemeral node service, like ZooKeeper's transaction log and snapshots.
+Every change to a node or session is appended to the log as a record holding its full new state. Records are
+written by a background thread in batches, so concurrent clients share a single write and fsync (group commit).
+Each batch is encoded as one JSON array on one line, which is several times cheaper to write and read back than
+a line per record.
+A snapshot of the whole tree is written periodically while requests continue, and the log segments it covers are
+deleted, which keeps recovery time bounded by the size of the tree instead of the number of operations since the
+service started. Snapshots are written a batch of entries per line as the entries are read, so the tree is never
+copied in memory and writes are only held up for one batch at a time. Deadlines are persisted as wall-clock time, since the monotonic clock restarts with the process.
+"""
+from typing import Iterable, Iterator, List, Optional, Tuple
+import glob
+import json
+import logging
+import os
+import threading
+import time
+
+from node_exceptions import TransactionLogException
+
+logging.basicConfig(filename='ephemeral_node_manager.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# fsync policies:
+#   always   - each write returns only once its record is on disk. Concurrent writes share one fsync.
+#   interval - the log is fsynced every flush_interval seconds. A crash loses at most that much.
+#   none     - the log is handed to the OS but never fsynced. Survives a process crash but not a machine crash.
+FSYNC_POLICIES = ("always", "interval", "none")
+
+SNAPSHOT_FILE = "snapshot.json"
+
+# Reused for every batch. json.dumps with separators builds a new encoder on each call.
+encode = json.JSONEncoder(separators=(",", ":")).encode
+
+
+class TransactionLog:
+    def __init__(self, directory: str, fsync_policy: str = "always", flush_interval: float = 0.01):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise Exception(f"Invalid fsync policy {fsync_policy}. Must be one of {FSYNC_POLICIES}.")
+        self.directory = directory
+        self.fsync_policy = fsync_policy
+        self.flush_interval = flush_interval # Seconds between writes for the interval and none policies
+        os.makedirs(directory, exist_ok=True)
+
+        self.cond = threading.Condition() # Guards pending and the sequence numbers
+        self.pending: List[list] = [] # Records appended but not yet written
+        self.last_seq = 0 # Sequence number of the last appended record
+        self.durable_seq = 0 # Sequence number of the last record written according to the fsync policy
+        self.io_lock = threading.Lock() # Serializes writes to and rotation of the log file
+        self.stats = {"records": 0, "batches": 0, "fsyncs": 0}
+        # Set once a write to the log fails. The failed batch is lost, so nothing is written after it
+        # and records appended since can never become durable.
+        self.error: Optional[TransactionLogException] = None
+
+        # Never append to a segment left by a previous run, its last record may be torn.
+        # Segments up to the current one are read back by recovery.
+        self.segment = max(self.get_segments(), default=0) + 1
+        self.file = open(self._segment_path(self.segment), "a")
+        self.closed = False
+        self.writer = threading.Thread(target=self._run_writer, daemon=True)
+        self.writer.start()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"wal.{segment:06d}.log")
+
+    def get_segments(self) -> List[int]:
+        return sorted(int(os.path.basename(path).split(".")[1]) for path in glob.glob(os.path.join(self.directory, "wal.*.log")))
+
+    # Writing
+
+    def append(self, record: tuple) -> int:
+        # Queue a record for writing. Returns its sequence number.
+        with self.cond:
+            self.pending.append(record)
+            self.last_seq += 1
+            if self.fsync_policy == "always":
+                self.cond.notify_all()
+            return self.last_seq
+
+    def commit(self):
+        # Wait until every record appended so far is durable. Only the always policy waits.
+        # Raises a TransactionLogException if writing to the log failed before the records were written.
+        with self.cond:
+            if self.fsync_policy == "always":
+                seq = self.last_seq
+                while self.durable_seq < seq and not self.closed and self.error is None:
+                    self.cond.wait()
+                if self.durable_seq >= seq:
+                    return
+            if self.error is not None:
+                raise self.error
+
+    def _run_writer(self):
+        while True:
+            with self.cond:
+                if self.fsync_policy == "always":
+                    while not self.pending and not self.closed:
+                        self.cond.wait()
+                else:
+                    self.cond.wait(self.flush_interval)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error("Error writing to the transaction log - %s", str(e))
+                return
+
+    def flush(self):
+        # Write all pending records in one batch. Records appended while a batch is being written go in the next one.
+        with self.io_lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        with self.cond:
+            if self.error is not None:
+                raise self.error
+            batch, self.pending = self.pending, []
+            seq = self.last_seq
+        if batch:
+            try:
+                self.file.write(encode(batch) + "\n")
+                self.file.flush()
+                if self.fsync_policy != "none":
+                    os.fsync(self.file.fileno())
+            except Exception as e:
+                # Wake up the requests waiting in commit so they fail instead of waiting forever
+                with self.cond:
+                    self.error = TransactionLogException(f"Writing to the transaction log failed - {e}")
+                    self.cond.notify_all()
+                raise self.error from e
+            if self.fsync_policy != "none":
+                self.stats["fsyncs"] += 1
+            self.stats["records"] += len(batch)
+            self.stats["batches"] += 1
+        with self.cond:
+            self.durable_seq = seq
+            self.cond.notify_all()
+
+    def rotate(self) -> int:
+        # Start a new log segment. Records appended before this call are in the older segments.
+        # Returns the new segment number.
+        with self.io_lock:
+            self._flush_locked()
+            self.file.close()
+            self.segment += 1
+            self.file = open(self._segment_path(self.segment), "a")
+            return self.segment
+
+    def close(self):
+        with self.io_lock:
+            try:
+                self._flush_locked()
+            finally:
+                with self.cond:
+                    self.closed = True
+                    self.cond.notify_all()
+                self.file.close()
+        self.writer.join()
+
+    # Snapshots
+
+    def write_snapshot(self, snapshot: dict, entries: Iterable[list], segment: int):
+        # Atomically replace the snapshot, then delete the log segments it covers.
+        # The snapshot must include every record from segments older than segment. The snapshot dict is written on
+        # the first line, followed by each batch of entries on its own line as entries produces it.
+        snapshot["segment"] = segment
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write(encode(snapshot) + "\n")
+            for batch in entries:
+                f.write(encode(batch) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        dir_fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+        for old_segment in self.get_segments():
+            if old_segment < segment:
+                os.remove(self._segment_path(old_segment))
+        logger.info("Wrote snapshot covering log segments before %d", segment)
+
+    # Recovery
+
+    def load(self) -> Tuple[Optional[dict], Iterator[list], Iterator[list]]:
+        # Returns the last snapshot, or None, its entries and the log records written after it in order.
+        snapshot, lines = None, []
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path) as f:
+                lines = f.read().split("\n")
+            snapshot = json.loads(lines[0])
+        first_segment = snapshot["segment"] if snapshot else 0
+        segments = [segment for segment in self.get_segments() if first_segment <= segment < self.segment]
+        return snapshot, self._read_entries(lines[1:]), self._read_records(segments)
+
+    def _read_entries(self, lines: List[str]) -> Iterator[list]:
+        # The snapshot file was replaced atomically, so every line is complete
+        for line in lines:
+            if line:
+                yield from json.loads(line)
+
+    def _read_records(self, segments: List[int]) -> Iterator[list]:
+        for segment in segments:
+            with open(self._segment_path(segment)) as f:
+                lines = f.read().split("\n")
+            for line_no, line in enumerate(lines):
+                if not line:
+                    continue
+                try:
+                    batch = json.loads(line)
+                except ValueError:
+                    # A torn batch can only be at the end of the log, written when the service stopped.
+                    # With the always policy none of its changes were acknowledged.
+                    logger.warning("Skipping unreadable batch at line %d of log segment %d", line_no + 1, segment)
+                    continue
+                yield from batch
+
+
+class SnapshotWriter:
+    # Periodically snapshots the node tree so the transaction log stays short.
+    def __init__(self, node_manager, snapshot_interval: int = 60):
+        self.node_manager = node_manager
+        self.snapshot_interval = snapshot_interval # in seconds
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run_snapshots, daemon=True)
+
+    def start(self):
+        logger.debug("Starting Snapshot Writer thread.")
+        self.thread.start()
+
+    def stop(self):
+        logger.debug("Stopping Snapshot Writer thread.")
+        self.stop_event.set()
+        self.thread.join()
+
+    def _run_snapshots(self):
+        while not self.stop_event.wait(self.snapshot_interval):
+            try:
+                start = time.perf_counter()
+                self.node_manager.take_snapshot()
+                logger.debug("Took snapshot in %.3f seconds", time.perf_counter() - start)
+            except Exception as e:
+                logger.error("Error taking snapshot - %s", str(e))
@@ -0,0 +1,33 @@
+"""
+This module provides a client session that owns a set of ephemeral nodes.
+Nodes created under a session have no expiry of their own. They live as long as the session is kept alive
+with heartbeats, and are all deleted together when the session expires or is closed.
+"""
+import time
+
+class Session:
+    __slots__ = ("session_id", "client_id", "ttl", "deadline", "nodes", "closed")
+
+    def __init__(self, session_id: str, client_id: str, ttl: int):
+        self.session_id = session_id # Unique identifier for the session
+        self.client_id = client_id # Identifier for the client that owns the session
+        self.ttl = ttl # Session time-to-live (TTL) in seconds, restarted by every heartbeat
+        self.deadline = time.monotonic() + ttl # Time on the monotonic clock after which the session is expired
+        self.nodes = set() # Nodes owned by the session
+        self.closed = False # Set once the session's nodes are being deleted. No nodes can be added after that.
+
+    def __str__(self):
+        return f"Session(session_id={self.session_id}, client_id={self.client_id}, ttl={self.ttl}, nodes={len(self.nodes)}, status={self.get_status()})"
+
+    def heartbeat(self):
+        # Extend the session, and with it every node owned by the session.
+        self.deadline = time.monotonic() + self.ttl
+
+    def get_status(self) -> str:
+        return "expired" if self.closed or time.monotonic() > self.deadline else "active"
+
+    def close(self) -> list:
+        # Close the session and return its nodes so they can be deleted.
+        self.closed = True
+        self.deadline = 0
+        return list(self.nodes)
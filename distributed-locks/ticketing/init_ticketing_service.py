@@ -10,6 +10,9 @@ TOTAL_TICKETS = 10
 logging.basicConfig(filename='ticket_reservation.log', level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Adds the fencing token column to a tickets table created before fencing tokens were introduced
+ADD_FENCING_TOKEN_QUERY = "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS fencing_token BIGINT NOT NULL DEFAULT 0;"
+
 # Function to initialize the ticketing service database
 def init_ticketing_service_db(HOST=None):
     # Note this will recreate the tickets table if it already exists.
@@ -75,10 +78,12 @@ def init_ticketing_service_db(HOST=None):
         CREATE TABLE IF NOT EXISTS tickets (
             ticket_id SERIAL PRIMARY KEY,
             sold_to VARCHAR(50),
-            state ticket_state NOT NULL
+            state ticket_state NOT NULL,
+            fencing_token BIGINT NOT NULL DEFAULT 0
         );
         '''
         cursor.execute(create_table_query)
+        cursor.execute(ADD_FENCING_TOKEN_QUERY)
         connection.commit()
         logger.info("Tickets table created successfully.")
 
@@ -100,5 +105,36 @@ def init_ticketing_service_db(HOST=None):
             cursor.close()
             connection.close()
 
+# Function to migrate an existing ticketing service database without recreating the tickets table
+def migrate_ticketing_service_db(HOST=None):
+    connection = None
+    try:
+        if not HOST:
+            HOST = DB_HOST
+
+        connection = psycopg2.connect(
+            dbname=DB_NAME,
+            user=DB_USER,
+            password=DB_PASSWORD,
+            host=HOST,
+            port=DB_PORT
+        )
+        cursor = connection.cursor()
+        cursor.execute(ADD_FENCING_TOKEN_QUERY)
+        connection.commit()
+        logger.info("Tickets table migrated successfully.")
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error(f"Error migrating ticketing service DB: {error}")
+    finally:
+        if connection and cursor:
+            cursor.close()
+            connection.close()
+
 if __name__ == "__main__":
-    init_ticketing_service_db()
\ No newline at end of file
+    import sys
+    # Pass --migrate to only add the new columns to an existing database and keep its data
+    if "--migrate" in sys.argv:
+        migrate_ticketing_service_db()
+    else:
+        init_ticketing_service_db()
\ No newline at end of file
@@ -23,6 +23,8 @@ class TicketingService:
         self.connection = None
         self.cursor = None
         self.expiry = 10  # Lock expiry time in seconds
+        # Seconds to wait in the lock's queue when another client holds it. 0 fails right away.
+        self.lock_wait_timeout = 0
 
         # Lets connect with the Postgres DB
         try:
@@ -67,9 +69,14 @@ class TicketingService:
         if self.connection:
             self.connection.close()
     
-    def execute_db_query(self, query, params=None):
+    def execute_db_query(self, query, params=None, fenced=False):
+        # A fenced query is guarded by a fencing token in its WHERE clause and fails if it updated nothing.
         try:
             self.cursor.execute(query, params)
+            if fenced and self.cursor.rowcount == 0:
+                logger.debug(f"Rejected stale fencing token for query: {query} with params: {params}")
+                self.connection.rollback()
+                return False
             self.connection.commit()
         except (Exception, psycopg2.DatabaseError) as error:
             logger.error(f"Error executing query: {error}")
@@ -78,14 +85,21 @@ class TicketingService:
         return True
 
 
+    # The lock methods return the fencing token of the client's lock with the distributed lock service, True with
+    # ephemeral nodes, which have no tokens, and False if the client does not hold the lock. The token is returned
+    # to the caller instead of being stored on the service, which all clients of the ticketing API share, so a
+    # client whose lock was taken over still writes with its own older token and is rejected.
     def _acquire_lock_for_ticket(self, ticket_id, client_id):
         logger.debug(f"{client_id} attempting to acquire lock for ticket {ticket_id}")
         if self.lock_manager_type == "distributed_lock":
             client_data = {"key": f"ticket_lock_{ticket_id}", "client_id": client_id, "expiry": self.expiry }
+            if self.lock_wait_timeout:
+                # Block on the lock service until the lock is handed to us instead of polling
+                client_data["wait_timeout"] = self.lock_wait_timeout
             response = requests.post(f"{self.base_url}/acquire_lock", json=client_data)
             if response.status_code == 200:
                 logger.info(f"{client_id} acquired Lock on ticket {ticket_id}: {response.json()}")
-                return True
+                return response.json()["fencing_token"]
             elif response.status_code == 409:
                 logger.debug(f"{client_id} could not acquire lock on ticket {ticket_id}: {response.json()}")
                 return False
@@ -96,16 +110,23 @@ class TicketingService:
             response = requests.post(f"{self.base_url}/create_node", json=client_data)
             if response.status_code == 200:
                 logger.info(f"{client_id} created Ephemeral Node for ticket {ticket_id}: {response.json()}")
-                # Now check if the node is the owner of the lock
-                owner_response = requests.get(f"{self.base_url}/current_lock_owner/{parent_path}")
-                if owner_response.status_code == 200:
-                    owner_info = owner_response.json()
-                    if owner_info.get("current_lock_owner") == client_id:
-                        logger.info(f"{client_id} acquired Lock on ticket {ticket_id} via Ephemeral Node: {owner_info}")
+                node_path = response.json()["node_path"]
+                # The service tells us whether we own the lock in the same call that created our node
+                if response.json()["current_lock_owner"] == client_id:
+                    logger.info(f"{client_id} acquired Lock on ticket {ticket_id} via Ephemeral Node: {response.json()}")
+                    return True
+                if self.lock_wait_timeout:
+                    # The service holds the request until the node before ours is deleted or expires, instead of
+                    # us polling the lock owner.
+                    wait_data = {"path": node_path, "timeout": self.lock_wait_timeout}
+                    owner_response = requests.post(f"{self.base_url}/wait_for_lock", json=wait_data)
+                    if owner_response.status_code == 200:
+                        logger.info(f"{client_id} acquired Lock on ticket {ticket_id} via Ephemeral Node: {owner_response.json()}")
                         return True
-                else:
-                    logger.debug(f"Could not get current lock owner for ticket {ticket_id}: {owner_response.json()}")
-                    return False
+                logger.debug(f"{client_id} could not acquire lock on ticket {ticket_id}, queued behind {response.json()['predecessor']}")
+                # Leave the queue so our node does not become the owner after we gave up
+                requests.post(f"{self.base_url}/delete_node", json={"path": node_path})
+                return False
         else:
             raise Exception("Invalid lock manager type specified.")
         
@@ -117,12 +138,12 @@ class TicketingService:
                 lock_info = response.json()
                 logger.debug(f"Lock info for ticket {ticket_id}: {lock_info}")
                 if lock_info["lock_status"] == "locked" and lock_info.get("client_id") == client_id:
-                    return True
+                    return lock_info["fencing_token"]
             return False
         elif self.lock_manager_type == "ephemeral_node":
             # For ephemeral node, we would check if the node exists and is owned by the client_id
             parent_path = f"/locks/ticket_lock_{ticket_id}"
-            owner_response = requests.get(f"{self.base_url}/current_lock_owner/{parent_path}")
+            owner_response = requests.get(f"{self.base_url}/current_lock_owner", params={"path": parent_path})
             if owner_response.status_code == 200:
                 owner_info = owner_response.json()
                 logger.debug(f"Current lock owner info for ticket {ticket_id}: {owner_info}")
@@ -137,7 +158,8 @@ class TicketingService:
         # Make a call to postgres to check if ticket is available.
         # Then try to obtain a distributed lock for that ticket.
         # If lock is obtained, mark the ticket as reserved in the DB.
-        if ticket_id in self.tickets and self._acquire_lock_for_ticket(ticket_id, client_id):
+        token = self._acquire_lock_for_ticket(ticket_id, client_id) if ticket_id in self.tickets else False
+        if token:
             sold_to, state = self.tickets[ticket_id]
             # First lets acquire the lock for this ticket.
             # If we get the lock, we can proceed to reserve the ticket.
@@ -145,8 +167,14 @@ class TicketingService:
             if state == 'available' or state == 'reserved': # In case we try to reserve an already reserved ticket for the same client.
                 # Mark ticket as reserved
                 # Lets update the database entry as well.
-                db_query = "UPDATE tickets SET sold_to = %s, state = %s WHERE ticket_id = %s;"
-                if self.execute_db_query(db_query, (client_id, 'reserved', ticket_id)):
+                if self.lock_manager_type == "distributed_lock":
+                    # Reject the update if a client with a newer lock on the ticket already wrote to it.
+                    db_query = "UPDATE tickets SET sold_to = %s, state = %s, fencing_token = %s WHERE ticket_id = %s AND fencing_token <= %s;"
+                    updated = self.execute_db_query(db_query, (client_id, 'reserved', token, ticket_id, token), fenced=True)
+                else:
+                    db_query = "UPDATE tickets SET sold_to = %s, state = %s WHERE ticket_id = %s;"
+                    updated = self.execute_db_query(db_query, (client_id, 'reserved', ticket_id))
+                if updated:
                     self.tickets[ticket_id] = (client_id, 'reserved')
                     return True
                 else:
@@ -159,11 +187,17 @@ class TicketingService:
         # Make a call to postgres to check if ticket is reserved.
         # Check if this client has the lock for this ticket.
         # If yes, mark the ticket as booked in the DB.
-        if ticket_id in self.tickets and self._client_has_lock_for_ticket(ticket_id, client_id):
+        token = self._client_has_lock_for_ticket(ticket_id, client_id) if ticket_id in self.tickets else False
+        if token:
             sold_to, state = self.tickets[ticket_id]
             if state == "reserved" and sold_to == client_id:
-                db_query = "UPDATE tickets SET state = %s WHERE ticket_id = %s;"
-                if self.execute_db_query(db_query, ('sold', ticket_id)):
+                if self.lock_manager_type == "distributed_lock":
+                    db_query = "UPDATE tickets SET state = %s, fencing_token = %s WHERE ticket_id = %s AND fencing_token <= %s;"
+                    updated = self.execute_db_query(db_query, ('sold', token, ticket_id, token), fenced=True)
+                else:
+                    db_query = "UPDATE tickets SET state = %s WHERE ticket_id = %s;"
+                    updated = self.execute_db_query(db_query, ('sold', ticket_id))
+                if updated:
                     # Mark ticket as sold
                     self.tickets[ticket_id] = (client_id, 'sold')
                     return True 